@@ -13,11 +13,32 @@
     error records. Data can be downloaded from the CDC VAERS site,
     https://vaers.hhs.gov/data.html. It is recommended to download the data
     for all years, extract it, and use that folder for your data folder.
+    The downloaded ZIP files can also be left unextracted in the data folder.
 
     For best performance run CPU 4+ core 3.0GHz+, 8GB+ RAM, 10GB+ available SSD
     Should run OK on slower hardware, but time will greatly increase.
     Run time is approximately 3 hours on hardware similar to what is listed
-    above. Using multi-threading can reduce the time.
+    above. Using multiple worker processes (--jobs N) can reduce the time.
+    Splitting each year by VAERS_ID (--shards N) lets a single large year
+    use all of the worker processes.
+    An extract of a few columns (--columns AGE_YRS SYMPTOM VAX_TYPE_1 ...)
+    only reads, cleans and writes those columns and runs much faster.
+    Filters (--filter VAX_TYPE=COVID19 RECVDATE>=01/01/2021 STATE=CA,NY)
+    drop the other rows as the files are read.
+    With --partitioned the yearly files are also written as a dataset with
+    a folder per year (and per VAX_TYPE with --vax-type-partitions) that
+    VAERSDataset reads one year, VAX type and column at a time.
+    With --sqlite they are loaded into VAERSData.sqlite, indexed by
+    VAERS_ID, RECVDATE, VAX_TYPE and symptom, for lookup_reports.
+    Writing the csv files compressed (--compression gzip or zstd) saves
+    disk space and I/O, zstd needs the zstandard package.
+    With --delta (best with --incremental) the rows of the rebuilt years are
+    compared with the last run by VAERS_ID, only the total file from the
+    first changed year on and the changed SQLite reports are rewritten,
+    and the inserted, changed and deleted IDs go to VAERSChangelog.csv.
+    With --layout long the pivot stages are skipped and each year is
+    written as Reports, ReportVaccines and ReportSymptoms tables keyed by
+    VAERS_ID, with a row per vaccine and symptom and no limit on either.
     
     This code is open source and licensed under the GNU GPL v3 at:
     https://www.gnu.org/licenses/gpl-3.0.en.html.
@@ -29,17 +50,58 @@ import sys
 import pandas as pd
 import numpy as np
 from datetime import datetime
-from multiprocessing import Process
 from multiprocessing import Pool
-from functools import partial
 import argparse
 from itertools import chain
 import chardet  
+import json
+import hashlib
+import re
+import time
+import warnings
+import io
+import contextlib
+import traceback
+import cProfile
+import pstats
+import tracemalloc
+import zipfile
+import operator
+import gzip
+import shutil
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 
 #================ Constants ================
 __error_begin_year_validation__ = 'Error: Start year validation error'
 __error_stop_year_validation__ = 'Error: End year validation'
 __error_missing_files__ = 'Error: Missing files'
+__error_unknown_filter_column__ = 'Error: Filter column not found'
+__error_unknown_selected_column__ = 'Error: Selected column not found'
+__error_layout_options__ = 'Error: Options not available with the long layout'
+manifest_name = 'VAERSManifest.json'
+all_years_archive_name = 'AllVAERSDataCSVS.zip'
+run_report_name = 'VAERSRunReport.json'
+dataset_dir_name = 'VAERSDataset/'
+dataset_index_name = '_index.json'
+sqlite_name = 'VAERSData.sqlite'
+changelog_name = 'VAERSChangelog.csv'
+long_table_names = ['Reports', 'ReportVaccines', 'ReportSymptoms'] # the files of the reports, report_vaccines and report_symptoms tables of the long layout
+date_format = '%m/%d/%Y'
+filter_operators = {'>=': operator.ge, '<=': operator.le, '>': operator.gt, '<': operator.lt} # besides = and !=, which take a comma separated list
+compression_extensions = {'gzip': '.gz', 'zstd': '.zst'} # added after .csv for compressed csv files
+compression_block_size = 4 * 1024 * 1024 # bytes of csv text each compression thread takes at a time
+compression_batch_rows = 100000 # rows turned into csv text at a time for a compressed file
+# dtypes of the VAERS columns for typed_schema, by name without the number of the pivoted columns (VAX_TYPE_1, SYMPTOM12)
+column_schema = {'VAERS_ID': 'int', 'RECVDATE': 'date', 'STATE': 'category', 'AGE_YRS': 'number', 'CAGE_YR': 'number',
+                 'CAGE_MO': 'number', 'SEX': 'category', 'RPT_DATE': 'date', 'DIED': 'category', 'DATEDIED': 'date',
+                 'L_THREAT': 'category', 'ER_VISIT': 'category', 'HOSPITAL': 'category', 'HOSPDAYS': 'int', 'X_STAY': 'category',
+                 'DISABLE': 'category', 'RECOVD': 'category', 'VAX_DATE': 'date', 'ONSET_DATE': 'date', 'NUMDAYS': 'int',
+                 'V_ADMINBY': 'category', 'V_FUNDBY': 'category', 'FORM_VERS': 'int', 'TODAYS_DATE': 'date',
+                 'BIRTH_DEFECT': 'category', 'OFC_VISIT': 'category', 'ER_ED_VISIT': 'category',
+                 'VAX_TYPE': 'category', 'VAX_MANU': 'category', 'VAX_DOSE_SERIES': 'category', 'VAX_ROUTE': 'category',
+                 'VAX_SITE': 'category', 'VAX_NAME': 'category', 'SYMPTOM': 'category', 'SYMPTOMVERSION': 'category'}
 #===========================================
 
 #================ User provided variables ================
@@ -49,25 +111,57 @@ output_dir_name = 'C:/Users/Giant/Desktop/Vaccine2/TotalCleanData/'
 begin_year = None
 stop_year = None
 non_domestic_flag = False
-multi_thread = False
+jobs = 1 # worker processes, 1 runs everything in this process
+csv_engine = 'python' # python, c or pyarrow
+chunk_size = None # rows per batch when scrubbing and appending, None reads each file at once
+intermediate_format = 'csv' # csv, parquet or feather for the clean files passed between the stages
+output_formats = ['csv'] # csv and/or parquet for the yearly and total files
+output_layout = 'wide' # wide pivots each report into one row, long writes the reports, report_vaccines and report_symptoms tables instead
+compression = None # None, gzip or zstd for the csv clean, yearly and total files, zstd needs the zstandard package
+compression_threads = os.cpu_count() or 1 # threads compressing each csv file
+typed_schema = False # load the combine and append stages with the column_schema dtypes instead of all text
+profile_modes = [] # cpu and/or memory to profile each stage into output_dir_name/profiles, empty for no profiling
+profile_top_n = 30 # functions and allocation sites listed in the profile summaries
+shards = 1 # hash partitions of VAERS_ID each year is split into to combine its parts in parallel, 1 combines each year whole
+partitioned = False # also write the yearly files as a dataset in output_dir_name/VAERSDataset, one folder per year, see VAERSDataset
+vax_type_partitions = False # split each year of the dataset into a folder per VAX_TYPE_1
+sqlite_index = False # also load the yearly files into output_dir_name/VAERSData.sqlite, indexed for lookups with lookup_reports
+delta_merge = False # patch the total file and the SQLite database with the rows that changed in the rebuilt years, logged in VAERSChangelog.csv
+row_filters = [] # rows kept, eg. [('VAX_TYPE', '=', 'COVID19'), ('RECVDATE', '>=', '01/01/2021')] on the values of the original files. Empty keeps them all
+selected_columns = None # the only columns to read and write besides VAERS_ID, eg. ['AGE_YRS', 'VAX_TYPE_1', 'SYMPTOM'] where SYMPTOM is every SYMPTOMn, None for all
+in_memory = False # scrub, combine and join each year without re-reading the clean files between the stages
+incremental = False # skip the years whose original files and outputs have not changed since the last run
+max_vax_records = 6
+encoding_sample_size = 1024 * 1024 # bytes given to chardet before settling on an encoding
+encoding_chunk_size = 64 * 1024
+scrub_replacements = [('@', 'at'), ('#', 'hashtag'), ('\'', 'quote'), ('\"', 'quote'), ('&', 'and'),
+                      ('-', 'minus'), (';', 'semicolon'), (':', 'colon'), ('~', ' ')] # applied in order to each column
 #========================================================== 
 
+settings_names = ['original_dir_name', 'clean_dir_name', 'output_dir_name', 'begin_year', 'stop_year', 'non_domestic_flag',
+                  'jobs', 'csv_engine', 'chunk_size', 'intermediate_format', 'output_formats', 'output_layout', 'compression', 'compression_threads', 'typed_schema', 'profile_modes', 'profile_top_n', 'shards', 'partitioned', 'vax_type_partitions', 'sqlite_index', 'delta_merge', 'row_filters', 'selected_columns', 'in_memory', 'incremental', 'max_vax_records', 'encoding_sample_size', 'encoding_chunk_size', 'scrub_replacements']
+encoding_cache = {}
+bad_lines_by_file = {}
+run_report = [] # an entry for each stage run on a file, see report_stage
+stage_report = None # the entry of the stage running in this process, the readers and writers add their counts to it
+stage_memory = None # the largest tracemalloc snapshot of the stage running in this process, when profiling memory
+
 
 '''
 Get the List of all files in the directory tree 
 Optional: start and end year to get files prefixed with those years
 Optional: file name suffix to get one of the three file types (eg. VAERSVAX.csv)
 '''
-def get_list_of_files(dir_name, start_year, end_year, non_domestic_flag):
+def get_list_of_files(dir_name, start_year, end_year, non_domestic_flag, extension='.csv'):
     current_year = start_year
     all_files = list()
-    file_base_names = ['VAERSDATA.csv', 'VAERSSYMPTOMS.csv', 'VAERSVAX.csv']
+    file_base_names = ['VAERSDATA' + extension, 'VAERSSYMPTOMS' + extension, 'VAERSVAX' + extension]
    
     while current_year <= end_year: 
         files_to_append = []
         
         for file_name in file_base_names:
-            full_name = dir_name + str(current_year) + file_name
+            full_name = get_original_file_name(dir_name, str(current_year), file_name)
             files_to_append = add_file_if_exists(full_name, files_to_append)
         if is_file_list_length_matching(len(files_to_append), len(file_base_names), current_year):
             all_files.append(files_to_append)
@@ -77,7 +171,7 @@ def get_list_of_files(dir_name, start_year, end_year, non_domestic_flag):
     files_to_append = []
     if non_domestic_flag == True:
         for file_name in file_base_names:
-            full_name = dir_name + 'NonDomestic' + file_name
+            full_name = get_original_file_name(dir_name, 'NonDomestic', file_name)
             files_to_append = add_file_if_exists(full_name, files_to_append)
 
         if is_file_list_length_matching(len(files_to_append), len(file_base_names), current_year):
@@ -86,261 +180,920 @@ def get_list_of_files(dir_name, start_year, end_year, non_domestic_flag):
     print('all files: ' + str(all_files))
     return all_files   
 
+# The extracted file, or when it is not there the same file in the <prefix>VAERSData.zip archive CDC publishes
+# for each year, or in the AllVAERSDataCSVS.zip archive of all the years
+def get_original_file_name(dir_name, prefix, file_name):
+    full_name = dir_name + prefix + file_name
+    if input_file_exists(full_name):
+        return full_name
+    for archive in [prefix + 'VAERSData.zip', all_years_archive_name]:
+        if input_file_exists(dir_name + archive + '/' + prefix + file_name):
+            return dir_name + archive + '/' + prefix + file_name
+    return full_name
+
 # Remove problematic chars and replace them with representative string
-def scrub_file(in_file, out_dir):
-    out_file = out_dir + (in_file.rpartition('/')[2]) 
+# With row_filters, only the rows that pass them are scrubbed, and with ids only the rows of those VAERS_IDs
+def scrub_file(in_file, out_dir, ids=None):
+    out_file = out_dir + (in_file.rpartition('/')[2]).rpartition('.')[0] + get_clean_extension()
     print('scrub: ' + in_file)  
-    file_encoding = get_file_encoding(in_file)
 
+    read_options = get_scrub_read_options(in_file, selected_columns, row_filters)
+
+    # with a chunk_size, read, scrub and append fixed size batches of rows to keep memory bounded
+    if chunk_size is None:
+        chunks = [read_csv_file(in_file, **read_options)] #drop records with errors
+    else:
+        chunks = read_csv_chunks(in_file, chunk_size, **read_options) #drop records with errors
+
+    scrub_seconds = 0
+    rows_read = 0
+    rows_kept = 0
+    writer = TableWriter(out_file)
+    for dataframe in chunks:
+        rows_read += len(dataframe)
+        dataframe = filter_rows(dataframe, row_filters, ids)
+        rows_kept += len(dataframe)
+        dataframe.set_index('VAERS_ID', inplace=True) #drop the auto-numbered column
+
+        # Replacement
+        start_time = time.perf_counter()
+        dataframe = scrub_dataframe(dataframe)
+        scrub_seconds += time.perf_counter() - start_time
+
+        # Create the clean copy of the file
+        writer.write(dataframe)
+    writer.close()
+    if len(row_filters) > 0 or ids is not None:
+        print('filters kept ' + str(rows_kept) + ' of ' + str(rows_read) + ' rows')
+
+    file_megabytes = get_file_stat(in_file).st_size / (1024 * 1024)
+    print('scrubbed ' + str(round(file_megabytes, 2)) + ' MB at ' + str(round(file_megabytes / max(scrub_seconds, 1e-9), 2)) + ' MB/s')
+    print(out_file)
+
+# Read every column of an original file as text, and only the eight VAX columns of a VAX file
+# With columns, only VAERS_ID, the columns that make up the selected ones and the columns the filters look at are read
+def get_scrub_read_options(in_file, columns=None, filters=()):
+    read_options = {'dtype': str, 'na_filter': False}
     if 'VAERSVAX.csv' in in_file:
-        dataframe = pd.read_csv(in_file, engine='python', on_bad_lines='skip', usecols=[*range(0,8)], encoding=file_encoding, dtype=str, na_filter=False) #drop records with errors, trim empty cols
+        read_options['usecols'] = [*range(0,8)] #trim empty cols
+    if columns is not None:
+        header = get_table_columns(in_file)
+        if 'VAERSVAX.csv' in in_file:
+            header = header[:8]
+        read_options['usecols'] = get_read_columns(header, list(columns) + [column for column, _, _ in filters])
+    return read_options
+
+# A filter expression such as VAX_TYPE=COVID19, RECVDATE>=01/01/2021 or STATE=CA,NY as a (column, operator, value) tuple
+def parse_filter(expression):
+    match = re.fullmatch(r'\s*(\w+)\s*(!=|>=|<=|=|>|<)\s*(.*?)\s*', expression)
+    if match is None:
+        raise argparse.ArgumentTypeError('not a filter, expected COLUMN=VALUE, COLUMN!=VALUE, COLUMN>=VALUE, ...: ' + expression)
+    column, op, value = match.groups()
+    check_filter_value(column, op, value)
+    return column, op, value
+
+# A value for a date or number column of column_schema that does not parse would drop every row, stop on it instead.
+# A blank item of = and != is kept, it stands for the missing values
+def check_filter_value(column, op, value):
+    kind = column_schema.get(get_base_column_name(column))
+    for text in value.split(',') if op in ['=', '!='] else [value]:
+        if text == '' and op in ['=', '!=']:
+            continue
+        try:
+            if kind == 'date':
+                datetime.strptime(text, date_format)
+            elif kind in ['int', 'number'] and pd.isna(pd.to_numeric(text)):
+                raise ValueError(text)
+        except ValueError:
+            expected = 'a date as ' + date_format.replace('%m', 'mm').replace('%d', 'dd').replace('%Y', 'yyyy') if kind == 'date' else 'a number'
+            raise argparse.ArgumentTypeError(column + ' takes ' + expected + ', not ' + repr(text) + ': ' + column + op + value)
+
+# Keep the rows that pass every filter on a column of the DataFrame, and with ids only the rows of those VAERS_IDs.
+# A filter on a column the DataFrame does not have is left to the other files of the year, the join drops their IDs
+def filter_rows(dataframe, filters, ids=None):
+    mask = np.ones(len(dataframe), dtype=bool)
+    for column, op, value in filters:
+        if column in dataframe.columns:
+            mask &= get_filter_mask(dataframe[column], op, value)
+    if ids is not None:
+        mask &= dataframe['VAERS_ID'].isin(ids).to_numpy()
+    if mask.all():
+        return dataframe
+    return dataframe[mask].reset_index(drop=True)
+
+# The rows of a column that pass a filter. Dates and numbers of column_schema are compared as dates and numbers,
+# everything else as text. A missing or unreadable date or number only passes !=
+def get_filter_mask(values, op, value):
+    kind = column_schema.get(get_base_column_name(values.name))
+    if kind == 'date':
+        convert = lambda text: pd.to_datetime(text, format=date_format, errors='coerce')
+    elif kind in ['int', 'number']:
+        convert = lambda text: pd.to_numeric(text, errors='coerce')
     else:
-        dataframe = pd.read_csv(in_file, engine='python', on_bad_lines='skip', encoding=file_encoding, dtype=str, na_filter=False) #drop records with errors
+        convert = lambda text: text
+    left = convert(values)
+    right = convert(pd.Series(value.split(',') if op in ['=', '!='] else [value], dtype=object))
+
+    if op == '=':
+        return left.isin(right).to_numpy()
+    if op == '!=':
+        return ~left.isin(right).to_numpy()
+    return filter_operators[op](left, right.iloc[0]).to_numpy(dtype=bool)
 
-    dataframe.set_index('VAERS_ID', inplace=True) #drop the auto-numbered column
+# The IDs left in both the clean DATA and VAX files of a year after filtering, the only IDs the join can keep
+def get_filtered_ids(file_group, clean_dir):
+    clean_files = [clean_dir + file.rpartition('/')[2].rpartition('.')[0] + get_clean_extension() for file in [file_group[0], file_group[2]]]
+    ids = [read_table_file(file, columns=['VAERS_ID'], dtype=str, na_filter=False)['VAERS_ID'].to_numpy(dtype=object) for file in clean_files]
+    return np.intersect1d(ids[0], ids[1])
 
-    # Replacement
+# Stop before any stage starts when a filter names a column that the original files of a year do not have
+def check_filter_columns(list_of_files):
+    for file_group in list_of_files:
+        columns = set(chain.from_iterable(get_table_columns(file) for file in file_group))
+        unknown = [column for column, _, _ in row_filters if column not in columns]
+        if len(unknown) > 0:
+            print('Filter columns ' + str(unknown) + ' are not in ' + str(file_group))
+            sys.exit(__error_unknown_filter_column__)
+
+# Stop before any stage starts when a selected column is in none of the original files, named in full or by the name
+# it is pivoted from (VAX_TYPE_1 for VAX_TYPE, SYMPTOM for SYMPTOM1). It would leave an extract without that column
+def check_selected_columns(list_of_files):
+    header = set(chain.from_iterable(get_table_columns(file) for file_group in list_of_files for file in file_group))
+    known = header | {get_base_column_name(col) for col in header}
+    unknown = [col for col in selected_columns if col not in known and get_base_column_name(col) not in known]
+    if len(unknown) > 0:
+        print('Selected columns ' + str(unknown) + ' are not in any of the files')
+        sys.exit(__error_unknown_selected_column__)
+
+# The columns of a file needed for the selected columns of the yearly files: the selected columns and the columns
+# they are pivoted from, eg. VAX_TYPE for VAX_TYPE_1. The symptom pivot needs every SYMPTOMn and SYMPTOMVERSIONn
+# when any of them is selected. VAERS_ID is always read, the join keeps only the IDs found in all three files
+def get_read_columns(header, columns):
+    wanted = set(columns) | {get_base_column_name(col) for col in columns}
+    if 'SYMPTOM' in wanted or 'SYMPTOMVERSION' in wanted:
+        wanted = wanted | {'SYMPTOM', 'SYMPTOMVERSION'}
+    return [col for col in header if col == 'VAERS_ID' or col in wanted or get_base_column_name(col) in wanted]
+
+# The selected columns of a joined year, named in full (VAX_TYPE_1) or by the name they are pivoted from (VAX_TYPE)
+def select_columns(dataframe, columns):
+    return dataframe[[col for col in dataframe.columns if col in columns or get_base_column_name(col) in columns]]
+
+# Apply the whole substitution table to each column at once, as one text buffer per column
+def scrub_dataframe(dataframe, replacements=None):
+    if replacements is None:
+        replacements = scrub_replacements
     dataframe = dataframe.astype(str)
-    dataframe = dataframe.replace('@', 'at', regex=True) 
-    dataframe = dataframe.replace('#', 'hashtag', regex=True)
-    dataframe = dataframe.replace('\'', 'quote', regex=True)
-    dataframe = dataframe.replace('\"', 'quote', regex=True) 
-    dataframe = dataframe.replace('&', 'and', regex=True) 
-    dataframe = dataframe.replace('-', 'minus', regex=True)
-    dataframe = dataframe.replace(';', 'semicolon', regex=True)
-    dataframe = dataframe.replace(':', 'colon', regex=True)
-    dataframe = dataframe.replace('~', ' ', regex=True)
-
-    # Create the clean copy of the file
-    print(out_file)
-    dataframe.to_csv(out_file)
+    scrubbed = {col: np.array(scrub_column(dataframe[col].to_list(), replacements), dtype=object) for col in dataframe.columns}
+    return pd.DataFrame(scrubbed, index=dataframe.index, columns=dataframe.columns)
+
+# Join the values with a separator, run the substitution table over the buffer and split it again.
+# Falls back to value by value if the separator shows up in the data or the table
+def scrub_column(values, replacements, separator='\x00'):
+    if len(values) == 0:
+        return values
+    buffer = separator.join(values)
+    if buffer.count(separator) != len(values) - 1 or any(separator in target + replacement for target, replacement in replacements):
+        return [substitute_all(value, replacements) for value in values]
+    return substitute_all(buffer, replacements).split(separator)
+
+# Replace each target in order, the same as running the replacements one after another
+def substitute_all(text, replacements):
+    for target, replacement in replacements:
+        text = text.replace(target, replacement)
+    return text
 
 # Combine the cleaned files by year - Creates one file for each year of VAERS data
 def combine_files(in_files, out_dir):
     for file_group in in_files:
         #Combine files for each year, join on VAERS_ID
-        dataframe = pd.DataFrame()
-        first_run = True
-        prefix = None
-
-        for file in file_group:
-            print('combining: ' + file)
-            file_encoding = get_file_encoding(file)
-            df = pd.read_csv(file, engine='python', on_bad_lines='skip', encoding=file_encoding, dtype=str, na_filter=False) #drop records with errors
-            if first_run == True:
-                dataframe = df              
-                first_run = False
-            else:                
-                dataframe = pd.merge(dataframe, df, how="inner", on="VAERS_ID")
-            prefix = file.rpartition('/')[2]  
-            prefix = prefix.split('V')[0] 
-
-        #Combine all files with same columns - do this from data frame above        
-        dataframe.set_index('VAERS_ID', inplace=True)
-        dataframe.to_csv(out_dir + prefix + 'VAERS.csv')
+        dataframe = join_clean_files(file_group)
+        prefix = get_file_prefix(file_group[0])
+
+        #Combine all files with same columns - do this from data frame above
+        for output_format in output_formats:
+            write_table_file(dataframe, out_dir + prefix + 'VAERS' + get_table_extension(output_format, compression))
+
+# With the long layout, write the reports of a year, one row per vaccine of each report and one row per symptom of each report
+# as three tables keyed by VAERS_ID instead of pivoting and joining them into one wide row per report.
+# The reports are those the wide join keeps, the IDs found in all three files
+def write_long_tables(file_group, out_dir):
+    frames = []
+    for file in file_group:
+        print('writing long tables: ' + file)
+        frames.append(read_table_file(file, dtype=str, na_filter=False)) #drop records with errors
+    reports, symptoms, vaccines = frames
+
+    found = reports['VAERS_ID'].isin(symptoms['VAERS_ID']) & reports['VAERS_ID'].isin(vaccines['VAERS_ID'])
+    report_ids = pd.Index(reports.loc[found, 'VAERS_ID'].unique())
+    print_dropped_rows(file_group, frames, [int((~found).sum()), int((~symptoms['VAERS_ID'].isin(report_ids)).sum()), int((~vaccines['VAERS_ID'].isin(report_ids)).sum())])
+    if 'SYMPTOM1' in symptoms.columns:
+        symptoms = flatten_symptoms(symptoms)
+    else: # the symptoms are not selected
+        symptoms = pd.DataFrame(columns=['VAERS_ID'])
+
+    tables = {'Reports': reports.loc[found].set_index('VAERS_ID'),
+              'ReportVaccines': number_report_rows(vaccines, report_ids, 'VAX_NUMBER'),
+              'ReportSymptoms': number_report_rows(symptoms, report_ids, 'SYMPTOM_NUMBER')}
+    prefix = get_file_prefix(file_group[0])
+    for table_name, dataframe in tables.items():
+        for output_format in output_formats:
+            write_table_file(dataframe, out_dir + prefix + 'VAERS' + table_name + get_table_extension(output_format, compression))
+
+# Number the rows of each VAERS_ID from 1 in file order, with no limit, and keep those of the reports in the order of the reports
+def number_report_rows(dataframe, report_ids, number_name):
+    positions = report_ids.get_indexer(dataframe['VAERS_ID'])
+    dataframe = dataframe.loc[positions >= 0]
+    dataframe.insert(1, number_name, dataframe.groupby('VAERS_ID', sort=False).cumcount() + 1)
+    order = np.argsort(positions[positions >= 0], kind='stable')
+    return dataframe.iloc[order].set_index('VAERS_ID')
+
+# Read the DATA, SYMPTOMS and VAX clean files of a year and join them on VAERS_ID
+def join_clean_files(file_group):
+    frames = []
+    for file in file_group:
+        print('combining: ' + file)
+        df = read_table_file(file, dtype=get_read_dtypes(file), na_filter=False) #drop records with errors
+        frames.append(apply_schema(df) if typed_schema else df)
+
+    dataframe, dropped = join_frames(frames)
+    print_dropped_rows(file_group, frames, dropped)
+    if selected_columns is not None:
+        dataframe = select_columns(dataframe, selected_columns)
+    return dataframe
 
-# Combine all the clean files - creates a file with the total VAERS data 
-def append_files(in_files, out_dir):
-    total_dataframe = pd.DataFrame()
-    first_file = True
+def print_dropped_rows(files, frames, dropped):
+    for file, frame, count in zip(files, frames, dropped):
+        if count > 0:
+            print('join dropped ' + str(count) + ' of ' + str(len(frame)) + ' rows from ' + file)
 
+# Inner join the frames on VAERS_ID in one pass, keeping the rows in the order of the first frame.
+# Returns the joined frame indexed by VAERS_ID and the number of rows dropped from each frame
+def join_frames(frames):
+    keys = [get_integer_keys(df) for df in frames]
+    value_columns = [col for df in frames for col in df.columns if col != 'VAERS_ID']
+    if any(key is None for key in keys) or len(value_columns) != len(set(value_columns)):
+        return merge_frames(frames)
+
+    # keep the IDs of the first frame found in every other frame, then look up their rows with a sorted key
+    found = np.ones(len(keys[0]), dtype=bool)
+    for key in keys[1:]:
+        found &= np.isin(keys[0], key)
+    positions = np.flatnonzero(found)
+    common = keys[0][positions]
+
+    # gather each column once, straight from its array
+    rows = [positions]
+    for key in keys[1:]:
+        order = np.argsort(key, kind='stable')
+        rows.append(order[np.searchsorted(key[order], common)])
+    columns = {}
+    for df, row in zip(frames, rows):
+        for col in df.columns:
+            if col != 'VAERS_ID':
+                columns[col] = df[col].array.take(row)
+
+    index = pd.Index(frames[0]['VAERS_ID'].array.take(positions), name='VAERS_ID')
+    dataframe = pd.DataFrame(columns, index=index)
+    return dataframe, [len(df) - len(common) for df in frames]
+
+# The VAERS_ID column as int64, or None when an ID is not a plain integer or is repeated
+def get_integer_keys(df):
+    ids = df['VAERS_ID'].to_numpy()
+    try:
+        keys = ids.astype(np.int64)
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+    # '0123' and '123' are different IDs to the string join, keep them apart
+    if not pd.Index(keys).is_unique or not (keys.astype(str) == ids.astype(str)).all():
+        return None
+    return keys
+
+# Chained string merges, for frames whose IDs the integer join cannot handle
+def merge_frames(frames):
+    dataframe = frames[0]
+    for df in frames[1:]:
+        dataframe = pd.merge(dataframe, df, how="inner", on="VAERS_ID")
+
+    joined_ids = dataframe['VAERS_ID'].unique()
+    dropped = [int((~df['VAERS_ID'].isin(joined_ids)).sum()) for df in frames]
+    return dataframe.set_index('VAERS_ID'), dropped
+
+# The year or NonDomestic prefix of a VAERS file name, eg. 2019 for .../2019VAERSDATA.csv
+def get_file_prefix(file):
+    return file.rpartition('/')[2].split('V')[0]
+
+# The names of the yearly files combine_files creates for the groups of clean files, or those of a table of the long layout
+def get_combined_file_names(in_files, out_dir, table_name=''):
+    return [out_dir + get_file_prefix(file_group[0]) + 'VAERS' + table_name + get_table_extension(output_formats[0], compression) for file_group in in_files]
+
+# Combine all the yearly files - creates a file with the total VAERS data.
+# Writes the header once and appends each file (or chunk of it) straight to the output.
+# Returns the columns of a plain csv total file and where each year starts and ends in it, for delta_merge to patch it
+def append_files(in_files, out_dir, total_name='TotalVAERSData'):
+    columns_by_file = {file: get_table_columns(file) for file in in_files}
+    columns = get_union_columns(list(columns_by_file.values()))
+    writers = [TableWriter(out_dir + total_name + get_table_extension(output_format, compression)) for output_format in output_formats]
+    segments = append_to_writers(in_files, columns_by_file, columns, writers, out_dir + total_name + '.csv')
+    for writer in writers:
+        writer.close()
+    return get_total_record(out_dir + total_name + '.csv', columns, segments)
+
+# Append the files to the writers, returns the year, start and end offset of each file in total_file.
+# start is where the csv writer of total_file begins, 0 for a new file and the end of the kept years for a patched one
+def append_to_writers(in_files, columns_by_file, columns, writers, total_file, start=0):
+    csv_writers = [writer for writer in writers if writer.out_file == total_file]
+    segments = []
     for file in in_files:
         print('appending ' + file)
-        file_encoding = get_file_encoding(file)
-        df = pd.read_csv(file, engine='python', on_bad_lines='skip', encoding=file_encoding) #drop records with errors
+        missing_columns = [col for col in columns if col not in columns_by_file[file]]
+        if len(missing_columns) > 0:
+            print(str(len(missing_columns)) + ' columns missing from ' + file + ' are left blank, starting with ' + missing_columns[0])
+
+        dtypes = get_read_dtypes(file)
+        if chunk_size is None:
+            chunks = [read_table_file(file, dtype=dtypes, na_filter=False)] #drop records with errors
+        else:
+            chunks = read_table_chunks(file, chunk_size, dtype=dtypes, na_filter=False) #drop records with errors
+
+        for df in chunks:
+            if typed_schema:
+                df = apply_schema(df)
+            df = df.reindex(columns=columns, fill_value='')
+            df.set_index('VAERS_ID', inplace=True)
+            for writer in writers:
+                writer.write(df)
+        end = os.path.getsize(total_file) if len(csv_writers) > 0 and csv_writers[0].started else start
+        segments.append([get_file_prefix(file), start, end])
+        start = end
+    return segments
+
+# What delta_merge needs to know about the total file of the last run, kept in the manifest. None unless it is a plain csv file
+def get_total_record(total_file, columns, segments):
+    if 'csv' not in output_formats or compression is not None or not os.path.exists(total_file):
+        return None
+    file_stat = get_file_stat(total_file)
+    return {'columns': columns, 'segments': segments, 'size': file_stat.st_size, 'mtime': file_stat.st_mtime}
+
+# With delta_merge, patch the csv total file instead of appending all the years again. The years before the first one with
+# changed rows are kept as they are, the file is cut where that year starts and the years from there on are appended again,
+# so new reports in the current year and NonDomestic files only rewrite the end of the file.
+# Appends all the files when the total file is not the one of the last run or the years gain columns
+def merge_into_total(in_files, out_dir, changed_years, total):
+    total_file = out_dir + 'TotalVAERSData.csv'
+    if output_formats != ['csv'] or compression is not None:
+        print('the delta merge needs a plain csv total file, appending all the files')
+        return append_files(in_files, out_dir)
+    columns_by_file = {file: get_table_columns(file) for file in in_files}
+    columns = get_union_columns(list(columns_by_file.values()))
+    if total is None or total['columns'] != columns or not os.path.exists(total_file) or \
+       [get_file_stat(total_file).st_size, get_file_stat(total_file).st_mtime] != [total['size'], total['mtime']]:
+        print('the total file is not the one of the last run or its columns changed, appending all the files')
+        return append_files(in_files, out_dir)
+
+    # the years in the same place as in the last run with no changed rows, up to the first changed one
+    kept = 0
+    while kept < min(len(in_files), len(total['segments'])) and get_file_prefix(in_files[kept]) == total['segments'][kept][0] and \
+          get_file_prefix(in_files[kept]) not in changed_years:
+        kept += 1
+    if kept == 0:
+        return append_files(in_files, out_dir)
+
+    cut = total['segments'][kept - 1][2]
+    print('keeping the first ' + str(cut) + ' bytes of ' + total_file + ', up to the end of ' + total['segments'][kept - 1][0])
+    with open(total_file, 'r+b') as f:
+        f.truncate(cut)
+    writer = TableWriter(total_file, append=True)
+    segments = total['segments'][:kept] + append_to_writers(in_files[kept:], columns_by_file, columns, [writer], total_file, cut)
+    writer.close()
+    return get_total_record(total_file, columns, segments)
+
+# A hash of each row of a yearly file by VAERS_ID, for delta_merge to find the rows that changed since the last run.
+# Blank cells are left out, so a row keeps its hash when its year gains an empty SYMPTOMn or VAX_*_n column
+def get_row_hashes(file):
+    df = read_table_file(file, dtype=str, na_filter=False)
+    hashes = np.zeros(len(df), dtype=np.uint64)
+    for col in df.columns:
+        if col != 'VAERS_ID':
+            values = df[col].to_numpy(dtype=object)
+            column_key = pd.util.hash_array(np.array([col], dtype=object))[0] | np.uint64(1)
+            hashes += np.where(values != '', pd.util.hash_array(values) * column_key, np.uint64(0))
+    row_hashes = pd.Series(hashes, index=pd.Index(df['VAERS_ID'], name='VAERS_ID')).groupby(level=0, sort=False).sum()
+    row_hashes.name = file
+    return row_hashes
+
+# The VAERS_IDs inserted, changed and deleted in a yearly file, compared with the row hashes of the previous one
+def get_row_changes(file, previous_hashes=None):
+    hashes = get_row_hashes(file)
+    if previous_hashes is None:
+        previous_hashes = pd.Series(dtype=np.uint64, index=pd.Index([], dtype=object))
+    common = hashes.index.intersection(previous_hashes.index, sort=False)
+    changes = [('inserted', hashes.index.difference(previous_hashes.index, sort=False)),
+               ('changed', common[hashes[common].to_numpy() != previous_hashes[common].to_numpy()]),
+               ('deleted', previous_hashes.index.difference(hashes.index, sort=False))]
+    print(get_file_prefix(file) + ': ' + ', '.join(str(len(ids)) + ' ' + change for change, ids in changes))
+    return pd.DataFrame({'YEAR': get_file_prefix(file),
+                         'VAERS_ID': np.concatenate([ids.to_numpy(dtype=object) for change, ids in changes]),
+                         'CHANGE': np.repeat([change for change, ids in changes], [len(ids) for change, ids in changes])})
+
+# Add the changes of a run to the changelog in out_dir, one row per VAERS_ID with the time of the run
+def write_changelog(out_dir, changes, started):
+    changelog_file = out_dir + changelog_name
+    changes = changes.assign(RUN=started.strftime('%Y-%m-%d %H:%M:%S'))[['RUN', 'YEAR', 'VAERS_ID', 'CHANGE']]
+    changes.to_csv(changelog_file, mode='a', header=not os.path.exists(changelog_file), index=False)
+    print(changelog_file)
+
+# Union of the columns of several files: the data columns in order of first appearance,
+# then the SYMPTOMn/SYMPTOMVERSIONn pairs and the VAX_*_n groups in numeric order
+def get_union_columns(column_lists):
+    columns = list(dict.fromkeys(chain.from_iterable(column_lists)))
+
+    def column_order(col):
+        symptom = re.fullmatch(r'SYMPTOM(VERSION)?(\d+)', col)
+        if symptom:
+            return (1, int(symptom.group(2)), columns.index(col))
+        vax = re.fullmatch(r'VAX_[A-Z_]+_(\d+)', col)
+        if vax:
+            return (2, int(vax.group(1)), columns.index(col))
+        return (0, 0, columns.index(col))
+
+    return sorted(columns, key=column_order)
+
+# Write a yearly file into its year=<prefix> folder of the dataset, split into a VAX_TYPE=<type> folder per VAX_TYPE_1
+# with vax_type_partitions. Returns the index entry of the year, which lists every VAX_TYPE_n value found in each partition
+def write_year_partitions(file, dataset_dir):
+    print('partitioning ' + file)
+    year = get_file_prefix(file)
+    year_dir = 'year=' + year + '/'
+    shutil.rmtree(dataset_dir + year_dir, ignore_errors=True)
+    extension = get_table_extension(output_formats[0], compression)
+
+    dataframe = read_table_file(file, dtype=str, na_filter=False).set_index('VAERS_ID')
+    if vax_type_partitions and 'VAX_TYPE_1' not in dataframe.columns:
+        print('VAX_TYPE_1 is not in ' + file + ', the year is not split by VAX_TYPE')
+    parts = [(None, year_dir, dataframe)]
+    if vax_type_partitions and 'VAX_TYPE_1' in dataframe.columns:
+        parts = []
+        for vax_type, df in dataframe.groupby('VAX_TYPE_1', sort=True):
+            part_dir = year_dir + 'VAX_TYPE=' + get_partition_name(vax_type) + '/'
+            if part_dir in [part[1] for part in parts]: # two types with the same folder name
+                part_dir = part_dir[:-1] + '_' + str(len(parts)) + '/'
+            parts.append((vax_type, part_dir, df))
+
+    partitions = []
+    for vax_type, part_dir, df in parts:
+        os.makedirs(dataset_dir + part_dir, exist_ok=True)
+        write_table_file(df, dataset_dir + part_dir + 'part' + extension)
+        partitions.append({'vax_type': vax_type, 'vax_types': get_vax_types(df), 'file': part_dir + 'part' + extension, 'rows': len(df)})
+    return {'year': year, 'rows': len(dataframe), 'columns': dataframe.columns.to_list(), 'partitions': partitions}
+
+# The VAX_TYPE_n columns of a yearly file
+def get_vax_type_columns(columns):
+    return [col for col in columns if re.fullmatch(r'VAX_TYPE_\d+', col)]
+
+# Every VAX type of the reports in a frame, in any of the VAX_TYPE_n columns
+def get_vax_types(dataframe):
+    values = dataframe[get_vax_type_columns(dataframe.columns)].to_numpy().ravel()
+    return sorted(set(values) - {''})
+
+# A VAX_TYPE as a folder name, characters that are not safe in a path are replaced with _
+def get_partition_name(value):
+    return re.sub(r'[^\w.()+-]', '_', value) if value != '' else '_'
+
+# The index entries of the years of an existing dataset that can be kept as they are, from those that were not rebuilt.
+# None are kept when the dataset was split differently or its partition files are missing
+def get_partitioned_years(dataset_dir, prefixes):
+    if not os.path.exists(dataset_dir + dataset_index_name):
+        return {}
+    with open(dataset_dir + dataset_index_name, 'r') as f:
+        index = json.load(f)
+    if index.get('vax_type_partitions') != vax_type_partitions:
+        return {}
+    return {year['year']: year for year in index['years'] if year['year'] in prefixes and
+            all('vax_types' in partition and os.path.exists(dataset_dir + partition['file']) for partition in year['partitions'])}
 
-        if(first_file):
-            total_dataframe = df
-            first_file = False
-        else:            
-            total_dataframe = pd.concat([total_dataframe, df], ignore_index=True) #replaced append
+# The _index.json of the dataset: the columns and partitions of each year in the order of the yearly files, and all their columns
+def write_dataset_index(dataset_dir, combined_files, years):
+    prefixes = [get_file_prefix(file) for file in combined_files]
+    years = sorted(years, key=lambda year: prefixes.index(year['year']))
+    index = {'created': datetime.now().isoformat(timespec='seconds'), 'vax_type_partitions': vax_type_partitions, 'columns': get_union_columns([year['columns'] for year in years]), 'years': years}
+    with open(dataset_dir + dataset_index_name, 'w') as f:
+        json.dump(index, f, indent=2)
 
-    total_dataframe.set_index("VAERS_ID", inplace=True) 
-    total_dataframe.to_csv(out_dir + 'TotalVAERSData.csv')
+# Open a dataset written with partitioned. Only the index is read when it is opened, read and read_partitions then
+# only read the files of the years and VAX types asked for, and only the columns asked for.
+#   dataset = VAERSDataset('TotalCleanData/VAERSDataset/')
+#   covid_2021 = dataset.read(years=['2021'], vax_types=['COVID19'], columns=['AGE_YRS', 'SEX', 'SYMPTOM1'])
+# vax_types keeps the reports with one of them in any VAX_TYPE_n column, like lookup_reports. Only the partitions that
+# have one of them are read, and with vax_type_partitions a report is in the folder of its VAX_TYPE_1 only
+class VAERSDataset:
+
+    def __init__(self, dataset_dir):
+        self.dataset_dir = add_trailing_slash(dataset_dir)
+        with open(self.dataset_dir + dataset_index_name, 'r') as f:
+            self.index = json.load(f)
+        self.columns = self.index['columns']
+        self.years = [year['year'] for year in self.index['years']]
+
+    # The columns of the year and index entry of each partition a query needs
+    def get_partitions(self, years=None, vax_types=None):
+        partitions = []
+        for year in self.index['years']:
+            if years is None or year['year'] in [str(y) for y in years]:
+                for partition in year['partitions']:
+                    if vax_types is None or 'vax_types' not in partition or len(set(partition['vax_types']) & set(vax_types)) > 0:
+                        partitions.append((year['columns'], partition))
+        return partitions
+
+    # Each partition a query needs as a DataFrame indexed by VAERS_ID with the columns asked for,
+    # blank where a partition does not have a column
+    def read_partitions(self, years=None, vax_types=None, columns=None):
+        wanted = self.columns if columns is None else list(columns)
+        for year_columns, partition in self.get_partitions(years, vax_types):
+            vax_type_columns = get_vax_type_columns(year_columns) if vax_types is not None else []
+            read_columns = ['VAERS_ID'] + [col for col in year_columns if col in wanted or col in vax_type_columns]
+            df = read_table_file(self.dataset_dir + partition['file'], columns=read_columns, dtype=str, na_filter=False)
+            if vax_types is not None:
+                df = df.loc[df[vax_type_columns].isin(vax_types).any(axis=1)]
+            yield df.set_index('VAERS_ID').reindex(columns=wanted, fill_value='')
+
+    # The rows of the years and VAX types asked for as one DataFrame, partition by partition
+    def read(self, years=None, vax_types=None, columns=None):
+        frames = list(self.read_partitions(years, vax_types, columns))
+        if len(frames) == 0:
+            return pd.DataFrame(columns=self.columns if columns is None else list(columns), index=pd.Index([], name='VAERS_ID'))
+        return pd.concat(frames)
+
+# Load the yearly files into a new output_dir/VAERSData.sqlite with three tables:
+#   reports          every column of the yearly files as text, plus RECVDATE_ISO (yyyy-mm-dd) to compare dates
+#   report_vaccines  a row per vaccine of a report, VAERS_ID, VAX_NUMBER and the VAX_* columns without their number
+#   report_symptoms  a row per symptom of a report, VAERS_ID, SYMPTOM_NUMBER, SYMPTOM and SYMPTOMVERSION
+# The indexes are made after the rows are loaded, and the database replaces the old one only when it is complete
+def build_sqlite_index(in_files, out_dir):
+    columns = get_union_columns([get_table_columns(file) for file in in_files])
+    vax_columns = list(dict.fromkeys(get_base_column_name(col) for col in columns if re.fullmatch(r'VAX_[A-Z_]+_\d+', col)))
+    db_file = out_dir + sqlite_name
+    temp_file = db_file + '.tmp'
+    if os.path.exists(temp_file):
+        os.remove(temp_file)
+
+    connection = sqlite3.connect(temp_file)
+    try:
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        create_sqlite_table(connection, 'reports', columns + ['RECVDATE_ISO'])
+        create_sqlite_table(connection, 'report_vaccines', ['VAERS_ID', 'VAX_NUMBER'] + vax_columns)
+        create_sqlite_table(connection, 'report_symptoms', ['VAERS_ID', 'SYMPTOM_NUMBER', 'SYMPTOM', 'SYMPTOMVERSION'])
+
+        for file in in_files:
+            print('indexing ' + file)
+            if chunk_size is None:
+                chunks = [read_table_file(file, dtype=str, na_filter=False)]
+            else:
+                chunks = read_table_chunks(file, chunk_size, dtype=str, na_filter=False)
+            for df in chunks:
+                insert_sqlite_reports(connection, df.reindex(columns=columns, fill_value=''), vax_columns)
+            connection.commit()
+
+        for table, column in [('reports', 'VAERS_ID'), ('reports', 'RECVDATE_ISO'), ('report_vaccines', 'VAERS_ID'), ('report_vaccines', 'VAX_TYPE'),
+                              ('report_symptoms', 'VAERS_ID'), ('report_symptoms', 'SYMPTOM')]:
+            if column in get_sqlite_columns(connection, table):
+                connection.execute('CREATE INDEX "' + table + '_' + column + '" ON "' + table + '" ("' + column + '")')
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(temp_file, db_file)
+    add_to_stage_report(bytes_out=os.path.getsize(db_file))
+    print(db_file)
+
+# With delta_merge, delete the changed and deleted reports from the SQLite database and insert the rows of the inserted
+# and changed ones from the yearly files, instead of loading all the years again
+def merge_into_sqlite(in_files, out_dir, changes):
+    db_file = out_dir + sqlite_name
+    connection = sqlite3.connect(db_file)
+    try:
+        changed_ids = bind_sqlite_values(connection, 'changed_ids', changes['VAERS_ID'])
+        for table in ['reports', 'report_vaccines', 'report_symptoms']:
+            connection.execute('DELETE FROM "' + table + '" WHERE VAERS_ID IN (SELECT value FROM ' + changed_ids + ')')
+
+        new_rows = changes.loc[changes['CHANGE'] != 'deleted']
+        for file in in_files:
+            ids = new_rows.loc[new_rows['YEAR'] == get_file_prefix(file), 'VAERS_ID']
+            if len(ids) == 0:
+                continue
+            print('indexing ' + str(len(ids)) + ' reports of ' + file)
+            df = read_table_file(file, dtype=str, na_filter=False)
+            df = df.loc[df['VAERS_ID'].isin(ids)]
+            vax_columns = list(dict.fromkeys(get_base_column_name(col) for col in df.columns if re.fullmatch(r'VAX_[A-Z_]+_\d+', col)))
+            columns = add_sqlite_columns(connection, 'reports', list(df.columns) + ['RECVDATE_ISO'])
+            vax_columns = add_sqlite_columns(connection, 'report_vaccines', ['VAERS_ID', 'VAX_NUMBER'] + vax_columns)[2:]
+            insert_sqlite_reports(connection, df.reindex(columns=[col for col in columns if col != 'RECVDATE_ISO'], fill_value=''), vax_columns)
+        connection.commit()
+    finally:
+        connection.close()
+    add_to_stage_report(bytes_out=os.path.getsize(db_file))
+    print(db_file)
+
+# Insert the rows of a yearly file into the reports table and their vaccines and symptoms into the long tables
+def insert_sqlite_reports(connection, dataframe, vax_columns):
+    insert_sqlite_rows(connection, 'reports', dataframe.assign(RECVDATE_ISO=get_iso_dates(dataframe.get('RECVDATE'))))
+    insert_sqlite_rows(connection, 'report_vaccines', unpivot_columns(dataframe, vax_columns, '_', 'VAX_NUMBER'))
+    insert_sqlite_rows(connection, 'report_symptoms', unpivot_columns(dataframe, ['SYMPTOM', 'SYMPTOMVERSION'], '', 'SYMPTOM_NUMBER'))
+    add_to_stage_report(rows_written=len(dataframe))
+
+# Add the columns a table does not have yet, returns all its columns
+def add_sqlite_columns(connection, table, columns):
+    table_columns = get_sqlite_columns(connection, table)
+    for col in columns:
+        if col not in table_columns:
+            connection.execute('ALTER TABLE "' + table + '" ADD COLUMN "' + col + '" TEXT')
+            table_columns.append(col)
+    return table_columns
+
+# Dates as yyyy-mm-dd text that sorts in date order, None for a missing or unreadable date
+def get_iso_dates(values):
+    if values is None:
+        return None
+    dates = pd.to_datetime(values, format=date_format, errors='coerce')
+    return dates.dt.strftime('%Y-%m-%d').astype(object).where(dates.notna(), None)
+
+def create_sqlite_table(connection, table, columns):
+    connection.execute('CREATE TABLE "' + table + '" (' + ', '.join('"' + col + '" TEXT' for col in columns) + ')')
+
+def insert_sqlite_rows(connection, table, dataframe):
+    columns = ', '.join('"' + col + '"' for col in dataframe.columns)
+    placeholders = ', '.join('?' * len(dataframe.columns))
+    connection.executemany('INSERT INTO "' + table + '" (' + columns + ') VALUES (' + placeholders + ')', dataframe.itertuples(index=False, name=None))
+
+def get_sqlite_columns(connection, table):
+    return [row[1] for row in connection.execute('PRAGMA table_info("' + table + '")')]
+
+# The numbered columns of a joined year, eg. VAX_TYPE_2 and VAX_MANU_2 or SYMPTOM2 and SYMPTOMVERSION2, as a row per VAERS_ID
+# and number with the columns named without their number. Numbers where all the columns are blank are left out
+def unpivot_columns(dataframe, base_names, separator, number_name):
+    numbers = set()
+    for col in dataframe.columns:
+        for base in base_names:
+            match = re.fullmatch(re.escape(base + separator) + r'(\d+)', col)
+            if match is not None:
+                numbers.add(int(match.group(1)))
+
+    parts = []
+    for number in sorted(numbers):
+        part = pd.DataFrame({'VAERS_ID': dataframe['VAERS_ID'].to_numpy(), number_name: number, 'ROW': np.arange(len(dataframe))})
+        for base in base_names:
+            name = base + separator + str(number)
+            part[base] = dataframe[name].to_numpy() if name in dataframe.columns else ''
+        parts.append(part.loc[(part[base_names] != '').any(axis=1)])
+    if len(parts) == 0:
+        return pd.DataFrame(columns=['VAERS_ID', number_name] + base_names)
+
+    # in row order, then number order
+    long_df = pd.concat(parts, ignore_index=True).sort_values(['ROW', number_name], kind='stable')
+    return long_df[['VAERS_ID', number_name] + base_names].reset_index(drop=True)
+
+# Look up the reports of an SQLite database written with sqlite_index, as a DataFrame indexed by VAERS_ID with the columns
+# of the yearly files, or only those in columns. Each argument given narrows the reports down, and they all use an index:
+#   lookup_reports('TotalCleanData/VAERSData.sqlite', ids=[902418, 902440])
+#   lookup_reports(db_file, vax_types=['COVID19'], symptoms=['Headache'], received_from='01/01/2021', received_to='01/31/2021')
+def lookup_reports(db_file, ids=None, vax_types=None, symptoms=None, received_from=None, received_to=None, columns=None):
+    connection = sqlite3.connect(db_file)
+    try:
+        conditions = []
+        params = []
+        if ids is not None:
+            conditions.append('VAERS_ID IN (SELECT value FROM ' + bind_sqlite_values(connection, 'query_ids', ids) + ')')
+        if vax_types is not None:
+            conditions.append('VAERS_ID IN (SELECT VAERS_ID FROM report_vaccines WHERE VAX_TYPE IN (SELECT value FROM ' + bind_sqlite_values(connection, 'query_vax_types', vax_types) + '))')
+        if symptoms is not None:
+            conditions.append('VAERS_ID IN (SELECT VAERS_ID FROM report_symptoms WHERE SYMPTOM IN (SELECT value FROM ' + bind_sqlite_values(connection, 'query_symptoms', symptoms) + '))')
+        if received_from is not None:
+            conditions.append('RECVDATE_ISO >= ?')
+            params.append(datetime.strptime(received_from, date_format).strftime('%Y-%m-%d'))
+        if received_to is not None:
+            conditions.append('RECVDATE_ISO <= ?')
+            params.append(datetime.strptime(received_to, date_format).strftime('%Y-%m-%d'))
+
+        if columns is None:
+            columns = [col for col in get_sqlite_columns(connection, 'reports') if col not in ['VAERS_ID', 'RECVDATE_ISO']]
+        query = 'SELECT ' + ', '.join('"' + col + '"' for col in ['VAERS_ID'] + list(columns)) + ' FROM reports'
+        if len(conditions) > 0:
+            query = query + ' WHERE ' + ' AND '.join(conditions)
+        return pd.read_sql_query(query + ' ORDER BY rowid', connection, params=params, index_col='VAERS_ID')
+    finally:
+        connection.close()
+
+# Put the values of a query in a temporary table, a set of thousands of IDs does not fit in the placeholders of one statement
+def bind_sqlite_values(connection, table, values):
+    connection.execute('CREATE TEMP TABLE "' + table + '" (value TEXT PRIMARY KEY)')
+    connection.executemany('INSERT OR IGNORE INTO "' + table + '" VALUES (?)', [(str(value),) for value in values])
+    return '"' + table + '"'
 
 #Combine multiple vaccination names from the same VAERS_ID to create a single record
 def combine_vax_records(file):
     print('processing ' + file)
-    headers = ['VAERS_ID', 'VAX_TYPE_1', 'VAX_MANU_1', 'VAX_LOT_1', 'VAX_DOSE_SERIES_1','VAX_ROUTE_1', 'VAX_SITE_1', 'VAX_NAME_1',
-               'VAX_TYPE_2', 'VAX_MANU_2', 'VAX_LOT_2', 'VAX_DOSE_SERIES_2','VAX_ROUTE_2', 'VAX_SITE_2', 'VAX_NAME_2',
-               'VAX_TYPE_3', 'VAX_MANU_3', 'VAX_LOT_3', 'VAX_DOSE_SERIES_3','VAX_ROUTE_3', 'VAX_SITE_3', 'VAX_NAME_3',
-               'VAX_TYPE_4', 'VAX_MANU_4', 'VAX_LOT_4', 'VAX_DOSE_SERIES_4','VAX_ROUTE_4', 'VAX_SITE_4', 'VAX_NAME_4',
-               'VAX_TYPE_5', 'VAX_MANU_5', 'VAX_LOT_5', 'VAX_DOSE_SERIES_5','VAX_ROUTE_5', 'VAX_SITE_5', 'VAX_NAME_5',
-               'VAX_TYPE_6', 'VAX_MANU_6', 'VAX_LOT_6', 'VAX_DOSE_SERIES_6','VAX_ROUTE_6', 'VAX_SITE_6', 'VAX_NAME_6']
-
-    df_out = pd.DataFrame(columns=headers)
-    file_encoding = get_file_encoding(file)
-    df = pd.read_csv(file, engine='python', on_bad_lines='skip', encoding=file_encoding, dtype=str, na_filter=False) #drop records with errors  
-          
-    # get a unique list of the IDs
-    id_list = list(df['VAERS_ID'])
-    id_list = list(dict.fromkeys(id_list))
-
-    in_rows = pd.DataFrame()    
-    # for each record, write the row if it's the only one found for that ID. Otherwise combine the rows
-    for record in id_list:
-        out_rows = pd.DataFrame(columns=headers)
-        in_rows = df.loc[df['VAERS_ID'] == record] 
-        in_rows.set_index("VAERS_ID", inplace=True) 
-        count = 1
-        for index, row in in_rows.iterrows(): 
-            if count == 1:
-                out_rows.at[record,'VAERS_ID'] = record
-                out_rows.at[record,'VAX_TYPE_1'] = in_rows.iat[0,0]
-                out_rows.at[record,'VAX_MANU_1'] = in_rows.iat[0,1]
-                out_rows.at[record,'VAX_LOT_1'] = in_rows.iat[0,2]
-                out_rows.at[record,'VAX_DOSE_SERIES_1'] = in_rows.iat[0,3]
-                out_rows.at[record,'VAX_ROUTE_1'] = in_rows.iat[0,4]
-                out_rows.at[record,'VAX_SITE_1'] = in_rows.iat[0,5]
-                out_rows.at[record,'VAX_NAME_1'] = in_rows.iat[0,6]
-                df_out = pd.concat([df_out,out_rows], ignore_index=True) #append
-            else:
-                if count > 6:
-                    print('error - more than 6 vaccines for this id ' + str(record))
-                else:
-                    # map the current record to the combined record
-                    str_count = str(count)
-                    vax_type = 'VAX_TYPE_' + str_count
-                    vax_manu = 'VAX_MANU_' + str_count
-                    vax_lot = 'VAX_LOT_' + str_count
-                    vax_series = 'VAX_DOSE_SERIES_' + str_count
-                    vax_route = 'VAX_ROUTE_' + str_count
-                    vax_site = 'VAX_SITE_' + str_count 
-                    vax_name = 'VAX_NAME_' + str_count
-
-                    count_index = count - 1
-                    location = 0
-
-                    # combine the data for record to be writen to the new file
-                    df_out.at[record,vax_type] = in_rows.iat[count_index,location]
-                    df_out.at[record,vax_manu] = in_rows.iat[count_index,location+1]
-                    df_out.at[record,vax_lot] = in_rows.iat[count_index,location+2]
-                    df_out.at[record,vax_series] = in_rows.iat[count_index,location+3]
-                    df_out.at[record,vax_route] = in_rows.iat[count_index,location+4]
-                    df_out.at[record,vax_site] = in_rows.iat[count_index,location+5]
-                    df_out.at[record,vax_name] = in_rows.iat[count_index,location+6]
-            
-            count += 1                
-            
-    #change to new dataframe   
-    df_out.set_index("VAERS_ID", inplace=True) 
-    df_out.to_csv(file)
-
-# Need to combine symptoms from multiple entries to a single entry. Supports 25 symptoms
+    df = read_table_file(file, dtype=str, na_filter=False) #drop records with errors  
+
+    df_out = pivot_vax_records(df)
+    write_table_file(df_out, file)
+
+# Pivot the VAX rows of each VAERS_ID into the VAX_*_1..6 columns of a single row
+def pivot_vax_records(df, max_records=None):
+    if max_records is None:
+        max_records = max_vax_records
+    value_columns = [col for col in df.columns if col != 'VAERS_ID']
+    headers = [col + '_' + str(count) for count in range(1, max_records + 1) for col in value_columns]
+    if len(value_columns) == 0: # none of the VAX columns are selected
+        return pd.DataFrame(index=pd.Index(df['VAERS_ID'].unique(), name='VAERS_ID'))
+
+    # number the rows of each ID in the order they appear in the file
+    df = df.assign(VAX_COUNT=df.groupby('VAERS_ID', sort=False).cumcount() + 1)
+    too_many = df['VAX_COUNT'] > max_records
+    for record in df.loc[too_many, 'VAERS_ID'].unique():
+        print('error - more than ' + str(max_records) + ' vaccines for this id ' + str(record))
+    df = df.loc[~too_many]
+
+    # one row per ID in order of first appearance, one column group per vaccine
+    df_out = df.set_index(['VAERS_ID', 'VAX_COUNT'])[value_columns].unstack('VAX_COUNT')
+    df_out.columns = [col + '_' + str(count) for col, count in df_out.columns]
+    df_out = df_out.reindex(index=df['VAERS_ID'].unique(), columns=headers, fill_value='')
+    df_out = df_out.fillna('')
+    df_out.index.name = 'VAERS_ID'
+    return df_out
+
+# Need to combine symptoms from multiple entries to a single entry. Adds as many SYMPTOMn columns as the data needs
 def combine_symptoms(file):
-    additional_headers = ['SYMPTOM6', 'SYMPTOMVERSION6',
-                        'SYMPTOM7', 'SYMPTOMVERSION7',
-                        'SYMPTOM8', 'SYMPTOMVERSION8',
-                        'SYMPTOM9', 'SYMPTOMVERSION9',
-                        'SYMPTOM10', 'SYMPTOMVERSION10',
-                        'SYMPTOM11', 'SYMPTOMVERSION11',
-                        'SYMPTOM12', 'SYMPTOMVERSION12',
-                        'SYMPTOM13', 'SYMPTOMVERSION13',
-                        'SYMPTOM14', 'SYMPTOMVERSION14',
-                        'SYMPTOM15', 'SYMPTOMVERSION15',
-                        'SYMPTOM16', 'SYMPTOMVERSION16',
-                        'SYMPTOM17', 'SYMPTOMVERSION17',
-                        'SYMPTOM18', 'SYMPTOMVERSION19',
-                        'SYMPTOM20', 'SYMPTOMVERSION20',
-                        'SYMPTOM21', 'SYMPTOMVERSION21',
-                        'SYMPTOM22', 'SYMPTOMVERSION22',
-                        'SYMPTOM23', 'SYMPTOMVERSION23',
-                        'SYMPTOM24', 'SYMPTOMVERSION24',
-                        'SYMPTOM25', 'SYMPTOMVERSION25',
-                        'SYMPTOM26', 'SYMPTOMVERSION26',
-                        'SYMPTOM27', 'SYMPTOMVERSION27',
-                        'SYMPTOM28', 'SYMPTOMVERSION28',
-                        'SYMPTOM29', 'SYMPTOMVERSION29',
-                        'SYMPTOM30', 'SYMPTOMVERSION30',
-                        'SYMPTOM31', 'SYMPTOMVERSION31',
-                        'SYMPTOM32', 'SYMPTOMVERSION32',
-                        'SYMPTOM33', 'SYMPTOMVERSION33',
-                        'SYMPTOM34', 'SYMPTOMVERSION34',
-                        'SYMPTOM35', 'SYMPTOMVERSION35']
-    
     print('processing ' + file)
-    file_encoding = get_file_encoding(file)
-    df = pd.read_csv(file, engine='python', on_bad_lines='skip', encoding=file_encoding, dtype=str) #drop records with errors
-
-    # get a unique list of the IDs
-    id_list = list(df['VAERS_ID'])
-    id_list = list(dict.fromkeys(id_list)) 
-
-    # add the new headers to support 25 symptoms per record
-    new_columns = df.columns.values  
-    new_columns = np.append(new_columns,additional_headers) 
-    df_out = pd.DataFrame(columns=new_columns)
-    out_rows = pd.DataFrame(columns=new_columns)
-    in_rows = pd.DataFrame()
-
-    # for each record, write the row if it's the only one found for that ID. Otherwise combine the rows 
-    for record in id_list:
-        in_rows = pd.DataFrame(df.loc[df['VAERS_ID'] == record])         
-        in_rows.set_index("VAERS_ID", inplace=True) 
-        count = 0  
-        out_rows = pd.DataFrame(columns=new_columns) 
-        out_rows.set_index("VAERS_ID", inplace=True)  
-        for index, row in in_rows.iterrows(): 
-            if count == 0:
-                out_rows.at[record,'VAERS_ID'] = record
-                out_rows.at[record,'SYMPTOM1'] = in_rows.iat[0,0]
-                out_rows.at[record,'SYMPTOMVERSION1'] = in_rows.iat[0,1]
-                out_rows.at[record,'SYMPTOM2'] = in_rows.iat[0,2]
-                out_rows.at[record,'SYMPTOMVERSION2'] = in_rows.iat[0,3]
-                out_rows.at[record,'SYMPTOM3'] = in_rows.iat[0,4]
-                out_rows.at[record,'SYMPTOMVERSION3'] = in_rows.iat[0,5]
-                out_rows.at[record,'SYMPTOM4'] = in_rows.iat[0,6]                
-                out_rows.at[record,'SYMPTOMVERSION4'] = in_rows.iat[0,7]
-                out_rows.at[record,'SYMPTOM5'] = in_rows.iat[0,8]                
-                out_rows.at[record,'SYMPTOMVERSION5'] = in_rows.iat[0,9]
-            else:
-                if count == 1:
-                    header_range = range(6,10)
-                    start_index = 6
-                elif count == 2:
-                    header_range = range(11,15)
-                    start_index = 11
-                elif count == 3:
-                    header_range = range(16,20)
-                    start_index = 16
-                elif count == 4:
-                    header_range = range(21,25)
-                    start_index = 21
-                elif count == 5:
-                    header_range = range(26,30)
-                    start_index = 26
-                elif count == 6:
-                    header_range = range(31,35)
-                    start_index = 31
-                else:
-                    print('error - more than 35 symptoms for this id ' + str(record))
-
-                # map the five symptoms from the current record to the combined record
-                for i in header_range:
-                    symptom_header = 'SYMPTOM' + str(i)
-                    version_header = 'SYMPTOMVERSION' + str(i)
-
-                    # get the indices to map it to
-                    if i == start_index:
-                        symptom_location = 0
-                        version_location = 1
-
-                    # combine the data for record to be writen to the new file
-                    new_symptom = in_rows.iat[count,symptom_location]
-                    new_version = in_rows.iat[count,version_location]                 
-                    out_rows.at[record,symptom_header] = new_symptom
-                    out_rows.at[record,version_header] = new_version
-                    
-                    symptom_location += 2
-                    version_location += 2
-
-            count += 1 
-
-        df_out = pd.concat([df_out, out_rows], ignore_index=True) #append
-
-    #change to new dataframe   
-    df_out.set_index("VAERS_ID", inplace=True)
-    df_out.to_csv(file)
+    df = read_table_file(file, dtype=str, na_filter=False) #drop records with errors
+
+    df_out = pivot_symptoms(df)
+    write_table_file(df_out, file)
+
+# Flatten the five SYMPTOM/SYMPTOMVERSION pairs of every row to one row per symptom, in file order
+def flatten_symptoms(df):
+    slots = []
+    for i in range(1, 6):
+        slot = pd.DataFrame({'VAERS_ID': df['VAERS_ID'].to_numpy(),
+                             'SYMPTOM': df['SYMPTOM' + str(i)].to_numpy(),
+                             'SYMPTOMVERSION': df['SYMPTOMVERSION' + str(i)].to_numpy(),
+                             'ROW': np.arange(len(df)),
+                             'SLOT': i})
+        slots.append(slot)
+    long_df = pd.concat(slots, ignore_index=True)
+
+    # drop the empty slots and keep the symptoms in row order, then slot order
+    long_df = long_df.loc[long_df['SYMPTOM'].fillna('') != '']
+    long_df = long_df.sort_values(['ROW', 'SLOT'], kind='stable')
+    return long_df[['VAERS_ID', 'SYMPTOM', 'SYMPTOMVERSION']].reset_index(drop=True)
+
+# Pivot the symptoms of each VAERS_ID into SYMPTOM1..n/SYMPTOMVERSION1..n columns of a single row
+def pivot_symptoms(df):
+    if 'SYMPTOM1' not in df.columns: # the symptoms are not selected
+        return pd.DataFrame(index=pd.Index(df['VAERS_ID'].unique(), name='VAERS_ID'))
+    long_df = flatten_symptoms(df)
+    long_df['SYMPTOM_COUNT'] = long_df.groupby('VAERS_ID', sort=False).cumcount() + 1
+    symptom_count = max(5, int(long_df['SYMPTOM_COUNT'].max()) if len(long_df) > 0 else 0)
+    headers = []
+    for i in range(1, symptom_count + 1):
+        headers = headers + ['SYMPTOM' + str(i), 'SYMPTOMVERSION' + str(i)]
+
+    # one row per ID in order of first appearance, IDs without symptoms keep an empty row
+    df_out = long_df.set_index(['VAERS_ID', 'SYMPTOM_COUNT'])[['SYMPTOM', 'SYMPTOMVERSION']].unstack('SYMPTOM_COUNT')
+    df_out.columns = [col + str(count) for col, count in df_out.columns]
+    df_out = df_out.reindex(index=df['VAERS_ID'].unique(), columns=headers, fill_value='')
+    df_out = df_out.fillna('')
+    df_out.index.name = 'VAERS_ID'
+    return df_out
+
+# Split the clean files of a year into shard_count hash partitions of VAERS_ID, so all the rows of an ID land in the
+# same shard and each shard can be combined on its own. Shard n is written to <clean dir>/shards/n/ under the same file names
+def split_year(file_group, shard_count):
+    for file in file_group:
+        print('sharding ' + file)
+        shard_files = [get_shard_file(file, shard) for shard in range(shard_count)]
+        for shard_file in shard_files:
+            os.makedirs(shard_file.rpartition('/')[0], exist_ok=True)
+        writers = [TableWriter(shard_file) for shard_file in shard_files]
+
+        if chunk_size is None:
+            chunks = [read_table_file(file, dtype=str, na_filter=False)]
+        else:
+            chunks = read_table_chunks(file, chunk_size, dtype=str, na_filter=False)
+
+        empty = None
+        for df in chunks:
+            shards = get_shards(df['VAERS_ID'], shard_count)
+            df = df.set_index('VAERS_ID')
+            empty = df.iloc[:0]
+            for shard, writer in enumerate(writers):
+                if (shards == shard).any():
+                    writer.write(df[shards == shard])
+
+        # a shard without rows still gets a file with the header
+        for writer in writers:
+            if not writer.started and empty is not None:
+                writer.write(empty)
+            writer.close()
+
+# The shard of each VAERS_ID, from a hash of its text that is the same in every process and run
+def get_shards(ids, shard_count):
+    return pd.util.hash_array(ids.to_numpy(dtype=object)) % shard_count
+
+def get_shard_file(file, shard):
+    dir_name, _, file_name = file.rpartition('/')
+    return dir_name + '/shards/' + str(shard) + '/' + file_name
+
+# The [DATA, SYMPTOMS, VAX] clean files of each shard of a year
+def get_shard_file_groups(file_group, shard_count):
+    return [[get_shard_file(file, shard) for file in file_group] for shard in range(shard_count)]
+
+# The joined shard of the yearly file, next to the clean files of the shard
+def get_shard_output_file(shard_group):
+    return shard_group[0].rpartition('/')[0] + '/' + get_file_prefix(shard_group[0]) + 'VAERS' + get_clean_extension()
+
+# Combine the vax records and symptoms of a shard and join its three files
+def combine_shard(shard_group):
+    combine_vax_records(shard_group[2])
+    combine_symptoms(shard_group[1])
+    write_table_file(join_clean_files(shard_group), get_shard_output_file(shard_group))
+
+# Concatenate the joined shards of a year into the yearly file, with the rows back in the order of the clean DATA file
+# like combine_files writes them, and with as many SYMPTOMn columns as the shard that has the most. The shard files are removed
+def concat_shards(file_group, shard_count, out_dir):
+    shard_groups = get_shard_file_groups(file_group, shard_count)
+    frames = []
+    for shard_group in shard_groups:
+        print('concatenating ' + get_shard_output_file(shard_group))
+        frames.append(read_table_file(get_shard_output_file(shard_group), dtype=str, na_filter=False))
+    columns = get_union_columns([df.columns.to_list() for df in frames])
+    dataframe = pd.concat([df.reindex(columns=columns, fill_value='') for df in frames], ignore_index=True)
+
+    # an ID repeated in the DATA file keeps the place of its first row
+    data_ids = read_table_file(file_group[0], columns=['VAERS_ID'], dtype=str, na_filter=False)['VAERS_ID'].drop_duplicates()
+    order = np.argsort(pd.Index(data_ids).get_indexer(dataframe['VAERS_ID']), kind='stable')
+    dataframe = dataframe.take(order).set_index('VAERS_ID')
+    for output_format in output_formats:
+        write_table_file(dataframe, out_dir + get_file_prefix(file_group[0]) + 'VAERS' + get_table_extension(output_format, compression))
+
+    for shard_group in shard_groups:
+        for file in shard_group + [get_shard_output_file(shard_group)]:
+            for name in [file, get_encoding_sidecar_name(file)]:
+                if os.path.exists(name):
+                    os.remove(name)
+
+# Run scrub -> vax combine -> symptom combine -> join for a year in memory, passing DataFrames between the stages
+# instead of re-reading the clean files. Takes its settings as arguments rather than from the module variables,
+# and only writes the clean files and the yearly file when given a directory for them.
+#   pipeline = VAERSPipeline(engine='c')
+#   dataframe = pipeline.run_year(['Data/2021VAERSDATA.csv', 'Data/2021VAERSSYMPTOMS.csv', 'Data/2021VAERSVAX.csv'], out_dir='Total/')
+class VAERSPipeline:
+
+    def __init__(self, engine='python', replacements=None, max_vax_records=6, intermediate_format='csv', output_formats=('csv',), compression=None, columns=None, filters=()):
+        self.engine = engine
+        self.replacements = scrub_replacements if replacements is None else replacements
+        self.max_vax_records = max_vax_records
+        self.intermediate_format = intermediate_format
+        self.output_formats = list(output_formats)
+        self.compression = compression
+        self.columns = columns
+        self.filters = list(filters)
+
+    # An original file read, filtered and scrubbed, indexed by VAERS_ID like the clean file scrub_file writes
+    def scrub(self, in_file, ids=None):
+        print('scrub: ' + in_file)
+        dataframe = read_csv_file(in_file, engine=self.engine, **get_scrub_read_options(in_file, self.columns, self.filters)) #drop records with errors
+        dataframe = filter_rows(dataframe, self.filters, ids)
+        dataframe.set_index('VAERS_ID', inplace=True)
+        return scrub_dataframe(dataframe, self.replacements)
+
+    def combine_vax_records(self, dataframe):
+        return pivot_vax_records(dataframe.reset_index(), self.max_vax_records)
+
+    def combine_symptoms(self, dataframe):
+        return pivot_symptoms(dataframe.reset_index())
+
+    # The joined year indexed by VAERS_ID. With a clean_dir, also writes the clean files the disk stages would leave there,
+    # and with an out_dir the yearly <prefix>VAERS file in each of the output formats
+    def run_year(self, file_group, clean_dir=None, out_dir=None):
+        data_file, symptoms_file, vax_file = file_group
+        data, vax = self.scrub(data_file), self.scrub(vax_file)
+        ids = np.intersect1d(data.index.to_numpy(dtype=object), vax.index.to_numpy(dtype=object)) if len(self.filters) > 0 else None
+        frames = [data, self.combine_symptoms(self.scrub(symptoms_file, ids)), self.combine_vax_records(vax)]
+        if clean_dir is not None:
+            for file, frame in zip(file_group, frames):
+                write_table_file(frame, clean_dir + file.rpartition('/')[2].rpartition('.')[0] + get_table_extension(self.intermediate_format, self.compression))
+
+        print('combining: ' + data_file)
+        frames = [frame.reset_index() for frame in frames]
+        dataframe, dropped = join_frames(frames)
+        print_dropped_rows(file_group, frames, dropped)
+        if self.columns is not None:
+            dataframe = select_columns(dataframe, self.columns)
+        if out_dir is not None:
+            for output_format in self.output_formats:
+                write_table_file(dataframe, out_dir + get_file_prefix(data_file) + 'VAERS' + get_table_extension(output_format, self.compression))
+        return dataframe
+
 #
 def is_file_list_length_matching(files_to_append_length, file_base_name_length, file_description):
     if files_to_append_length != file_base_name_length:
@@ -351,7 +1104,7 @@ def is_file_list_length_matching(files_to_append_length, file_base_name_length,
 
 # Take a file path and list, add the file to the list if it exists, return the list
 def add_file_if_exists(the_path, file_list):
-    if os.path.exists(the_path):
+    if input_file_exists(the_path):
         file_list.append(the_path)
     else:
         print("File not found while creating list " + the_path)
@@ -404,32 +1157,812 @@ def correct_for_common_errors():
         print('Data is only available starting with the year 1990 up to the current year. Please verify your stop_year variable. The value provided is invalid: ' + str(stop_year))
         sys.exit(__error_stop_year_validation__)
 
+    # The long layout replaces the pivot and join stages that these work on
+    if output_layout == 'long' and (shards > 1 or in_memory or partitioned or sqlite_index or delta_merge):
+        print('The long layout writes the report, vaccine and symptom tables straight from the clean files, it cannot be used with --shards, --in-memory, --partitioned, --sqlite or --delta.')
+        sys.exit(__error_layout_options__)
+
+# Read a CSV file with the selected engine. Malformed rows are dropped like on_bad_lines='skip',
+# and the lines that were dropped are kept in bad_lines_by_file and reported
+def read_csv_file(file, engine=None, **kwargs):
+    if engine is None:
+        engine = csv_engine
+    file_encoding = get_file_encoding(file)
+    if engine == 'pyarrow':
+        kwargs = get_pyarrow_read_options(file, file_encoding, kwargs)
+
+    with warnings.catch_warnings(record=True) as caught_warnings, open_csv_source(file) as source:
+        warnings.simplefilter('always', pd.errors.ParserWarning)
+        dataframe = pd.read_csv(source, engine=engine, on_bad_lines='warn', encoding=file_encoding, **kwargs)
+
+    record_bad_lines(file, get_bad_lines_from_warnings(caught_warnings))
+    add_to_stage_report(rows_read=len(dataframe), bytes_in=get_file_stat(file).st_size)
+    return dataframe
+
+# Read a CSV file in batches of chunk_size rows, dropping and recording malformed rows like read_csv_file.
+# Always uses the python engine, the c engine truncates over-long rows after the first chunk instead of dropping them
+# and pyarrow does not read in chunks
+def read_csv_chunks(file, chunk_size, **kwargs):
+    file_encoding = get_file_encoding(file)
+    bad_lines = []
+    with open_csv_source(file) as source, pd.read_csv(source, engine='python', on_bad_lines='warn', encoding=file_encoding, chunksize=chunk_size, **kwargs) as reader:
+        while True:
+            with warnings.catch_warnings(record=True) as caught_warnings:
+                warnings.simplefilter('always', pd.errors.ParserWarning)
+                chunk = next(reader, None)
+            bad_lines = bad_lines + get_bad_lines_from_warnings(caught_warnings)
+            if chunk is None:
+                break
+            add_to_stage_report(rows_read=len(chunk))
+            yield chunk
+    record_bad_lines(file, bad_lines)
+    add_to_stage_report(bytes_in=get_file_stat(file).st_size)
+
+# pyarrow only takes column names for usecols and needs keep_default_na=False to leave empty cells as ''
+def get_pyarrow_read_options(file, file_encoding, kwargs):
+    kwargs = dict(kwargs)
+    if kwargs.get('na_filter') is False:
+        kwargs['keep_default_na'] = False
+    usecols = kwargs.get('usecols')
+    if usecols is not None and any(isinstance(col, int) for col in usecols):
+        with open_csv_source(file) as source:
+            header = pd.read_csv(source, nrows=0, encoding=file_encoding).columns
+        kwargs['usecols'] = [header[col] if isinstance(col, int) else col for col in usecols if not isinstance(col, int) or col < len(header)]
+    return kwargs
+
+# Collect the bad lines from the caught parser warnings and pass any other warning on
+def get_bad_lines_from_warnings(caught_warnings):
+    bad_lines = []
+    for caught in caught_warnings:
+        if issubclass(caught.category, pd.errors.ParserWarning):
+            bad_lines = bad_lines + get_bad_lines_from_warning(str(caught.message))
+        else:
+            warnings.warn_explicit(caught.message, caught.category, caught.filename, caught.lineno)
+    return bad_lines
+
+# The python and c engines report 'Skipping line N: ...', pyarrow reports 'Expected N columns, but found M: <row>'
+def get_bad_lines_from_warning(message):
+    bad_lines = []
+    for line in message.splitlines():
+        line = line.strip()
+        if line.startswith('Skipping line '):
+            bad_lines.append(line.split(':')[0].replace('Skipping ', ''))
+        elif line.startswith('Expected '):
+            bad_lines.append('row ' + line.partition(': ')[2])
+    return bad_lines
+
+def record_bad_lines(file, bad_lines):
+    bad_lines_by_file[file] = bad_lines
+    add_to_stage_report(bad_lines=len(bad_lines))
+    if len(bad_lines) > 0:
+        print('dropped ' + str(len(bad_lines)) + ' bad lines from ' + file + ': ' + ', '.join(bad_lines))
+
+# Csv, parquet or feather, from the file extension
+def get_table_format(file):
+    extension = file[:len(file) - len(get_file_compression_extension(file))].rpartition('.')[2]
+    if extension in ['parquet', 'feather']:
+        return extension
+    return 'csv'
+
+# The extension of the clean files passed between the stages
+def get_clean_extension():
+    return get_table_extension(intermediate_format, compression)
+
+# The extension of a table file, eg. .parquet or .csv.gz. Only csv files are compressed, parquet and feather use their own codecs
+def get_table_extension(table_format, file_compression=None):
+    if table_format == 'csv' and file_compression is not None:
+        return '.csv' + compression_extensions[file_compression]
+    return '.' + table_format
+
+# Gzip or zstd from the extension of a compressed file, None for other files
+def get_file_compression(file):
+    for name, extension in compression_extensions.items():
+        if file.lower().endswith(extension):
+            return name
+    return None
+
+def get_file_compression_extension(file):
+    file_compression = get_file_compression(file)
+    return '' if file_compression is None else compression_extensions[file_compression]
+
+# Read a table file as a DataFrame with VAERS_ID as a column. Csv files go through read_csv_file,
+# parquet and feather files can read just the columns that are needed
+def read_table_file(file, columns=None, **kwargs):
+    file_format = get_table_format(file)
+    if file_format == 'csv':
+        if columns is not None:
+            kwargs['usecols'] = columns
+        return read_csv_file(file, **kwargs)
+
+    with open(file, 'rb') as f:
+        if file_format == 'parquet':
+            dataframe = pd.read_parquet(f, columns=columns)
+        else:
+            dataframe = pd.read_feather(f, columns=columns)
+    record_bad_lines(file, [])
+    add_to_stage_report(rows_read=len(dataframe), bytes_in=os.path.getsize(file))
+    return dataframe
+
+# Read a table file in batches of chunk_size rows
+def read_table_chunks(file, chunk_size, **kwargs):
+    file_format = get_table_format(file)
+    if file_format == 'csv':
+        yield from read_csv_chunks(file, chunk_size, **kwargs)
+    elif file_format == 'parquet':
+        import pyarrow.parquet
+        with open(file, 'rb') as f:
+            for batch in pyarrow.parquet.ParquetFile(f).iter_batches(batch_size=chunk_size):
+                add_to_stage_report(rows_read=batch.num_rows)
+                yield batch.to_pandas()
+        add_to_stage_report(bytes_in=os.path.getsize(file))
+    else:
+        yield read_table_file(file)
+
+# The column names of a table file, without reading its rows
+def get_table_columns(file):
+    file_format = get_table_format(file)
+    if file_format == 'csv':
+        with open_csv_source(file) as source:
+            return pd.read_csv(source, nrows=0, encoding=get_file_encoding(file)).columns.to_list()
+
+    import pyarrow.parquet
+    import pyarrow.ipc
+    with open(file, 'rb') as f:
+        if file_format == 'parquet':
+            return pyarrow.parquet.read_schema(f).names
+        return pyarrow.ipc.open_file(f).schema.names
+
+# Write a DataFrame indexed by VAERS_ID in batches to a csv, parquet or feather file, picked from the extension.
+# Parquet and feather keep VAERS_ID as the first column and need pyarrow. With append a csv file is added to without a header
+class TableWriter:
+
+    def __init__(self, out_file, append=False):
+        self.out_file = out_file
+        self.file_format = get_table_format(out_file)
+        self.compression = get_file_compression(out_file)
+        self.started = append
+        self.sink = None
+        self.writer = None
+        self.schema = None
+
+    def write(self, dataframe):
+        add_to_stage_report(rows_written=len(dataframe))
+        if self.file_format == 'csv' and self.compression is not None:
+            self.write_compressed(dataframe)
+        elif self.file_format == 'csv':
+            dataframe.to_csv(self.out_file, mode='a' if self.started else 'w', header=not self.started, date_format=date_format)
+        else:
+            self.write_arrow(get_text_frame(dataframe.reset_index()))
+        self.started = True
+
+    def write_arrow(self, dataframe):
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+        table = pyarrow.Table.from_pandas(dataframe, schema=self.schema, preserve_index=False)
+        if self.writer is None:
+            self.schema = table.schema
+            self.sink = open(self.out_file, 'wb')
+            if self.file_format == 'parquet':
+                self.writer = pyarrow.parquet.ParquetWriter(self.sink, self.schema)
+            else:
+                self.writer = pyarrow.ipc.new_file(self.sink, self.schema)
+        self.writer.write_table(table)
+
+    # The csv text goes to the compressor in slices of rows, so a whole file is never held as text
+    def write_compressed(self, dataframe):
+        if self.writer is None:
+            self.sink = open(self.out_file, 'wb')
+            self.writer = open_compressor(self.compression, self.sink)
+        for start in range(0, max(1, len(dataframe)), compression_batch_rows):
+            text = dataframe.iloc[start:start + compression_batch_rows].to_csv(header=not self.started and start == 0, date_format=date_format)
+            self.writer.write(text.encode('utf-8'))
+
+    # The csv files are written as utf-8, which is recorded so reading them back does not depend on chardet guessing it from a sample
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.sink.close()
+        if os.path.exists(self.out_file):
+            add_to_stage_report(bytes_out=os.path.getsize(self.out_file))
+            if self.file_format == 'csv':
+                set_file_encoding(self.out_file, 'utf-8')
+
+# A binary writer compressing into an open file: zstd compresses on its own threads, gzip on a ParallelGzipWriter
+def open_compressor(file_compression, sink):
+    if file_compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(threads=compression_threads).stream_writer(sink, closefd=False)
+    return ParallelGzipWriter(sink, compression_threads)
+
+# Gzip on several threads, the way pigz does it. The text is cut in blocks of compression_block_size bytes that are
+# compressed as separate gzip members on a thread pool and written in order, gzip readers read the members as one file
+class ParallelGzipWriter:
+
+    def __init__(self, sink, threads):
+        self.sink = sink
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(threads)
+        self.pending = []
+        self.buffer = []
+        self.buffered = 0
+        self.blocks = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= compression_block_size:
+            self.compress_buffer()
+
+    # zlib lets go of the GIL while it compresses, so the blocks are compressed in parallel.
+    # At most two blocks per thread wait for their turn to be written, which keeps memory bounded
+    def compress_buffer(self):
+        block = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.blocks += 1
+        self.pending.append(self.executor.submit(gzip.compress, block, compresslevel=6, mtime=0))
+        while len(self.pending) > 2 * self.threads:
+            self.sink.write(self.pending.pop(0).result())
+
+    def close(self):
+        if self.buffered > 0 or self.blocks == 0:
+            self.compress_buffer()
+        for future in self.pending:
+            self.sink.write(future.result())
+        self.pending = []
+        self.executor.shutdown()
+
+# Typed columns of a DataFrame turned back into the text the csv writer gives them
+def get_text_frame(dataframe):
+    typed_columns = [col for col in dataframe.columns if dataframe[col].dtype != object]
+    if len(typed_columns) == 0:
+        return dataframe
+    return dataframe.assign(**{col: format_typed_column(dataframe[col]) for col in typed_columns})
+
+# The text of a typed column as to_csv writes it, blanks for missing values
+def format_typed_column(values):
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.astype(object)
+    lines = values.to_csv(index=False, header=False, lineterminator='\n', date_format=date_format).split('\n')[:-1]
+    return pd.Series(lines, index=values.index, dtype=object).replace('""', '')
+
+# The column name without the number of the pivoted columns, eg. VAX_TYPE for VAX_TYPE_1 and SYMPTOM for SYMPTOM12
+def get_base_column_name(col):
+    return re.sub(r'_?\d+$', '', col)
+
+# The dtypes to read a file with: all text, or with typed_schema the category columns of column_schema read as categoricals
+def get_read_dtypes(file):
+    if not typed_schema:
+        return str
+    return {col: 'category' if column_schema.get(get_base_column_name(col)) == 'category' else str for col in get_table_columns(file)}
+
+# Convert the text columns named in column_schema to compact dtypes. A column only changes type when it
+# is written back as the same text, so typed and text runs write the same files
+def apply_schema(dataframe):
+    for col in dataframe.columns:
+        kind = column_schema.get(get_base_column_name(col))
+        if kind is not None and dataframe[col].dtype == object:
+            dataframe[col] = to_typed_column(dataframe[col], kind)
+    return dataframe
+
+# The column as a categorical, nullable integer, float or date, or the text itself when no type gives it back unchanged
+def to_typed_column(values, kind):
+    if kind == 'category':
+        return values.astype('category')
+
+    missing = values.mask(values == '')
+    if kind == 'date':
+        candidates = [lambda: pd.to_datetime(missing, format=date_format, errors='coerce')]
+    else:
+        numbers = pd.to_numeric(missing, errors='coerce')
+        candidates = [lambda: numbers.astype('Int64')]
+        if kind == 'number':
+            candidates.append(lambda: numbers)
+
+    for candidate in candidates:
+        try:
+            typed = candidate()
+        except (TypeError, ValueError):
+            continue
+        if (format_typed_column(typed) == values).all():
+            return typed
+    return values
+
+# Write a whole DataFrame indexed by VAERS_ID to a table file
+def write_table_file(dataframe, out_file):
+    writer = TableWriter(out_file)
+    writer.write(dataframe)
+    writer.close()
+
+# Original files can be read straight from a ZIP archive, named <archive>.zip/<member>, eg. Data/AllVAERSDataCSVS.zip/2019VAERSDATA.csv.
+# Returns the archive and member names, or None, None for a plain file
+def split_zip_path(file):
+    match = re.match(r'(.+?\.zip)/(.+)$', file, re.IGNORECASE)
+    if match is None or os.path.isdir(match.group(1)):
+        return None, None
+    return match.group(1), match.group(2)
+
+# The member of an archive by its name, or by its file name when the archive keeps it in a folder
+def get_zip_member(archive, member):
+    try:
+        return archive.getinfo(member)
+    except KeyError:
+        for info in archive.infolist():
+            if info.filename.rpartition('/')[2] == member:
+                return info
+    raise FileNotFoundError('No member ' + member + ' in ' + archive.filename)
+
+def input_file_exists(file):
+    zip_file, member = split_zip_path(file)
+    if zip_file is None:
+        return os.path.exists(file)
+    if not os.path.isfile(zip_file):
+        return False
+    try:
+        with zipfile.ZipFile(zip_file) as archive:
+            get_zip_member(archive, member)
+    except (FileNotFoundError, zipfile.BadZipFile):
+        return False
+    return True
+
+# Size and modified time of a file, for an archive member its uncompressed size and the time of the archive
+def get_file_stat(file):
+    zip_file, member = split_zip_path(file)
+    if zip_file is None:
+        return os.stat(file)
+    with zipfile.ZipFile(zip_file) as archive:
+        info = get_zip_member(archive, member)
+    return SimpleNamespace(st_size=info.file_size, st_mtime=os.stat(zip_file).st_mtime)
+
+# Open a file or archive member as a binary stream, members and gzip or zstd files are decompressed as they are read
+@contextlib.contextmanager
+def open_input_file(file):
+    zip_file, member = split_zip_path(file)
+    if zip_file is None and get_file_compression(file) == 'gzip':
+        with gzip.open(file, 'rb') as f:
+            yield f
+        return
+    if zip_file is None and get_file_compression(file) == 'zstd':
+        import zstandard
+        with open(file, 'rb') as raw, zstandard.ZstdDecompressor().stream_reader(raw) as f:
+            yield f
+        return
+    if zip_file is None:
+        with open(file, 'rb') as f:
+            yield f
+        return
+    with zipfile.ZipFile(zip_file) as archive, archive.open(get_zip_member(archive, member)) as f:
+        yield f
+
+# What to give pandas to read a csv file: the path of a plain file, or the stream of an archive member
+@contextlib.contextmanager
+def open_csv_source(file):
+    if split_zip_path(file)[0] is None:
+        yield file
+        return
+    with open_input_file(file) as f:
+        yield f
+
+# Get the encoding of a file, cached by path, size and modified time in memory and in a <file>.encoding sidecar
 def get_file_encoding(file):
-    rawdata = open(file, "rb").read()
-    result = chardet.detect(rawdata)
-    return result['encoding']
+    file_stat = get_file_stat(file)
+    cache_key = (os.path.abspath(file), file_stat.st_size, file_stat.st_mtime)
+    if cache_key in encoding_cache:
+        return encoding_cache[cache_key]
 
-#Main function for program execution starts here
-def main(): 
-    print("Starting at " + datetime.now().strftime('%H:%M:%S'))     
+    file_encoding = read_encoding_sidecar(file, file_stat)
+    if file_encoding is None:
+        start_time = time.perf_counter()
+        file_encoding = detect_file_encoding(file)
+        add_to_stage_report(encoding_seconds=time.perf_counter() - start_time)
+        write_encoding_sidecar(file, file_stat, file_encoding)
+
+    encoding_cache[cache_key] = file_encoding
+    return file_encoding
+
+# Record the encoding of a file this program wrote, in the cache and the sidecar
+def set_file_encoding(file, file_encoding):
+    file_stat = get_file_stat(file)
+    encoding_cache[(os.path.abspath(file), file_stat.st_size, file_stat.st_mtime)] = file_encoding
+    write_encoding_sidecar(file, file_stat, file_encoding)
+
+# Feed chardet a bounded sample of the file and stop as soon as it is confident
+def detect_file_encoding(file):
+    detector = chardet.UniversalDetector()
+    sample_is_ascii = True
+    bytes_read = 0
+    with open_input_file(file) as f:
+        while bytes_read < encoding_sample_size and not detector.done:
+            chunk = f.read(encoding_chunk_size)
+            if not chunk:
+                break
+            detector.feed(chunk)
+            bytes_read += len(chunk)
+            sample_is_ascii = sample_is_ascii and chunk.isascii()
+
+        # An ASCII sample does not rule out other characters further on, so scan the rest without chardet
+        # and only feed it the first chunk that is not plain ASCII
+        while sample_is_ascii and not detector.done:
+            chunk = f.read(encoding_chunk_size)
+            if not chunk:
+                break
+            if not chunk.isascii():
+                detector.feed(chunk)
+                sample_is_ascii = False
+
+    detector.close()
+    return detector.result['encoding']
+
+# <file>.encoding, or <archive>.zip.<member>.encoding next to the archive for a member of a ZIP archive
+def get_encoding_sidecar_name(file):
+    zip_file, member = split_zip_path(file)
+    if zip_file is not None:
+        return zip_file + '.' + member.replace('/', '_') + '.encoding'
+    return file + '.encoding'
+
+# Return the encoding stored in the sidecar if it was written for the same size and modified time, otherwise None
+def read_encoding_sidecar(file, file_stat):
+    sidecar = get_encoding_sidecar_name(file)
+    if not os.path.exists(sidecar):
+        return None
+    try:
+        with open(sidecar, 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get('size') != file_stat.st_size or cached.get('mtime') != file_stat.st_mtime:
+        return None
+    return cached.get('encoding')
+
+def write_encoding_sidecar(file, file_stat, file_encoding):
+    sidecar = get_encoding_sidecar_name(file)
+    try:
+        with open(sidecar, 'w') as f:
+            json.dump({'size': file_stat.st_size, 'mtime': file_stat.st_mtime, 'encoding': file_encoding}, f)
+    except OSError:
+        print('Warning: could not write encoding cache ' + sidecar)
+
+# Size, modified time and sha256 of a file. The hash of the previous fingerprint is reused while size and time match
+def get_file_fingerprint(file, previous=None):
+    file_stat = get_file_stat(file)
+    if previous is not None and previous.get('size') == file_stat.st_size and previous.get('mtime') == file_stat.st_mtime:
+        return previous
+
+    file_hash = hashlib.sha256()
+    with open_input_file(file) as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(block)
+    return {'size': file_stat.st_size, 'mtime': file_stat.st_mtime, 'sha256': file_hash.hexdigest()}
+
+def read_manifest(out_dir):
+    manifest_file = out_dir + manifest_name
+    if not os.path.exists(manifest_file):
+        return {'years': {}}
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+def write_manifest(out_dir, manifest):
+    with open(out_dir + manifest_name, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+# The settings that change the content of the clean and yearly files, a year is rebuilt when they change
+def get_output_settings():
+    return {'intermediate_format': intermediate_format, 'output_formats': output_formats, 'output_layout': output_layout, 'compression': compression, 'selected_columns': selected_columns,
+            'row_filters': [list(row_filter) for row_filter in row_filters], 'csv_engine': csv_engine,
+            'max_vax_records': max_vax_records, 'scrub_replacements': [list(pair) for pair in scrub_replacements]}
+
+# The clean files and the yearly files built from a group of original files
+def get_year_output_files(file_group):
+    prefix = get_file_prefix(file_group[0])
+    clean_files = [clean_dir_name + prefix + base_name + get_clean_extension() for base_name in ['VAERSDATA', 'VAERSSYMPTOMS', 'VAERSVAX']]
+    table_names = long_table_names if output_layout == 'long' else ['']
+    return clean_files + [output_dir_name + prefix + 'VAERS' + table_name + get_table_extension(output_format, compression) for table_name in table_names for output_format in output_formats]
+
+# True if the original files of a year, the files built from them and the settings are the same as in the manifest
+def is_year_up_to_date(file_group, manifest):
+    entry = manifest['years'].get(get_file_prefix(file_group[0]))
+    if entry is None or entry.get('settings') != get_output_settings():
+        return False
+    if sorted(entry['inputs']) != sorted(file_group) or sorted(entry['outputs']) != sorted(get_year_output_files(file_group)):
+        return False
+    for file, fingerprint in chain(entry['inputs'].items(), entry['outputs'].items()):
+        if not input_file_exists(file) or get_file_fingerprint(file, fingerprint)['sha256'] != fingerprint['sha256']:
+            return False
+    return True
+
+def record_year_in_manifest(file_group, manifest):
+    manifest['years'][get_file_prefix(file_group[0])] = {
+        'settings': get_output_settings(),
+        'inputs': {file: get_file_fingerprint(file) for file in file_group},
+        'outputs': {file: get_file_fingerprint(file) for file in get_year_output_files(file_group)}}
+
+# With incremental set, leave out the years that are up to date with the manifest
+def get_years_to_build(list_of_files, manifest):
+    if not incremental:
+        return list_of_files
+    years_to_build = []
+    for file_group in list_of_files:
+        if is_year_up_to_date(file_group, manifest):
+            print('skipping ' + get_file_prefix(file_group[0]) + ', files unchanged since the last run')
+        else:
+            years_to_build.append(file_group)
+    return years_to_build
+
+# Run func once per work item (a tuple of arguments). With jobs > 1 the items go to a pool of worker processes,
+# largest input first so one big year does not hold up the rest. Each item's log is printed as one block and
+# the first failure stops the run
+def run_tasks(func, items):
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [run_stage(func, item) for item in items]
+
+    # the largest items start first, the results are given back in the order of the items
+    order = sorted(range(len(items)), key=lambda i: get_task_size(items[i]), reverse=True)
+    results = [None] * len(items)
+    with Pool(processes=min(jobs, len(items)), initializer=apply_settings, initargs=(get_settings(),)) as pool:
+        pending = [(i, pool.apply_async(run_task, (func, items[i]))) for i in order]
+        for i, task in pending:
+            log, result, report = task.get() # raises the worker's error
+            print(log, end='')
+            results[i] = result
+            run_report.extend(report)
+    return results
+
+# Build a year with a VAERSPipeline set up from the user provided variables
+def build_year(file_group):
+    pipeline = VAERSPipeline(csv_engine, scrub_replacements, max_vax_records, intermediate_format, output_formats, compression, selected_columns, row_filters)
+    pipeline.run_year(file_group, clean_dir_name, output_dir_name)
+
+# Run one work item in a worker process and return its captured log and run report entries with the result
+def run_task(func, item):
+    log = io.StringIO()
+    first_entry = len(run_report)
+    try:
+        with contextlib.redirect_stdout(log):
+            result = run_stage(func, item)
+    except Exception:
+        raise RuntimeError(func.__name__ + str(item) + ' failed\n' + log.getvalue() + traceback.format_exc()) from None
+    return log.getvalue(), result, run_report[first_entry:]
+
+# Run one work item with a run report entry named after the function and the first file of the item
+def run_stage(func, item):
+    file = get_task_file(item)
+    with report_stage(func.__name__, file), profile_stage(func.__name__, file):
+        return func(*item)
+
+def get_task_file(item):
+    if isinstance(item, (list, tuple)):
+        return next((file for file in map(get_task_file, item) if file is not None), None)
+    return item if isinstance(item, str) else None
+
+# Collect the duration, rows, bytes and peak memory of a stage working on a file into a run report entry
+@contextlib.contextmanager
+def report_stage(stage, file):
+    global stage_report
+    stage_report = {'stage': stage, 'file': file, 'seconds': 0.0, 'rows_read': 0, 'bad_lines': 0, 'rows_written': 0,
+                    'bytes_in': 0, 'bytes_out': 0, 'encoding_seconds': 0.0, 'peak_rss_mb': None}
+    reset_peak_rss()
+    start_time = time.perf_counter()
+    try:
+        yield stage_report
+    finally:
+        stage_report['seconds'] = round(time.perf_counter() - start_time, 4)
+        stage_report['encoding_seconds'] = round(stage_report['encoding_seconds'], 4)
+        stage_report['peak_rss_mb'] = get_peak_rss_mb()
+        run_report.append(stage_report)
+        stage_report = None
+
+def add_to_stage_report(**counts):
+    if stage_report is not None:
+        for name, count in counts.items():
+            stage_report[name] += count
+    if stage_memory is not None:
+        snapshot_stage_memory()
+
+# The file of a stage in the name of its profile. The shards of a year have the same file names, so the shard is kept
+def get_profile_file_name(file):
+    if file is None:
+        return 'all'
+    shard = re.search(r'/shards/(\d+)/([^/]+)$', file)
+    if shard is not None:
+        return 'shard' + shard.group(1) + '-' + shard.group(2)
+    return file.rpartition('/')[2]
+
+# Profile a stage with cProfile and/or tracemalloc, as set in profile_modes, and save the profile and its
+# top profile_top_n summary under output_dir_name/profiles. Does nothing when profile_modes is empty
+@contextlib.contextmanager
+def profile_stage(stage, file):
+    global stage_memory
+    if len(profile_modes) == 0:
+        yield
+        return
+
+    profile_dir = output_dir_name + 'profiles/'
+    os.makedirs(profile_dir, exist_ok=True)
+    profile_name = profile_dir + stage + '-' + get_profile_file_name(file)
+    profiler = cProfile.Profile() if 'cpu' in profile_modes else None
+    started_tracing = False
+    if 'memory' in profile_modes:
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        stage_memory = {'traced': 0, 'snapshot': None}
+
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_name + '.prof')
+            with open(profile_name + '-cpu.txt', 'w') as f:
+                pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(profile_top_n)
+        if stage_memory is not None:
+            snapshot_stage_memory()
+            write_memory_summary(profile_name + '-memory.txt', stage_memory['snapshot'], tracemalloc.get_traced_memory()[1])
+            stage_memory = None
+            if started_tracing:
+                tracemalloc.stop()
+
+# Keep the snapshot with the most traced memory. The readers and writers call this through add_to_stage_report,
+# when the stage holds its data, as the memory is mostly freed again by the end of the stage
+def snapshot_stage_memory():
+    traced = tracemalloc.get_traced_memory()[0]
+    if stage_memory['snapshot'] is None or traced > stage_memory['traced']:
+        stage_memory['traced'] = traced
+        stage_memory['snapshot'] = tracemalloc.take_snapshot()
+
+def write_memory_summary(out_file, snapshot, peak):
+    with open(out_file, 'w') as f:
+        f.write('peak traced memory: ' + str(round(peak / (1024 * 1024), 2)) + ' MB\n')
+        f.write('largest snapshot: ' + str(round(sum(stat.size for stat in snapshot.statistics('filename')) / (1024 * 1024), 2)) + ' MB\n')
+        f.write('top ' + str(profile_top_n) + ' allocation sites in the largest snapshot:\n')
+        for stat in snapshot.statistics('lineno')[:profile_top_n]:
+            f.write(str(stat) + '\n')
+
+# Linux lets a process reset its peak RSS, so each stage reports its own peak rather than the peak of the process so far
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+# Peak resident memory of this process in MB, None where the resource module is not available (Windows)
+def get_peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+# Write the run report with the totals of each stage next to the output files
+def write_run_report(out_dir, started):
+    stages = {}
+    for entry in run_report:
+        totals = stages.setdefault(entry['stage'], {'files': 0, 'seconds': 0.0, 'rows_read': 0, 'bad_lines': 0, 'rows_written': 0,
+                                                    'bytes_in': 0, 'bytes_out': 0, 'encoding_seconds': 0.0, 'peak_rss_mb': None})
+        totals['files'] += 1
+        for name in ['seconds', 'rows_read', 'bad_lines', 'rows_written', 'bytes_in', 'bytes_out', 'encoding_seconds']:
+            totals[name] += entry[name]
+        if entry['peak_rss_mb'] is not None:
+            totals['peak_rss_mb'] = max(totals['peak_rss_mb'] or 0, entry['peak_rss_mb'])
+    for totals in stages.values():
+        totals['seconds'] = round(totals['seconds'], 4)
+        totals['encoding_seconds'] = round(totals['encoding_seconds'], 4)
+        totals['mb_per_second'] = round(totals['bytes_in'] / (1024 * 1024) / totals['seconds'], 2) if totals['seconds'] > 0 else None
+
+    report = {'started': started.isoformat(timespec='seconds'), 'finished': datetime.now().isoformat(timespec='seconds'),
+              'jobs': jobs, 'csv_engine': csv_engine, 'stages': stages, 'files': run_report}
+    with open(out_dir + run_report_name, 'w') as f:
+        json.dump(report, f, indent=2)
+
+# Total size of the files named in a work item, used to start the largest work first
+def get_task_size(item):
+    if isinstance(item, (list, tuple)):
+        return sum(get_task_size(i) for i in item)
+    if isinstance(item, str) and input_file_exists(item):
+        return get_file_stat(item).st_size
+    return 0
+
+# The user provided variables, passed to the worker processes so they run with the same settings
+def get_settings():
+    return {name: globals()[name] for name in settings_names}
+
+def apply_settings(settings):
+    globals().update(settings)
+
+# Override the user provided variables from the command line
+def parse_arguments(args=None):
     global original_dir_name
     global clean_dir_name
     global output_dir_name
     global begin_year
-    global stop_year    
-
-    # parser = argparse.ArgumentParser(description ='Process some integers.')
-    # parser.add_argument('integers', metavar ='N', 
-    #                     type = int, nargs ='+',
-    #                     help ='an integer for the accumulator')
+    global stop_year
+    global non_domestic_flag
+    global jobs
+    global csv_engine
+    global chunk_size
+    global intermediate_format
+    global output_formats
+    global output_layout
+    global compression
+    global compression_threads
+    global typed_schema
+    global profile_modes
+    global shards
+    global selected_columns
+    global row_filters
+    global partitioned
+    global vax_type_partitions
+    global sqlite_index
+    global delta_merge
+    global in_memory
+    global incremental
 
-    # parser.add_argument(dest ='accumulate', 
-    #                     action ='store_const',
-    #                     const = sum, 
-    #                     help ='sum the integers')
+    parser = argparse.ArgumentParser(description='Clean and combine VAERS data files.')
+    parser.add_argument('--data-dir', default=original_dir_name, help='directory with the CDC VAERS csv files')
+    parser.add_argument('--clean-dir', default=clean_dir_name, help='directory for the cleaned files')
+    parser.add_argument('--output-dir', default=output_dir_name, help='directory for the combined files')
+    parser.add_argument('--begin-year', type=int, default=begin_year)
+    parser.add_argument('--stop-year', type=int, default=stop_year)
+    parser.add_argument('--non-domestic', action='store_true', default=non_domestic_flag, help='include the NonDomestic files')
+    parser.add_argument('--jobs', type=int, default=jobs, help='number of worker processes')
+    parser.add_argument('--engine', choices=['python', 'c', 'pyarrow'], default=csv_engine, help='csv reader engine')
+    parser.add_argument('--chunk-size', type=int, default=chunk_size, help='scrub files in batches of this many rows')
+    parser.add_argument('--intermediate-format', choices=['csv', 'parquet', 'feather'], default=intermediate_format, help='format of the clean files between the stages')
+    parser.add_argument('--output-format', choices=['csv', 'parquet'], nargs='+', default=output_formats, help='formats of the yearly and total files')
+    parser.add_argument('--layout', choices=['wide', 'long'], default=output_layout, help='one wide row per report, or separate report, vaccine and symptom tables')
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], default=compression, help='compress the csv clean, yearly and total files')
+    parser.add_argument('--compression-threads', type=int, default=compression_threads, help='threads compressing each csv file')
+    parser.add_argument('--typed', action='store_true', default=typed_schema, help='keep flags, codes, numbers and dates as compact types in the combine and append stages')
+    parser.add_argument('--profile', choices=['cpu', 'memory'], nargs='+', default=profile_modes, help='profile each stage into the profiles folder of the output directory')
+    parser.add_argument('--shards', type=int, default=shards, help='split each year into this many parts by VAERS_ID and combine them in parallel')
+    parser.add_argument('--columns', nargs='+', default=selected_columns, help='only read and write these columns, eg. AGE_YRS SYMPTOM VAX_TYPE_1')
+    parser.add_argument('--filter', type=parse_filter, nargs='+', default=row_filters, help='only keep the rows that pass all of these, eg. VAX_TYPE=COVID19 RECVDATE>=01/01/2021 STATE=CA,NY')
+    parser.add_argument('--partitioned', action='store_true', default=partitioned, help='also write a dataset with a folder per year that VAERSDataset reads')
+    parser.add_argument('--vax-type-partitions', action='store_true', default=vax_type_partitions, help='split each year of the dataset by VAX_TYPE_1')
+    parser.add_argument('--sqlite', action='store_true', default=sqlite_index, help='also load the yearly files into an indexed SQLite database for lookups')
+    parser.add_argument('--delta', action='store_true', default=delta_merge, help='only rewrite the rows of the total file and SQLite database that changed, logged in a changelog')
+    parser.add_argument('--in-memory', action='store_true', default=in_memory, help='build each year in memory, reads each original file whole')
+    parser.add_argument('--incremental', action='store_true', default=incremental, help='only rebuild the years that changed since the last run')
+    parsed = parser.parse_args(args)
 
-    # args = parser.parse_args()
+    original_dir_name = parsed.data_dir
+    clean_dir_name = parsed.clean_dir
+    output_dir_name = parsed.output_dir
+    begin_year = parsed.begin_year
+    stop_year = parsed.stop_year
+    non_domestic_flag = parsed.non_domestic
+    jobs = max(1, parsed.jobs)
+    csv_engine = parsed.engine
+    chunk_size = parsed.chunk_size
+    intermediate_format = parsed.intermediate_format
+    output_formats = parsed.output_format
+    output_layout = parsed.layout
+    compression = parsed.compression
+    compression_threads = max(1, parsed.compression_threads)
+    typed_schema = parsed.typed
+    profile_modes = parsed.profile
+    shards = max(1, parsed.shards)
+    selected_columns = parsed.columns
+    row_filters = parsed.filter
+    partitioned = parsed.partitioned
+    vax_type_partitions = parsed.vax_type_partitions
+    sqlite_index = parsed.sqlite
+    delta_merge = parsed.delta
+    in_memory = parsed.in_memory
+    incremental = parsed.incremental
 
+#Main function for program execution starts here
+def main(): 
+    started = datetime.now()
+    print("Starting at " + started.strftime('%H:%M:%S'))     
+    parse_arguments()
     correct_for_common_errors()
           
     # Get the list of all original files for the run
@@ -438,61 +1971,115 @@ def main():
         print('No files have been found to process. Please check that you have downloaded and unzipped the VAERS files in the directory provided in the original_dir_name variable.')
         sys.exit(__error_missing_files__)
 
-   
-      
-    # Create clean copies of the files 
-    # if multi_thread:
-        # pool = Pool()
-        # scrub_file1=partial(scrub_file, out_dir=clean_dir_name)
-        # pool.map(scrub_file1, list_of_files)         
-        # pool.close()
-    # else:
-    for sub_list in list_of_files:
-        for file in sub_list:
-            scrub_file(file, clean_dir_name)
+    # Only rebuild the years that changed since the last run when incremental is set
+    manifest = read_manifest(output_dir_name)
+    years_to_build = get_years_to_build(list_of_files, manifest)
+    prefixes_to_build = [get_file_prefix(file_group[0]) for file_group in years_to_build]
+
+    # With delta_merge, hash the rows of the yearly files of the last run before they are rebuilt
+    previous_hashes = {}
+    if delta_merge:
+        previous_files = [file for file in get_combined_file_names(years_to_build, output_dir_name) if os.path.exists(file)]
+        previous_hashes = {hashes.name: hashes for hashes in run_tasks(get_row_hashes, [(file,) for file in previous_files])}
+
+    if len(row_filters) > 0:
+        check_filter_columns(list_of_files)
+    if selected_columns is not None:
+        check_selected_columns(list_of_files)
+
+    # Create clean copies of the files, or with in_memory build each year in one go and keep the clean files for the record.
+    # With filters, the SYMPTOMS files are scrubbed last and only for the IDs left in the DATA and VAX files
+    if in_memory:
+        run_tasks(build_year, [(file_group,) for file_group in years_to_build])
+    elif len(row_filters) > 0:
+        run_tasks(scrub_file, [(file, clean_dir_name) for file_group in years_to_build for file in [file_group[0], file_group[2]]])
+        run_tasks(scrub_file, [(file_group[1], clean_dir_name, get_filtered_ids(file_group, clean_dir_name)) for file_group in years_to_build])
+    else:
+        run_tasks(scrub_file, [(file, clean_dir_name) for file in chain.from_iterable(years_to_build)])
 
     # Create the list of clean files
-    list_of_clean_files = get_list_of_files(clean_dir_name, begin_year, stop_year, non_domestic_flag)
-    if len(list_of_files) < 1:
+    list_of_clean_files = get_list_of_files(clean_dir_name, begin_year, stop_year, non_domestic_flag, get_clean_extension())
+    if len(list_of_clean_files) < 1:
         print('No clean files have been found to combine. Please check the data, original_dir_name variable, and clean_dir_name variable.')
         sys.exit(__error_missing_files__)
 
+    # The years built in memory are already combined
+    clean_files_to_build = [file_group for file_group in list_of_clean_files if get_file_prefix(file_group[0]) in prefixes_to_build and not in_memory]
+
+    # With the long layout, write the tables of each year and of all the years straight from the clean files, there is nothing to pivot
+    if output_layout == 'long':
+        print("Writing long tables at " + datetime.now().strftime('%H:%M:%S'))
+        run_tasks(write_long_tables, [(file_group, output_dir_name) for file_group in clean_files_to_build])
+        print("Appending files at " + datetime.now().strftime('%H:%M:%S'))
+        run_tasks(append_files, [(get_combined_file_names(list_of_clean_files, output_dir_name, table_name), output_dir_name, 'TotalVAERS' + table_name) for table_name in long_table_names])
+        finish_run(years_to_build, manifest, started)
+        return
+
+    # With shards, split each year by VAERS_ID and combine the shards in parallel, then put each year back together
+    if shards > 1:
+        print("Starting shards at " + datetime.now().strftime('%H:%M:%S'))
+        run_tasks(split_year, [(file_group, shards) for file_group in clean_files_to_build])
+        run_tasks(combine_shard, [(shard_group,) for file_group in clean_files_to_build for shard_group in get_shard_file_groups(file_group, shards)])
+        run_tasks(concat_shards, [(file_group, shards, output_dir_name) for file_group in clean_files_to_build])
+        clean_files_to_build = []
+
     # Create a flat list of all the files to use in combining them
-    flat_list_of_files =  list(chain.from_iterable(list_of_clean_files))
+    flat_list_of_files =  list(chain.from_iterable(clean_files_to_build))
     
-          #TODO fix duplicates
-    # Combine the records of the Vax file to remove duplicates TODO combining: C:/Users/Giant/Desktop/Vaccine2/Data/2017VAERSDATA.csv should be using clean data list
+    # Combine the records of the Vax file to remove duplicates
     print("Starting vax files at " + datetime.now().strftime('%H:%M:%S'))
-    vax_files = get_file_names_containing('VAERSVAX.csv', list_of_clean_files)
-    #TODO get list of files from list_of_files 
-    # if multi_thread:
-        # pool2 = Pool()
-        # pool2.map(combine_vax_records, vax_files, chunksize=1)  
-        # pool2.close()
-    # else:
-    for sub_list in vax_files:
-        for file in sub_list:
-            combine_vax_records(file)
+    vax_files = get_file_names_containing('VAERSVAX' + get_clean_extension(), flat_list_of_files)
+    run_tasks(combine_vax_records, [(file,) for file in vax_files])
     
     # Combine the symptom records so they are all on one line
     print("Starting symptom files at " + datetime.now().strftime('%H:%M:%S'))
-    symptom_files = get_file_names_containing('VAERSSYMPTOMS.csv', list_of_clean_files)
-    # if multi_thread:
-        # pool1 = Pool()
-        # pool1.map(combine_symptoms, symptom_files, chunksize=1)         
-        # pool1.close()
-    # else:
-    for sub_list in symptom_files:
-        for file in sub_list:
-            combine_symptoms(file)
+    symptom_files = get_file_names_containing('VAERSSYMPTOMS' + get_clean_extension(), flat_list_of_files)
+    run_tasks(combine_symptoms, [(file,) for file in symptom_files])
     
     # Combine the three yearly files into one
     print("Combining files at " + datetime.now().strftime('%H:%M:%S'))
-    combine_files(list_of_clean_files, output_dir_name)
-    
-    # Append all the files to create one total VAERS file
+    run_tasks(combine_files, [([file_group], output_dir_name) for file_group in clean_files_to_build])
+
+    # With delta_merge, compare the rows of the rebuilt years with those of the last run and log the changes
+    combined_files = get_combined_file_names(list_of_clean_files, output_dir_name)
+    if delta_merge:
+        print("Comparing rows at " + datetime.now().strftime('%H:%M:%S'))
+        rebuilt_files = [file for file in combined_files if get_file_prefix(file) in prefixes_to_build]
+        changes = pd.concat(run_tasks(get_row_changes, [(file, previous_hashes.get(file)) for file in rebuilt_files]) +
+                            [pd.DataFrame(columns=['YEAR', 'VAERS_ID', 'CHANGE'])], ignore_index=True)
+        write_changelog(output_dir_name, changes, started)
+
+    # Append all the yearly files, rebuilt or not, to create one total VAERS file, or only the years from the first changed one on with delta_merge
     print("Appending files at " + datetime.now().strftime('%H:%M:%S'))
-    append_files(flat_list_of_files, output_dir_name)
+    if delta_merge:
+        manifest['total'] = run_tasks(merge_into_total, [(combined_files, output_dir_name, set(changes['YEAR']), manifest.get('total'))])[0]
+    else:
+        manifest['total'] = run_tasks(append_files, [(combined_files, output_dir_name)])[0]
+
+    # Write the yearly files again as a dataset partitioned by year, and by VAX_TYPE_1 with vax_type_partitions
+    if partitioned:
+        print("Partitioning files at " + datetime.now().strftime('%H:%M:%S'))
+        dataset_dir = output_dir_name + dataset_dir_name
+        kept_years = get_partitioned_years(dataset_dir, [prefix for prefix in map(get_file_prefix, combined_files) if prefix not in prefixes_to_build])
+        years = run_tasks(write_year_partitions, [(file, dataset_dir) for file in combined_files if get_file_prefix(file) not in kept_years])
+        write_dataset_index(dataset_dir, combined_files, years + list(kept_years.values()))
+
+    # Load the yearly files into an SQLite database indexed for lookups
+    if sqlite_index and delta_merge and os.path.exists(output_dir_name + sqlite_name):
+        print("Indexing changes at " + datetime.now().strftime('%H:%M:%S'))
+        run_tasks(merge_into_sqlite, [(combined_files, output_dir_name, changes)])
+    elif sqlite_index:
+        print("Indexing files at " + datetime.now().strftime('%H:%M:%S'))
+        run_tasks(build_sqlite_index, [(combined_files, output_dir_name)])
+
+    finish_run(years_to_build, manifest, started)
+
+# Record the years built in the manifest and write the run report
+def finish_run(years_to_build, manifest, started):
+    for file_group in years_to_build:
+        record_year_in_manifest(file_group, manifest)
+    write_manifest(output_dir_name, manifest)
+    write_run_report(output_dir_name, started)
 
     print("Finished at " + datetime.now().strftime('%H:%M:%S'))
       
@@ -0,0 +1,323 @@
+'''
+===================  VAERSCleanDataBenchmark  ===================
+    This file times the stages of the VAERSCleanData program on
+    generated data. The VAERS files in TestData are too small to
+    show how the stages grow with the size of a year, so this file
+    writes seeded, realistic VAERSDATA, VAERSSYMPTOMS and VAERSVAX
+    files of any size and runs scrub_file, combine_vax_records,
+    combine_symptoms, combine_files and append_files on them.
+
+    Each stage is timed at each size, then run again under
+    tracemalloc to record its peak memory. The results are written
+    to a JSON report that can be compared with the report of another
+    commit, eg.
+
+    python VAERSCleanDataBenchmark.py --sizes 1000 10000 100000 --report before.json
+    python VAERSCleanDataBenchmark.py --sizes 1000 10000 100000 --report after.json --compare before.json
+
+    Any other arguments (eg. --engine c or --typed) are passed on to
+    VAERSCleanData. The stages run one file at a time in this process,
+    so --jobs has no effect here.
+
+    This code is open source and licensed under the GNU GPL v3 at:
+    https://www.gnu.org/licenses/gpl-3.0.en.html.
+
+    Copyright (c) 2025 Things and Stuff LTD
+'''
+import os
+import csv
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import VAERSCleanData
+
+#================ Constants ================
+data_columns = ['VAERS_ID', 'RECVDATE', 'STATE', 'AGE_YRS', 'CAGE_YR', 'CAGE_MO', 'SEX', 'RPT_DATE', 'SYMPTOM_TEXT', 'DIED',
+                'DATEDIED', 'L_THREAT', 'ER_VISIT', 'HOSPITAL', 'HOSPDAYS', 'X_STAY', 'DISABLE', 'RECOVD', 'VAX_DATE',
+                'ONSET_DATE', 'NUMDAYS', 'LAB_DATA', 'V_ADMINBY', 'V_FUNDBY', 'OTHER_MEDS', 'CUR_ILL', 'HISTORY', 'PRIOR_VAX',
+                'SPLTTYPE', 'FORM_VERS', 'TODAYS_DATE', 'BIRTH_DEFECT', 'OFC_VISIT', 'ER_ED_VISIT', 'ALLERGIES']
+symptom_columns = ['VAERS_ID'] + [col + str(i) for i in range(1, 6) for col in ['SYMPTOM', 'SYMPTOMVERSION']]
+vax_columns = ['VAERS_ID', 'VAX_TYPE', 'VAX_MANU', 'VAX_LOT', 'VAX_DOSE_SERIES', 'VAX_ROUTE', 'VAX_SITE', 'VAX_NAME']
+stage_names = ['scrub_file', 'combine_vax_records', 'combine_symptoms', 'combine_files', 'append_files']
+long_stage_names = ['scrub_file', 'write_long_tables', 'append_files'] # with --layout long
+
+states = ['CA', 'TX', 'FL', 'NY', 'PA', 'IL', 'OH', 'GA', 'NC', 'MI', 'WA', 'AZ', 'MA', 'HI', 'WI', '']
+vaccines = [('COVID19', 'PFIZER\\BIONTECH', 'COVID19 (COVID19 (PFIZER-BIONTECH))'),
+            ('COVID19', 'MODERNA', 'COVID19 (COVID19 (MODERNA))'),
+            ('FLU4', 'SANOFI PASTEUR', 'INFLUENZA (SEASONAL) (FLUZONE QUADRIVALENT)'),
+            ('FLU4', 'GLAXOSMITHKLINE BIOLOGICALS', 'INFLUENZA (SEASONAL) (FLUARIX QUADRIVALENT)'),
+            ('VARZOS', 'GLAXOSMITHKLINE BIOLOGICALS', 'ZOSTER (SHINGRIX)'),
+            ('HPV9', 'MERCK & CO. INC.', 'HPV (GARDASIL 9)'),
+            ('PPV', 'MERCK & CO. INC.', 'PNEUMO (PNEUMOVAX)'),
+            ('TDAP', 'SANOFI PASTEUR', 'TDAP (ADACEL)')]
+symptoms = ['Pain', 'Pyrexia', 'Headache', 'Fatigue', 'Chills', 'Nausea', 'Dizziness', 'Arthralgia', 'Myalgia', 'Rash',
+            'Injection site pain', 'Injection site erythema', 'Injection site swelling', 'Injection site pruritus',
+            'Pain in extremity', 'Dyspnoea', 'Urticaria', 'Vomiting', 'Lymphadenopathy', 'Paraesthesia']
+# words for the free text, including the characters scrub_file replaces
+words = ['patient', 'reported', 'pain', 'swelling', 'at', 'the', 'injection', 'site', 'after', 'dose', 'fever', 'of', '101.5F',
+         'resolved', 'within', '2-3', 'days;', 'took', 'Tylenol', '&', 'ibuprofen', 'per', 'MD\'s', 'advice:', '"rest"',
+         'arm', 'sore', '#2', 'follow-up', 'on', '12/30/2019', 'no', 'other', 'symptoms', '~', 'email@clinic', 'café', 'naïve']
+#===========================================
+
+
+'''
+Write a seeded, realistic year of VAERS files, <prefix>VAERSDATA.csv, <prefix>VAERSSYMPTOMS.csv and <prefix>VAERSVAX.csv
+rows: the number of reports (VAERS_IDs) in the year
+multi_vax_ratio: share of reports with more than one vaccine
+multi_symptom_ratio: share of reports with more than the five symptoms that fit on one SYMPTOMS row
+long_text_ratio: share of reports with a SYMPTOM_TEXT of several thousand characters
+malformed_ratio: share of lines followed by a malformed line with extra fields, which the readers drop
+Returns the three file names and the number of malformed lines written to each
+'''
+def generate_year(out_dir, prefix, rows, first_id=1000000, multi_vax_ratio=0.1, multi_symptom_ratio=0.1, long_text_ratio=0.01,
+                  malformed_ratio=0.001, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = np.arange(first_id, first_id + rows)
+    year = int(prefix) if prefix.isdigit() else 2021
+    files = [out_dir + prefix + name for name in ['VAERSDATA.csv', 'VAERSSYMPTOMS.csv', 'VAERSVAX.csv']]
+
+    malformed = [write_rows(files[0], data_columns, generate_data_rows(rng, ids, year, long_text_ratio), rng, malformed_ratio),
+                 write_rows(files[1], symptom_columns, generate_symptom_rows(rng, ids, multi_symptom_ratio), rng, malformed_ratio),
+                 write_rows(files[2], vax_columns, generate_vax_rows(rng, ids, multi_vax_ratio), rng, malformed_ratio)]
+    return files, malformed
+
+def generate_data_rows(rng, ids, year, long_text_ratio):
+    rows = len(ids)
+    received = pd.Timestamp(year, 1, 1) + pd.to_timedelta(rng.integers(0, 365, rows), unit='D')
+    vaccinated = received - pd.to_timedelta(rng.integers(0, 30, rows), unit='D')
+    numdays = rng.integers(0, 5, rows)
+    onset = vaccinated + pd.to_timedelta(numdays, unit='D')
+    ages = rng.integers(0, 100, rows)
+    died = rng.random(rows) < 0.01
+    hospital = rng.random(rows) < 0.05
+    text_words = np.where(rng.random(rows) < long_text_ratio, rng.integers(400, 2000, rows), rng.integers(5, 60, rows))
+
+    columns = {'VAERS_ID': ids,
+               'RECVDATE': received.strftime('%m/%d/%Y'),
+               'STATE': rng.choice(states, rows),
+               'AGE_YRS': np.where(rng.random(rows) < 0.95, ages.astype(float).astype(str), ''),
+               'CAGE_YR': ages.astype(str),
+               'SEX': rng.choice(['F', 'M', 'U'], rows),
+               'SYMPTOM_TEXT': get_texts(rng, text_words),
+               'DIED': np.where(died, 'Y', ''),
+               'DATEDIED': np.where(died, (onset + pd.Timedelta(days=3)).strftime('%m/%d/%Y'), ''),
+               'L_THREAT': np.where(rng.random(rows) < 0.01, 'Y', ''),
+               'HOSPITAL': np.where(hospital, 'Y', ''),
+               'HOSPDAYS': np.where(hospital, rng.integers(1, 20, rows).astype(str), ''),
+               'RECOVD': rng.choice(['Y', 'N', 'U', ''], rows),
+               'VAX_DATE': vaccinated.strftime('%m/%d/%Y'),
+               'ONSET_DATE': onset.strftime('%m/%d/%Y'),
+               'NUMDAYS': numdays.astype(str),
+               'LAB_DATA': get_texts(rng, rng.integers(0, 20, rows)),
+               'V_ADMINBY': rng.choice(['PVT', 'PHM', 'PUB', 'WRK', 'UNK'], rows),
+               'OTHER_MEDS': get_texts(rng, rng.integers(0, 8, rows)),
+               'CUR_ILL': rng.choice(['None', '', 'Cold'], rows),
+               'HISTORY': get_texts(rng, rng.integers(0, 8, rows)),
+               'FORM_VERS': np.full(rows, '2'),
+               'TODAYS_DATE': received.strftime('%m/%d/%Y'),
+               'OFC_VISIT': rng.choice(['Y', ''], rows),
+               'ER_ED_VISIT': rng.choice(['Y', ''], rows),
+               'ALLERGIES': rng.choice(['None', 'Penicillin', 'NKDA', ''], rows)}
+    blank = np.full(rows, '')
+    return zip(*[columns.get(col, blank) for col in data_columns])
+
+def generate_symptom_rows(rng, ids, multi_symptom_ratio):
+    for vaers_id in ids:
+        count = int(rng.integers(6, 26)) if rng.random() < multi_symptom_ratio else int(rng.integers(1, 6))
+        terms = sorted(rng.choice(symptoms, min(count, len(symptoms)), replace=False))
+        for i in range(0, len(terms), 5):
+            row = [vaers_id]
+            for slot in range(5):
+                row = row + ([terms[i + slot], '24.0'] if i + slot < len(terms) else ['', ''])
+            yield row
+
+def generate_vax_rows(rng, ids, multi_vax_ratio):
+    for vaers_id in ids:
+        count = int(rng.integers(2, 5)) if rng.random() < multi_vax_ratio else 1
+        for i in range(count):
+            vax_type, manufacturer, name = vaccines[int(rng.integers(0, len(vaccines)))]
+            yield [vaers_id, vax_type, manufacturer, 'L' + str(int(rng.integers(1000, 99999))), rng.choice(['1', '2', 'UNK']),
+                   rng.choice(['IM', 'SYR', 'OT', '']), rng.choice(['LA', 'RA', 'AR', '']), name]
+
+# Random texts of the given numbers of words, drawn in one go
+def get_texts(rng, word_counts):
+    drawn = np.array(words, dtype=object)[rng.integers(0, len(words), int(word_counts.sum()))]
+    ends = np.cumsum(word_counts)
+    return [' '.join(drawn[end - count:end]) for count, end in zip(word_counts, ends)]
+
+# Write the rows as a latin-1 CSV like the CDC files, with a malformed line after malformed_ratio of them
+def write_rows(file, columns, rows, rng, malformed_ratio):
+    malformed = 0
+    with open(file, 'w', newline='', encoding='latin-1') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            if rng.random() < malformed_ratio:
+                writer.writerow(list(row) + ['extra', 'fields'])
+                malformed = malformed + 1
+    return malformed
+
+# Run func and return the seconds it took, or its peak traced memory in MB when memory is set
+def measure(func, args, memory=False):
+    with open(os.devnull, 'w') as sink, contextlib.redirect_stdout(sink):
+        if not memory:
+            start = time.perf_counter()
+            func(*args)
+            return time.perf_counter() - start
+
+        tracemalloc.start()
+        try:
+            func(*args)
+            return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        finally:
+            tracemalloc.stop()
+
+# Run the stages of the program on the years in data_dir, the same way main does but one file at a time,
+# and return the seconds (or peak MB) of each stage summed (or maxed) over the files
+def run_stages(data_dir, work_dir, memory=False):
+    clean_dir = work_dir + 'CleanData/'
+    output_dir = work_dir + 'TotalCleanData/'
+    os.makedirs(clean_dir)
+    os.makedirs(output_dir)
+    combine = max if memory else sum
+    results = {}
+
+    # start each run without the encodings found by an earlier one
+    VAERSCleanData.encoding_cache.clear()
+    for file in os.listdir(data_dir):
+        if file.endswith('.encoding'):
+            os.remove(data_dir + file)
+
+    list_of_files = get_year_groups(data_dir, '.csv')
+    results['scrub_file'] = combine(measure(VAERSCleanData.scrub_file, (file, clean_dir), memory) for file in chain_files(list_of_files))
+
+    list_of_clean_files = get_year_groups(clean_dir, VAERSCleanData.get_clean_extension())
+    if VAERSCleanData.output_layout == 'long':
+        results['write_long_tables'] = combine(measure(VAERSCleanData.write_long_tables, (file_group, output_dir), memory) for file_group in list_of_clean_files)
+        results['append_files'] = combine(measure(VAERSCleanData.append_files, (VAERSCleanData.get_combined_file_names(list_of_clean_files, output_dir, table_name),
+                                                                                output_dir, 'TotalVAERS' + table_name), memory) for table_name in VAERSCleanData.long_table_names)
+        return results
+
+    results['combine_vax_records'] = combine(measure(VAERSCleanData.combine_vax_records, (file_group[2],), memory) for file_group in list_of_clean_files)
+    results['combine_symptoms'] = combine(measure(VAERSCleanData.combine_symptoms, (file_group[1],), memory) for file_group in list_of_clean_files)
+    results['combine_files'] = combine(measure(VAERSCleanData.combine_files, ([file_group], output_dir), memory) for file_group in list_of_clean_files)
+
+    combined_files = VAERSCleanData.get_combined_file_names(list_of_clean_files, output_dir)
+    results['append_files'] = measure(VAERSCleanData.append_files, (combined_files, output_dir), memory)
+    return results
+
+# The [DATA, SYMPTOMS, VAX] files of each generated year in a directory
+def get_year_groups(dir_name, extension):
+    prefixes = sorted({file.split('VAERS')[0] for file in os.listdir(dir_name) if file.endswith('VAERSDATA' + extension)})
+    return [[dir_name + prefix + name + extension for name in ['VAERSDATA', 'VAERSSYMPTOMS', 'VAERSVAX']] for prefix in prefixes]
+
+def chain_files(list_of_files):
+    return [file for file_group in list_of_files for file in file_group]
+
+def get_dir_size(dir_name):
+    return sum(os.path.getsize(dir_name + file) for file in os.listdir(dir_name))
+
+# Generate each size, run the stages on it once for time and once for memory, and collect the results
+def run_benchmark(sizes, years=2, seed=0, memory=True, work_dir=None, **generator_options):
+    results = []
+    base_dir = tempfile.mkdtemp(prefix='VAERSBenchmark', dir=work_dir)
+    try:
+        for rows in sizes:
+            data_dir = base_dir + '/' + str(rows) + '/Data/'
+            os.makedirs(data_dir)
+            malformed = 0
+            for i in range(years):
+                prefix = str(2019 + i)
+                _, counts = generate_year(data_dir, prefix, rows, first_id=1000000 * (i + 1), seed=seed + i, **generator_options)
+                malformed = malformed + sum(counts)
+
+            seconds = run_stages(data_dir, base_dir + '/' + str(rows) + '/time/')
+            peak_mb = run_stages(data_dir, base_dir + '/' + str(rows) + '/memory/', memory=True) if memory else {}
+            for stage in seconds:
+                results.append({'rows': rows, 'years': years, 'stage': stage, 'seconds': round(seconds[stage], 4),
+                                'peak_mb': round(peak_mb[stage], 2) if stage in peak_mb else None,
+                                'input_mb': round(get_dir_size(data_dir) / (1024 * 1024), 2), 'malformed_lines': malformed})
+                print(str(rows) + ' rows, ' + stage + ': ' + str(round(seconds[stage], 3)) + ' s'
+                      + (', ' + str(round(peak_mb[stage], 1)) + ' MB peak' if stage in peak_mb else ''))
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+    return results
+
+# The report written to JSON: the results with what is needed to compare them across commits and machines
+def get_report(results, generator_options):
+    return {'created': datetime.now().isoformat(timespec='seconds'),
+            'commit': get_git_commit(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'settings': {name: value for name, value in VAERSCleanData.get_settings().items() if not name.endswith('_name')},
+            'generator': generator_options,
+            'results': results}
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Print the time and memory of each stage and size relative to an earlier report
+def compare_reports(old_report, new_report):
+    old_results = {(result['rows'], result['stage']): result for result in old_report['results']}
+    print('comparing with ' + str(old_report.get('commit')) + ' from ' + old_report['created'])
+    for result in new_report['results']:
+        old = old_results.get((result['rows'], result['stage']))
+        if old is None:
+            continue
+        line = str(result['rows']) + ' rows, ' + result['stage'] + ': time x' + get_ratio(result['seconds'], old['seconds'])
+        if result['peak_mb'] is not None and old['peak_mb'] is not None:
+            line = line + ', memory x' + get_ratio(result['peak_mb'], old['peak_mb'])
+        print(line)
+
+def get_ratio(new, old):
+    return str(round(new / old, 2)) if old else 'n/a'
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the VAERSCleanData stages on generated data. Other arguments are passed to VAERSCleanData.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='reports per generated year')
+    parser.add_argument('--years', type=int, default=2, help='generated years for each size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--multi-vax-ratio', type=float, default=0.1)
+    parser.add_argument('--multi-symptom-ratio', type=float, default=0.1)
+    parser.add_argument('--long-text-ratio', type=float, default=0.01)
+    parser.add_argument('--malformed-ratio', type=float, default=0.001)
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run, it is several times slower than the timed run')
+    parser.add_argument('--work-dir', default=None, help='directory for the generated files, the system temp directory by default')
+    parser.add_argument('--report', default='VAERSBenchmark.json', help='JSON file for the results')
+    parser.add_argument('--compare', default=None, help='earlier JSON report to compare the results with')
+    return parser.parse_known_args(args)
+
+def main():
+    parsed, program_args = parse_arguments()
+    VAERSCleanData.parse_arguments(program_args)
+    generator_options = {'multi_vax_ratio': parsed.multi_vax_ratio, 'multi_symptom_ratio': parsed.multi_symptom_ratio,
+                         'long_text_ratio': parsed.long_text_ratio, 'malformed_ratio': parsed.malformed_ratio}
+
+    results = run_benchmark(parsed.sizes, parsed.years, parsed.seed, not parsed.no_memory, parsed.work_dir, **generator_options)
+    report = get_report(results, dict(generator_options, seed=parsed.seed))
+    with open(parsed.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('report written to ' + parsed.report)
+
+    if parsed.compare is not None:
+        with open(parsed.compare) as f:
+            compare_reports(json.load(f), report)
+
+if __name__ == '__main__':
+    main()
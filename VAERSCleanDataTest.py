@@ -19,10 +19,33 @@ from datetime import datetime
 import unittest
 from pyfakefs.fake_filesystem_unittest import TestCase
 import VAERSCleanData
+import VAERSCleanDataBenchmark
 import os
 import pandas as pd
 import fsspec
 import numpy as np
+import json
+import importlib.util
+import tempfile
+import zipfile
+import gzip
+import shutil
+
+# Write the clean DATA, SYMPTOMS and VAX files of a small 2021 into dir_name and return them. 128 and 129 have no
+# vaccine, 105 has two and 117 has seven symptoms over two rows
+def write_clean_year(dir_name):
+    data = 'VAERS_ID,AGE_YRS\n' + ''.join(str(id) + ',' + str(id % 90) + '\n' for id in range(100, 130))
+    symptoms = 'VAERS_ID,SYMPTOM1,SYMPTOMVERSION1,SYMPTOM2,SYMPTOMVERSION2,SYMPTOM3,SYMPTOMVERSION3,SYMPTOM4,SYMPTOMVERSION4,SYMPTOM5,SYMPTOMVERSION5\n'
+    symptoms = symptoms + ''.join(str(id) + ',Pain,23.1,Rash,23.1,,,,,,\n' for id in range(129, 99, -1)) + '117,Fever,23.1,Chills,23.1,Nausea,23.1,Cough,23.1,Headache,23.1\n'
+    vax = 'VAERS_ID,VAX_TYPE,VAX_MANU,VAX_LOT,VAX_DOSE_SERIES,VAX_ROUTE,VAX_SITE,VAX_NAME\n'
+    vax = vax + ''.join(str(id) + ',FLU4,SANOFI,,1,IM,LA,FLU\n' for id in range(100, 128)) + '105,VARZOS,GSK,,2,IM,RA,ZOSTER\n'
+    os.makedirs(dir_name)
+    file_group = []
+    for name, text in [('2021VAERSDATA.csv', data), ('2021VAERSSYMPTOMS.csv', symptoms), ('2021VAERSVAX.csv', vax)]:
+        with open(dir_name + name, 'w') as f:
+            f.write(text)
+        file_group.append(dir_name + name)
+    return file_group
 
 class VAERSCleanDataTest(TestCase):
 
@@ -35,6 +58,7 @@ class VAERSCleanDataTest(TestCase):
         VAERSCleanData.begin_year = 2019
         VAERSCleanData.stop_year = 2020 
         VAERSCleanData.non_domestic_flag = True
+        VAERSCleanData.encoding_cache.clear()
 
     def tearDown(self):
         pass
@@ -125,6 +149,124 @@ class VAERSCleanDataTest(TestCase):
                 self.fail(item[1])
 
 
+    def test_scrub_file_chunked(self):
+        out_dir = 'C://fake_dir/'
+        os.makedirs(out_dir + 'chunked')
+        in_file = './TestData/Data/testOther.csv'
+
+        VAERSCleanData.scrub_file(in_file, out_dir)
+        VAERSCleanData.chunk_size = 3
+        try:
+            VAERSCleanData.scrub_file(in_file, out_dir + 'chunked/')
+        finally:
+            VAERSCleanData.chunk_size = None
+
+        with open(out_dir + 'testOther.csv', 'r') as f, open(out_dir + 'chunked/testOther.csv', 'r') as f_chunked:
+            self.assertEqual(f.read(), f_chunked.read())
+        self.assertEqual(['line 13'], VAERSCleanData.bad_lines_by_file[in_file])
+
+    def test_scrub_dataframe(self):
+        dataframe = pd.DataFrame({'A': ['a@b', 'x-y;z', ''], 'B': ['it\'s', '"#1"', 'a & b ~ c:d']})
+        result = VAERSCleanData.scrub_dataframe(dataframe)
+        self.assertEqual(['aatb', 'xminusysemicolonz', ''], result['A'].to_list())
+        self.assertEqual(['itquotes', 'quotehashtag1quote', 'a and b   ccolond'], result['B'].to_list())
+
+    def test_scrub_dataframe_custom_replacements(self):
+        dataframe = pd.DataFrame({'A': ['a\x00b', 'N/A']})
+        result = VAERSCleanData.scrub_dataframe(dataframe, [('/', ' slash '), ('N slash A', 'NA')])
+        self.assertEqual(['a\x00b', 'NA'], result['A'].to_list()) # separator in the data falls back to value by value
+
+    def test_read_csv_file_bad_lines(self):
+        os.makedirs('C://fake_dir')
+        file_path = 'C://fake_dir/bad_lines.csv'
+        with open(file_path, 'w') as f:
+            f.write('VAERS_ID,A,B\n1,x,y\n2,x,y,z\n3,x,y\n4,a,b,c,d\n')
+
+        for engine in ['python', 'c']:
+            dataframe = VAERSCleanData.read_csv_file(file_path, engine=engine, dtype=str, na_filter=False)
+            self.assertEqual(['1', '3'], dataframe['VAERS_ID'].to_list(), engine)
+            self.assertEqual(['line 3', 'line 5'], VAERSCleanData.bad_lines_by_file[file_path], engine)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_read_csv_file_bad_lines_pyarrow(self):
+        os.makedirs('C://fake_dir')
+        file_path = 'C://fake_dir/bad_lines.csv'
+        with open(file_path, 'w') as f:
+            f.write('VAERS_ID,A,B\n1,x,\n2,x,y,z\n3,x,y\n')
+
+        dataframe = VAERSCleanData.read_csv_file(file_path, engine='pyarrow', dtype=str, na_filter=False)
+        self.assertEqual(['1', '3'], dataframe['VAERS_ID'].to_list())
+        self.assertEqual('', dataframe['B'][0])
+        self.assertEqual(['row 2,x,y,z'], VAERSCleanData.bad_lines_by_file[file_path])
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_table_writer_parquet_chunks(self):
+        os.makedirs('C://fake_dir')
+        file_path = 'C://fake_dir/2019VAERSVAX.parquet'
+        writer = VAERSCleanData.TableWriter(file_path)
+        writer.write(pd.DataFrame({'VAERS_ID': ['1', '1'], 'VAX_TYPE': ['FLU4', 'VARZOS']}).set_index('VAERS_ID'))
+        writer.write(pd.DataFrame({'VAERS_ID': ['2'], 'VAX_TYPE': ['']}).set_index('VAERS_ID'))
+        writer.close()
+
+        self.assertEqual(['VAERS_ID', 'VAX_TYPE'], VAERSCleanData.get_table_columns(file_path))
+        VAERSCleanData.combine_vax_records(file_path)
+        dataframe = VAERSCleanData.read_table_file(file_path, columns=['VAERS_ID', 'VAX_TYPE_1', 'VAX_TYPE_2'])
+        self.assertEqual(['1', '2'], dataframe['VAERS_ID'].to_list())
+        self.assertEqual(['VARZOS', ''], dataframe['VAX_TYPE_2'].to_list())
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_scrub_file_feather(self):
+        out_dir = 'C://fake_dir/'
+        os.makedirs(out_dir)
+        VAERSCleanData.intermediate_format = 'feather'
+        try:
+            VAERSCleanData.scrub_file('./TestData/Data/testOther.csv', out_dir)
+        finally:
+            VAERSCleanData.intermediate_format = 'csv'
+
+        self.assertFalse(os.path.exists(out_dir + 'testOther.csv'))
+        dataframe = VAERSCleanData.read_table_file(out_dir + 'testOther.feather')
+        self.assertEqual('VAERS_ID', dataframe.columns[0])
+        self.assertFalse(dataframe.apply(lambda col: col.str.contains('@')).any().any())
+
+    def test_table_writer_gzip_blocks(self):
+        os.makedirs('C://fake_dir')
+        file_path = 'C://fake_dir/2019VAERSVAX.csv.gz'
+        dataframe = pd.DataFrame({'VAERS_ID': [str(i) for i in range(1000)], 'VAX_TYPE': ['FLU4'] * 1000}).set_index('VAERS_ID')
+        block_size = VAERSCleanData.compression_block_size
+        VAERSCleanData.compression_block_size = 1000 # several gzip members
+        try:
+            writer = VAERSCleanData.TableWriter(file_path)
+            writer.write(dataframe.iloc[:600])
+            writer.write(dataframe.iloc[600:])
+            writer.close()
+        finally:
+            VAERSCleanData.compression_block_size = block_size
+
+        with open(file_path, 'rb') as f:
+            self.assertEqual(dataframe.to_csv(), gzip.decompress(f.read()).decode('utf-8'))
+        self.assertEqual('csv', VAERSCleanData.get_table_format(file_path))
+        self.assertEqual(['VAERS_ID', 'VAX_TYPE'], VAERSCleanData.get_table_columns(file_path))
+        self.assertEqual(1000, len(VAERSCleanData.read_table_file(file_path, dtype=str, na_filter=False)))
+
+    def test_scrub_and_append_files_gzip(self):
+        out_dir = 'C://fake_dir/'
+        os.makedirs(out_dir)
+        in_file = './TestData/Data/testOther.csv'
+        VAERSCleanData.scrub_file(in_file, out_dir)
+        VAERSCleanData.compression = 'gzip'
+        try:
+            VAERSCleanData.scrub_file(in_file, out_dir)
+            VAERSCleanData.append_files([out_dir + 'testOther.csv.gz'], out_dir)
+        finally:
+            VAERSCleanData.compression = None
+
+        with open(out_dir + 'testOther.csv', 'rb') as f, gzip.open(out_dir + 'testOther.csv.gz') as f_gzip:
+            self.assertEqual(f.read(), f_gzip.read())
+        total = VAERSCleanData.read_table_file(out_dir + 'TotalVAERSData.csv.gz', dtype=str, na_filter=False)
+        scrubbed = VAERSCleanData.read_table_file(out_dir + 'testOther.csv', dtype=str, na_filter=False)
+        pd.testing.assert_frame_equal(scrubbed, total)
+
     def test_append_files_single(self):
         out_dir = 'C://fake_dir/'
         in_files = ['./TestData/CleanData/2019VAERSDATA.csv']
@@ -141,6 +283,27 @@ class VAERSCleanDataTest(TestCase):
         self.assertTrue(os.path.exists('C://fake_dir/TotalVAERSData.csv'))
         #TODO make sure data is there
 
+    def test_append_files_union_columns(self):
+        out_dir = 'C://fake_dir/'
+        os.makedirs(out_dir)
+        with open(out_dir + '2019VAERS.csv', 'w') as f:
+            f.write('VAERS_ID,STATE,SYMPTOM1,SYMPTOMVERSION1,VAX_TYPE_1\n1,CA,Pain,22.1,FLU4\n2,,Fever,22.1,VARZOS\n')
+        with open(out_dir + '2020VAERS.csv', 'w') as f:
+            f.write('VAERS_ID,STATE,SYMPTOM1,SYMPTOMVERSION1,SYMPTOM2,SYMPTOMVERSION2,VAX_TYPE_1\n3,TX,Pain,23.0,Rash,23.0,COVID19\n')
+
+        VAERSCleanData.chunk_size = 1
+        try:
+            VAERSCleanData.append_files([out_dir + '2019VAERS.csv', out_dir + '2020VAERS.csv'], out_dir)
+        finally:
+            VAERSCleanData.chunk_size = None
+
+        with open(out_dir + 'TotalVAERSData.csv', 'r') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(['VAERS_ID,STATE,SYMPTOM1,SYMPTOMVERSION1,SYMPTOM2,SYMPTOMVERSION2,VAX_TYPE_1',
+                          '1,CA,Pain,22.1,,,FLU4',
+                          '2,,Fever,22.1,,,VARZOS',
+                          '3,TX,Pain,23.0,Rash,23.0,COVID19'], lines)
+
     def test_combine_files(self):
         out_dir = 'C://fake_dir/'
         in_files = [['./TestData/CleanData/2019VAERSDATA.csv','./TestData/CleanData/2019VAERSSYMPTOMS.csv','./TestData/CleanData/2019VAERSVAX.csv'],['./TestData/CleanData/NonDomesticVAERSDATA.csv','./TestData/CleanData/NonDomesticVAERSSYMPTOMS.csv','./TestData/CleanData/NonDomesticVAERSVAX.csv']]
@@ -161,195 +324,128 @@ class VAERSCleanDataTest(TestCase):
         #self.assertEqual()
         #TODO make sure data is there
 
+    def test_combine_shards_matches_combine_files(self):
+        serial_group = write_clean_year('C://fake_dir/serial/')
+        sharded_group = write_clean_year('C://fake_dir/sharded/')
+        VAERSCleanData.combine_vax_records(serial_group[2])
+        VAERSCleanData.combine_symptoms(serial_group[1])
+        VAERSCleanData.combine_files([serial_group], 'C://fake_dir/serial/')
+
+        VAERSCleanData.split_year(sharded_group, 3)
+        for shard_group in VAERSCleanData.get_shard_file_groups(sharded_group, 3):
+            VAERSCleanData.combine_shard(shard_group)
+        VAERSCleanData.concat_shards(sharded_group, 3, 'C://fake_dir/sharded/')
+
+        with open('C://fake_dir/serial/2021VAERS.csv') as f, open('C://fake_dir/sharded/2021VAERS.csv') as f_sharded:
+            self.assertEqual(f.read(), f_sharded.read())
+        self.assertEqual([], os.listdir('C://fake_dir/sharded/shards/0'))
+
+    def test_write_long_tables(self):
+        file_group = write_clean_year('C://fake_dir/')
+        VAERSCleanData.write_long_tables(file_group, 'C://fake_dir/')
+
+        reports = pd.read_csv('C://fake_dir/2021VAERSReports.csv', dtype=str)
+        vaccines = pd.read_csv('C://fake_dir/2021VAERSReportVaccines.csv', dtype=str, keep_default_na=False)
+        symptoms = pd.read_csv('C://fake_dir/2021VAERSReportSymptoms.csv', dtype=str)
+        self.assertEqual([str(id) for id in range(100, 128)], reports['VAERS_ID'].to_list())
+        self.assertEqual(['VAERS_ID', 'VAX_NUMBER', 'VAX_TYPE', 'VAX_MANU', 'VAX_LOT', 'VAX_DOSE_SERIES', 'VAX_ROUTE', 'VAX_SITE', 'VAX_NAME'], vaccines.columns.to_list())
+        self.assertEqual([('105', '1', 'FLU4'), ('105', '2', 'VARZOS')], list(vaccines.loc[vaccines['VAERS_ID'] == '105', ['VAERS_ID', 'VAX_NUMBER', 'VAX_TYPE']].itertuples(index=False, name=None)))
+        self.assertEqual(['Pain', 'Rash', 'Fever', 'Chills', 'Nausea', 'Cough', 'Headache'], symptoms.loc[symptoms['VAERS_ID'] == '117', 'SYMPTOM'].to_list())
+        self.assertEqual([str(number) for number in range(1, 8)], symptoms.loc[symptoms['VAERS_ID'] == '117', 'SYMPTOM_NUMBER'].to_list())
+
+        # the same reports, vaccines and symptoms as the wide file
+        VAERSCleanData.combine_vax_records(file_group[2])
+        VAERSCleanData.combine_symptoms(file_group[1])
+        VAERSCleanData.combine_files([file_group], 'C://fake_dir/')
+        wide = pd.read_csv('C://fake_dir/2021VAERS.csv', dtype=str, keep_default_na=False)
+        wide_vaccines = VAERSCleanData.unpivot_columns(wide, ['VAX_TYPE', 'VAX_MANU', 'VAX_LOT', 'VAX_DOSE_SERIES', 'VAX_ROUTE', 'VAX_SITE', 'VAX_NAME'], '_', 'VAX_NUMBER')
+        self.assertEqual(wide_vaccines.astype(str).values.tolist(), vaccines.values.tolist())
+        self.assertEqual(len(VAERSCleanData.unpivot_columns(wide, ['SYMPTOM', 'SYMPTOMVERSION'], '', 'SYMPTOM_NUMBER')), len(symptoms))
+
+    def test_join_frames(self):
+        data = pd.DataFrame({'VAERS_ID': ['3', '1', '2', '4'], 'STATE': ['TX', 'CA', '', 'NY']})
+        symptoms = pd.DataFrame({'VAERS_ID': ['1', '2', '3'], 'SYMPTOM1': ['Pain', 'Fever', 'Rash']})
+        vax = pd.DataFrame({'VAERS_ID': ['2', '3', '1', '5'], 'VAX_TYPE_1': ['VARZOS', 'COVID19', 'FLU4', 'HPV9']})
+
+        dataframe, dropped = VAERSCleanData.join_frames([data, symptoms, vax])
+        self.assertEqual(['3', '1', '2'], dataframe.index.to_list())
+        self.assertEqual(['STATE', 'SYMPTOM1', 'VAX_TYPE_1'], dataframe.columns.to_list())
+        self.assertEqual(['TX', 'Rash', 'COVID19'], dataframe.loc['3'].to_list())
+        self.assertEqual([1, 0, 1], dropped)
+
+        # IDs that are not plain integers use the string merge and give the same result
+        merged, merged_dropped = VAERSCleanData.merge_frames([data, symptoms, vax])
+        self.assertTrue(dataframe.equals(merged))
+        self.assertEqual(dropped, merged_dropped)
+        self.assertIsNone(VAERSCleanData.get_integer_keys(pd.DataFrame({'VAERS_ID': ['01', '1']})))
+        self.assertIsNone(VAERSCleanData.get_integer_keys(pd.DataFrame({'VAERS_ID': ['1', 'A']})))
+
+    def test_apply_schema(self):
+        os.makedirs('C://fake_dir')
+        text = pd.DataFrame({'VAERS_ID': ['916600', '916601', '916602'], 'RECVDATE': ['01/01/2021', '', '12/31/2021'],
+                             'AGE_YRS': ['33.0', '0.5', ''], 'NUMDAYS': ['0', '', '12'], 'ONSET_DATE': ['1/1/2021', '', ''],
+                             'VAX_TYPE_1': ['COVID19', 'FLU4', 'COVID19'], 'VAX_LOT_1': ['EL3248', '', '']})
+        typed = VAERSCleanData.apply_schema(text.copy())
+        self.assertEqual('Int64', typed['VAERS_ID'].dtype)
+        self.assertTrue(pd.api.types.is_datetime64_any_dtype(typed['RECVDATE']))
+        self.assertEqual('float64', typed['AGE_YRS'].dtype)
+        self.assertEqual('Int64', typed['NUMDAYS'].dtype)
+        self.assertEqual('category', typed['VAX_TYPE_1'].dtype)
+        # dates without the leading zeros would not be written back the same, so they stay text
+        self.assertEqual(object, typed['ONSET_DATE'].dtype)
+        self.assertEqual(object, typed['VAX_LOT_1'].dtype)
+
+        VAERSCleanData.write_table_file(text.set_index('VAERS_ID'), 'C://fake_dir/text.csv')
+        VAERSCleanData.write_table_file(typed.set_index('VAERS_ID'), 'C://fake_dir/typed.csv')
+        with open('C://fake_dir/text.csv') as f_text, open('C://fake_dir/typed.csv') as f_typed:
+            self.assertEqual(f_text.read(), f_typed.read())
+
     def test_combine_symptoms(self):
-        pass
-        # VAERSCleanData.combine_symptoms('./TestData/CleanData/2019VAERSSYMPTOMS.csv') TODO make sure call doesn't overwrite test data
-        # expect headers 
-        # expect no duplicates
-        # expect data to be there
-
-        #     def combine_symptoms(file):
-        # additional_headers = ['SYMPTOM6', 'SYMPTOMVERSION6',
-        #                     'SYMPTOM7', 'SYMPTOMVERSION7',
-        #                     'SYMPTOM8', 'SYMPTOMVERSION8',
-        #                     'SYMPTOM9', 'SYMPTOMVERSION9',
-        #                     'SYMPTOM10', 'SYMPTOMVERSION10',
-        #                     'SYMPTOM11', 'SYMPTOMVERSION11',
-        #                     'SYMPTOM12', 'SYMPTOMVERSION12',
-        #                     'SYMPTOM13', 'SYMPTOMVERSION13',
-        #                     'SYMPTOM14', 'SYMPTOMVERSION14',
-        #                     'SYMPTOM15', 'SYMPTOMVERSION15',
-        #                     'SYMPTOM16', 'SYMPTOMVERSION16',
-        #                     'SYMPTOM17', 'SYMPTOMVERSION17',
-        #                     'SYMPTOM18', 'SYMPTOMVERSION19',
-        #                     'SYMPTOM20', 'SYMPTOMVERSION20',
-        #                     'SYMPTOM21', 'SYMPTOMVERSION21',
-        #                     'SYMPTOM22', 'SYMPTOMVERSION22',
-        #                     'SYMPTOM23', 'SYMPTOMVERSION23',
-        #                     'SYMPTOM24', 'SYMPTOMVERSION24',
-        #                     'SYMPTOM25', 'SYMPTOMVERSION25',
-        #                     'SYMPTOM26', 'SYMPTOMVERSION26',
-        #                     'SYMPTOM27', 'SYMPTOMVERSION27',
-        #                     'SYMPTOM28', 'SYMPTOMVERSION28',
-        #                     'SYMPTOM29', 'SYMPTOMVERSION29',
-        #                     'SYMPTOM30', 'SYMPTOMVERSION30',
-        #                     'SYMPTOM31', 'SYMPTOMVERSION31',
-        #                     'SYMPTOM32', 'SYMPTOMVERSION32',
-        #                     'SYMPTOM33', 'SYMPTOMVERSION33',
-        #                     'SYMPTOM34', 'SYMPTOMVERSION34',
-        #                     'SYMPTOM35', 'SYMPTOMVERSION35']
-        
-        # df = pd.read_csv(file, engine='python', on_bad_lines='skip', encoding=file_encoding, dtype=str, na_filter=False) #drop records with errors
-        # # get a unique list of the IDs
-        # id_list = list(df['VAERS_ID'])
-        # id_list = list(dict.fromkeys(id_list)) 
-        # # add the new headers to support 25 symptoms per record
-        # new_columns = df.columns.values  
-        # new_columns = np.append(new_columns,additional_headers)      
-        # df_out = pd.DataFrame(columns=new_columns)
-        # out_rows = pd.DataFrame(columns=new_columns)
-        # in_rows = pd.DataFrame()
-        # # for each record, write the row if it's the only one found for that ID. Otherwise combine the rows TODO find more effiecent
-        # for record in id_list:
-        #     in_rows = df.loc[df['VAERS_ID'] == record]         
-        #     in_rows.set_index("VAERS_ID", inplace=True) 
-        #     count = 0  
-        #     out_rows = pd.DataFrame(columns=new_columns) 
-        #     out_rows.set_index("VAERS_ID", inplace=True)   
-        #     for index, row in in_rows.iterrows(): 
-        #         if count == 0:
-        #             out_rows.at[record,'VAERS_ID'] = record
-        #             out_rows.at[record,'SYMPTOM1'] = in_rows.iat[0,0]
-        #             out_rows.at[record,'SYMPTOMVERSION1'] = in_rows.iat[0,1]
-        #             out_rows.at[record,'SYMPTOM2'] = in_rows.iat[0,2]
-        #             out_rows.at[record,'SYMPTOMVERSION2'] = in_rows.iat[0,3]
-        #             out_rows.at[record,'SYMPTOM3'] = in_rows.iat[0,4]
-        #             out_rows.at[record,'SYMPTOMVERSION3'] = in_rows.iat[0,5]
-        #             out_rows.at[record,'SYMPTOM4'] = in_rows.iat[0,6]                
-        #             out_rows.at[record,'SYMPTOMVERSION4'] = in_rows.iat[0,7]
-        #             out_rows.at[record,'SYMPTOM5'] = in_rows.iat[0,8]                
-        #             out_rows.at[record,'SYMPTOMVERSION5'] = in_rows.iat[0,9]
-        #         else:
-        #             if count == 1:
-        #                 header_range = range(6,10)
-        #                 start_index = 6
-        #             elif count == 2:
-        #                 header_range = range(11,15)
-        #                 start_index = 11
-        #             elif count == 3:
-        #                 header_range = range(16,20)
-        #                 start_index = 16
-        #             elif count == 4:
-        #                 header_range = range(21,25)
-        #                 start_index = 21
-        #             elif count == 5:
-        #                 header_range = range(26,30)
-        #                 start_index = 26
-        #             elif count == 6:
-        #                 header_range = range(31,35)
-        #                 start_index = 31
-        #             else:
-        #                 print('error - more than 35 symptoms for this id ' + str(record))
-
-        #             # map the five symptoms from the current record to the combined record
-        #             for i in header_range:
-        #                 symptom_header = 'SYMPTOM' + str(i)
-        #                 version_header = 'SYMPTOMVERSION' + str(i)
-
-        #                 # get the indices to map it to
-        #                 if i == start_index:
-        #                     symptom_location = 0
-        #                     version_location = 1
-
-        #                 # combine the data for record to be writen to the new file
-        #                 new_symptom = in_rows.iat[count,symptom_location]
-        #                 new_version = in_rows.iat[count,version_location]                 
-        #                 out_rows.at[record,symptom_header] = new_symptom
-        #                 out_rows.at[record,version_header] = new_version
-                        
-        #                 symptom_location += 2
-        #                 version_location += 2
-
-        #         count += 1 
-
-        #     pd.concat([df_out, out_rows], ignore_index=True) #append
-
-        # df_out.set_index("VAERS_ID", inplace=True) 
-        # df_out.to_csv(file) 
+        file = './TestData/Data/NonDomesticVAERSSYMPTOMS.csv'
+        VAERSCleanData.combine_symptoms(file)
+
+        dataframe = pd.read_csv(file, dtype=str, na_filter=False)
+        self.assertEqual(['874013', '875102', '876031'], dataframe['VAERS_ID'].to_list()) # one row per id, in file order
+        self.assertEqual(dataframe.columns[-1], 'SYMPTOMVERSION62') # 875102 has 62 symptoms
+        record = dataframe.set_index('VAERS_ID').loc['876031']
+        self.assertEqual(record['SYMPTOM5'], 'Dizziness')
+        self.assertEqual(record['SYMPTOM6'], 'Dyspnoea')
+        self.assertEqual(record['SYMPTOMVERSION16'], '23')
+        self.assertEqual(record['SYMPTOM17'], '')
+
+    def test_flatten_symptoms(self):
+        df = pd.DataFrame({'VAERS_ID': ['1', '2', '1'],
+                           'SYMPTOM1': ['a', 'c', 'f'], 'SYMPTOMVERSION1': ['23', '23', '23'],
+                           'SYMPTOM2': ['b', 'd', ''], 'SYMPTOMVERSION2': ['23', '23', ''],
+                           'SYMPTOM3': ['', 'e', ''], 'SYMPTOMVERSION3': ['', '23', ''],
+                           'SYMPTOM4': ['', '', ''], 'SYMPTOMVERSION4': ['', '', ''],
+                           'SYMPTOM5': ['', '', ''], 'SYMPTOMVERSION5': ['', '', '']})
+        long_df = VAERSCleanData.flatten_symptoms(df)
+        self.assertEqual(['1', '1', '2', '2', '2', '1'], long_df['VAERS_ID'].to_list())
+        self.assertEqual(['a', 'b', 'c', 'd', 'e', 'f'], long_df['SYMPTOM'].to_list())
+
+        df_out = VAERSCleanData.pivot_symptoms(df)
+        self.assertEqual(['a', 'b', 'f', ''], df_out.loc['1', ['SYMPTOM1', 'SYMPTOM2', 'SYMPTOM3', 'SYMPTOM4']].to_list())
 
     def test_combine_vax_records(self):
-        pass
-        # VAERSCleanData.combine_vax_records('./TestData/CleanData/NonDomesticVAERSVAX.csv') TODO make sure call doesn't overwrite test data
-        # expect headers 
-        # expect no duplicates
-        # expect data to be there
-
-        # def combine_vax_records(file):
-        # print('processing ' + file)
-        # headers = ['VAERS_ID', 'VAX_TYPE_1', 'VAX_MANU_1', 'VAX_LOT_1', 'VAX_DOSE_SERIES_1','VAX_ROUTE_1', 'VAX_SITE_1', 'VAX_NAME_1',
-        #            'VAX_TYPE_2', 'VAX_MANU_2', 'VAX_LOT_2', 'VAX_DOSE_SERIES_2','VAX_ROUTE_2', 'VAX_SITE_2', 'VAX_NAME_2',
-        #            'VAX_TYPE_3', 'VAX_MANU_3', 'VAX_LOT_3', 'VAX_DOSE_SERIES_3','VAX_ROUTE_3', 'VAX_SITE_3', 'VAX_NAME_3',
-        #            'VAX_TYPE_4', 'VAX_MANU_4', 'VAX_LOT_4', 'VAX_DOSE_SERIES_4','VAX_ROUTE_4', 'VAX_SITE_4', 'VAX_NAME_4',
-        #            'VAX_TYPE_5', 'VAX_MANU_5', 'VAX_LOT_5', 'VAX_DOSE_SERIES_5','VAX_ROUTE_5', 'VAX_SITE_5', 'VAX_NAME_5',
-        #            'VAX_TYPE_6', 'VAX_MANU_6', 'VAX_LOT_6', 'VAX_DOSE_SERIES_6','VAX_ROUTE_6', 'VAX_SITE_6', 'VAX_NAME_6']
-
-        # df_out = pd.DataFrame(columns=headers)
-        # file_encoding = get_file_encoding(file)
-        # df = pd.read_csv(file, engine='python', on_bad_lines='skip', encoding=file_encoding, dtype=str, na_filter=False) #drop records with errors  
-            
-        # # get a unique list of the IDs
-        # id_list = list(df['VAERS_ID'])
-        # id_list = list(dict.fromkeys(id_list)) 
-
-        # in_rows = pd.DataFrame()    
-        # # for each record, write the row if it's the only one found for that ID. Otherwise combine the rows
-        # for record in id_list:
-        #     out_rows = pd.DataFrame(columns=headers)
-        #     in_rows = df.loc[df['VAERS_ID'] == record] 
-        #     in_rows.set_index("VAERS_ID", inplace=True)
-        #     count = 1
-        #     for index, row in in_rows.iterrows(): 
-        #         if count == 1:
-        #             out_rows.at[record,'VAERS_ID'] = record
-        #             out_rows.at[record,'VAX_TYPE_1'] = in_rows.iat[0,0]
-        #             out_rows.at[record,'VAX_MANU_1'] = in_rows.iat[0,1]
-        #             out_rows.at[record,'VAX_LOT_1'] = in_rows.iat[0,2]
-        #             out_rows.at[record,'VAX_DOSE_SERIES_1'] = in_rows.iat[0,3]
-        #             out_rows.at[record,'VAX_ROUTE_1'] = in_rows.iat[0,4]
-        #             out_rows.at[record,'VAX_SITE_1'] = in_rows.iat[0,5]
-        #             out_rows.at[record,'VAX_NAME_1'] = in_rows.iat[0,6]
-        #             df_out = pd.concat([df_out,out_rows], ignore_index=True) #append
-        #         else:
-        #             if count > 6:
-        #                 print('error - more than 6 vaccines for this id ' + str(record))
-        #             else:
-        #                 # map the current record to the combined record
-        #                 str_count = str(count)
-        #                 vax_type = 'VAX_TYPE_' + str_count
-        #                 vax_manu = 'VAX_MANU_' + str_count
-        #                 vax_lot = 'VAX_LOT_' + str_count
-        #                 vax_series = 'VAX_DOSE_SERIES_' + str_count
-        #                 vax_route = 'VAX_ROUTE_' + str_count
-        #                 vax_site = 'VAX_SITE_' + str_count 
-        #                 vax_name = 'VAX_NAME_' + str_count
-
-        #                 count_index = count - 1
-        #                 location = 0
-
-        #                 # combine the data for record to be writen to the new file
-        #                 df_out.at[record,vax_type] = in_rows.iat[count_index,location]
-        #                 df_out.at[record,vax_manu] = in_rows.iat[count_index,location+1]
-        #                 df_out.at[record,vax_lot] = in_rows.iat[count_index,location+2]
-        #                 df_out.at[record,vax_series] = in_rows.iat[count_index,location+3]
-        #                 df_out.at[record,vax_route] = in_rows.iat[count_index,location+4]
-        #                 df_out.at[record,vax_site] = in_rows.iat[count_index,location+5]
-        #                 df_out.at[record,vax_name] = in_rows.iat[count_index,location+6]
-                
-        #         count += 1                
-                
-        # #change to new dataframe   
-        # df_out.set_index("VAERS_ID", inplace=True) 
-        # df_out.to_csv(file)
+        file = './TestData/Data/NonDomesticVAERSVAX.csv'
+        VAERSCleanData.combine_vax_records(file)
+
+        dataframe = pd.read_csv(file, dtype=str, na_filter=False)
+        self.assertEqual(dataframe.columns[0], 'VAERS_ID')
+        self.assertEqual(dataframe.columns[-1], 'VAX_NAME_6')
+        self.assertEqual(['874013', '875102', '876031'], dataframe['VAERS_ID'].to_list()) # one row per id, in file order
+        record = dataframe.set_index('VAERS_ID').loc['876031']
+        self.assertEqual(record['VAX_TYPE_1'], 'FLUX')
+        self.assertEqual(record['VAX_TYPE_2'], 'HEPAB')
+        self.assertEqual(record['VAX_LOT_3'], 'AC37B313AB')
+        self.assertEqual(record['VAX_TYPE_4'], '')
+
+    def test_pivot_vax_records_more_than_max(self):
+        df = pd.DataFrame({'VAERS_ID': ['1'] * 8, 'VAX_TYPE': [str(i) for i in range(8)]})
+        df_out = VAERSCleanData.pivot_vax_records(df)
+        self.assertEqual(['VAX_TYPE_' + str(i) for i in range(1, 7)], df_out.columns.to_list())
+        self.assertEqual(['0', '1', '2', '3', '4', '5'], df_out.loc['1'].to_list())
 
     def test_add_file_if_exists_new(self):
         expected_file_list = ['C://fake_dir/test_file.csv']
@@ -434,6 +530,31 @@ class VAERSCleanDataTest(TestCase):
             VAERSCleanData.correct_for_common_errors()
             self.assertEqual(cm.exception, VAERSCleanData.__error_stop_year_validation__)
 
+    def test_get_list_of_files_zip(self):
+        os.makedirs('C://fake_dir/Data')
+        with zipfile.ZipFile('C://fake_dir/Data/2019VAERSData.zip', 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name in ['2019VAERSDATA.csv', '2019VAERSSYMPTOMS.csv', '2019VAERSVAX.csv']:
+                archive.write('./TestData/Data/' + name, name)
+        with zipfile.ZipFile('C://fake_dir/Data/AllVAERSDataCSVS.zip', 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name in ['NonDomesticVAERSDATA.csv', 'NonDomesticVAERSSYMPTOMS.csv', 'NonDomesticVAERSVAX.csv']:
+                archive.write('./TestData/Data/' + name, 'AllVAERSDataCSVS/' + name)
+
+        list_of_files = VAERSCleanData.get_list_of_files('C://fake_dir/Data/', 2019, 2020, True)
+        self.assertEqual([['C://fake_dir/Data/2019VAERSData.zip/2019VAERSDATA.csv', 'C://fake_dir/Data/2019VAERSData.zip/2019VAERSSYMPTOMS.csv', 'C://fake_dir/Data/2019VAERSData.zip/2019VAERSVAX.csv'],
+                          ['C://fake_dir/Data/AllVAERSDataCSVS.zip/NonDomesticVAERSDATA.csv', 'C://fake_dir/Data/AllVAERSDataCSVS.zip/NonDomesticVAERSSYMPTOMS.csv', 'C://fake_dir/Data/AllVAERSDataCSVS.zip/NonDomesticVAERSVAX.csv']], list_of_files)
+
+        # members are scrubbed the same as the extracted files, with the encoding sidecar next to the archive
+        member = list_of_files[1][2]
+        self.assertEqual(os.path.getsize('./TestData/Data/NonDomesticVAERSVAX.csv'), VAERSCleanData.get_file_stat(member).st_size)
+        os.makedirs('C://fake_dir/zip')
+        os.makedirs('C://fake_dir/plain')
+        VAERSCleanData.scrub_file(member, 'C://fake_dir/zip/')
+        VAERSCleanData.scrub_file('./TestData/Data/NonDomesticVAERSVAX.csv', 'C://fake_dir/plain/')
+        with open('C://fake_dir/zip/NonDomesticVAERSVAX.csv') as zipped, open('C://fake_dir/plain/NonDomesticVAERSVAX.csv') as plain:
+            self.assertEqual(plain.read(), zipped.read())
+        self.assertTrue(os.path.exists('C://fake_dir/Data/AllVAERSDataCSVS.zip.NonDomesticVAERSVAX.csv.encoding'))
+        self.assertFalse(VAERSCleanData.input_file_exists('C://fake_dir/Data/AllVAERSDataCSVS.zip/2020VAERSVAX.csv'))
+
     def test_get_file_encoding(self):
         the_encoding = 'ascii'
         os.mkdir('C://fake_dir')
@@ -443,6 +564,43 @@ class VAERSCleanDataTest(TestCase):
         
         self.assertEqual(VAERSCleanData.get_file_encoding(file_path), the_encoding)
 
+    def test_get_file_encoding_non_ascii_after_sample(self):
+        os.makedirs('C://fake_dir')
+        file_path = 'C://fake_dir/test_file.txt'
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write('a' * 5000 + ' Guillain–Barré syndrome, réaction à la vaccination')
+        VAERSCleanData.encoding_sample_size = 1024
+        VAERSCleanData.encoding_chunk_size = 512
+        try:
+            self.assertEqual(VAERSCleanData.get_file_encoding(file_path), 'utf-8')
+        finally:
+            VAERSCleanData.encoding_sample_size = 1024 * 1024
+            VAERSCleanData.encoding_chunk_size = 64 * 1024
+
+    def test_get_file_encoding_sidecar(self):
+        os.makedirs('C://fake_dir')
+        file_path = 'C://fake_dir/test_file.txt'
+        with open(file_path, 'w', encoding='ascii') as f:
+            f.write('test')
+
+        self.assertEqual(VAERSCleanData.get_file_encoding(file_path), 'ascii')
+        with open(file_path + '.encoding', 'r') as f:
+            sidecar = json.load(f)
+        self.assertEqual(sidecar['size'], 4)
+        self.assertEqual(sidecar['encoding'], 'ascii')
+
+        # a matching sidecar is used without running detection again
+        sidecar['encoding'] = 'latin-1'
+        with open(file_path + '.encoding', 'w') as f:
+            json.dump(sidecar, f)
+        VAERSCleanData.encoding_cache.clear()
+        self.assertEqual(VAERSCleanData.get_file_encoding(file_path), 'latin-1')
+
+        # a changed file is detected again
+        with open(file_path, 'w', encoding='ascii') as f:
+            f.write('changed')
+        self.assertEqual(VAERSCleanData.get_file_encoding(file_path), 'ascii')
+
     def test_is_file_list_length_matching_true_year(self):
         file_length = 3
         name_length = 3
@@ -482,5 +640,380 @@ class VAERSCleanDataTest(TestCase):
         self.assertEqual(expected_result, result)
         
 
+    def test_is_year_up_to_date(self):
+        VAERSCleanData.clean_dir_name = 'C://fake_dir/CleanData/'
+        VAERSCleanData.output_dir_name = 'C://fake_dir/Total/'
+        os.makedirs(VAERSCleanData.clean_dir_name)
+        os.makedirs(VAERSCleanData.output_dir_name)
+        file_group = ['./TestData/Data/NonDomesticVAERSDATA.csv', './TestData/Data/NonDomesticVAERSSYMPTOMS.csv', './TestData/Data/NonDomesticVAERSVAX.csv']
+        for file in VAERSCleanData.get_year_output_files(file_group):
+            with open(file, 'w') as f:
+                f.write('VAERS_ID\n1\n')
+
+        manifest = {'years': {}}
+        self.assertFalse(VAERSCleanData.is_year_up_to_date(file_group, manifest))
+        VAERSCleanData.record_year_in_manifest(file_group, manifest)
+        VAERSCleanData.write_manifest(VAERSCleanData.output_dir_name, manifest)
+        manifest = VAERSCleanData.read_manifest(VAERSCleanData.output_dir_name)
+        self.assertTrue(VAERSCleanData.is_year_up_to_date(file_group, manifest))
+
+        VAERSCleanData.incremental = True
+        try:
+            self.assertEqual([], VAERSCleanData.get_years_to_build([file_group], manifest))
+        finally:
+            VAERSCleanData.incremental = False
+
+        # a changed output file means the year has to be rebuilt
+        with open(VAERSCleanData.output_dir_name + 'NonDomesticVAERS.csv', 'w') as f:
+            f.write('VAERS_ID\n2\n')
+        self.assertFalse(VAERSCleanData.is_year_up_to_date(file_group, manifest))
+
+    def test_run_report(self):
+        out_dir = 'C://fake_dir/'
+        os.makedirs(out_dir)
+        VAERSCleanData.run_report.clear()
+        in_file = './TestData/Data/NonDomesticVAERSVAX.csv'
+
+        VAERSCleanData.run_tasks(VAERSCleanData.scrub_file, [(in_file, out_dir)])
+        entry = VAERSCleanData.run_report[0]
+        self.assertEqual('scrub_file', entry['stage'])
+        self.assertEqual(in_file, entry['file'])
+        self.assertEqual(11, entry['rows_read'])
+        self.assertEqual(11, entry['rows_written'])
+        self.assertEqual(os.path.getsize(in_file), entry['bytes_in'])
+        self.assertEqual(os.path.getsize(out_dir + 'NonDomesticVAERSVAX.csv'), entry['bytes_out'])
+        self.assertIsNone(VAERSCleanData.stage_report)
+
+        VAERSCleanData.write_run_report(out_dir, datetime.now())
+        with open(out_dir + VAERSCleanData.run_report_name) as f:
+            report = json.load(f)
+        self.assertEqual(1, report['stages']['scrub_file']['files'])
+        self.assertEqual(11, report['stages']['scrub_file']['rows_written'])
+        self.assertEqual([entry], report['files'])
+
+    def test_profile_stage(self):
+        VAERSCleanData.output_dir_name = 'C://fake_dir/Total/'
+        os.makedirs(VAERSCleanData.output_dir_name)
+        VAERSCleanData.profile_modes = ['cpu', 'memory']
+        try:
+            VAERSCleanData.run_tasks(VAERSCleanData.scrub_file, [('./TestData/Data/NonDomesticVAERSVAX.csv', 'C://fake_dir/')])
+        finally:
+            VAERSCleanData.profile_modes = []
+
+        profile_name = 'C://fake_dir/Total/profiles/scrub_file-NonDomesticVAERSVAX.csv'
+        self.assertTrue(os.path.exists(profile_name + '.prof'))
+        with open(profile_name + '-cpu.txt') as f:
+            self.assertIn('scrub_file', f.read())
+        with open(profile_name + '-memory.txt') as f:
+            self.assertTrue(f.readline().startswith('peak traced memory: '))
+        self.assertIsNone(VAERSCleanData.stage_memory)
+        self.assertEqual('shard2-2021VAERSDATA.csv', VAERSCleanData.get_profile_file_name(VAERSCleanData.get_shard_file('C://fake_dir/clean/2021VAERSDATA.csv', 2)))
+
+    def test_pipeline_run_year(self):
+        file_group = ['./TestData/Data/NonDomesticVAERSDATA.csv', './TestData/Data/NonDomesticVAERSSYMPTOMS.csv', './TestData/Data/NonDomesticVAERSVAX.csv']
+        os.makedirs('C://fake_dir/disk/clean')
+        os.makedirs('C://fake_dir/memory/clean')
+
+        # the disk stages
+        for file in file_group:
+            VAERSCleanData.scrub_file(file, 'C://fake_dir/disk/clean/')
+        clean_group = ['C://fake_dir/disk/clean/' + file.rpartition('/')[2] for file in file_group]
+        VAERSCleanData.combine_symptoms(clean_group[1])
+        VAERSCleanData.combine_vax_records(clean_group[2])
+        VAERSCleanData.combine_files([clean_group], 'C://fake_dir/disk/')
+
+        pipeline = VAERSCleanData.VAERSPipeline()
+        dataframe = pipeline.run_year(file_group, clean_dir='C://fake_dir/memory/clean/', out_dir='C://fake_dir/memory/')
+        self.assertEqual(3, len(dataframe))
+        for file in ['NonDomesticVAERS.csv'] + ['clean/' + file.rpartition('/')[2] for file in file_group]:
+            with open('C://fake_dir/disk/' + file) as disk, open('C://fake_dir/memory/' + file) as memory:
+                self.assertEqual(disk.read(), memory.read(), file)
+
+        # nothing is written without a directory for it
+        files_before = sorted(os.listdir('C://fake_dir/memory')) + sorted(os.listdir('C://fake_dir/memory/clean'))
+        pipeline = VAERSCleanData.VAERSPipeline(max_vax_records=1, replacements=[('-', ' ')])
+        dataframe = pipeline.run_year(file_group)
+        self.assertNotIn('VAX_TYPE_2', dataframe.columns)
+        self.assertEqual(files_before, sorted(os.listdir('C://fake_dir/memory')) + sorted(os.listdir('C://fake_dir/memory/clean')))
+
+    def test_get_read_columns(self):
+        columns = ['AGE_YRS', 'SYMPTOM1', 'VAX_TYPE']
+        self.assertEqual(['VAERS_ID', 'AGE_YRS'], VAERSCleanData.get_read_columns(['VAERS_ID', 'RECVDATE', 'AGE_YRS', 'SYMPTOM_TEXT'], columns))
+        self.assertEqual(['VAERS_ID', 'SYMPTOM1', 'SYMPTOMVERSION1', 'SYMPTOM2', 'SYMPTOMVERSION2'],
+                         VAERSCleanData.get_read_columns(['VAERS_ID', 'SYMPTOM1', 'SYMPTOMVERSION1', 'SYMPTOM2', 'SYMPTOMVERSION2'], columns))
+        self.assertEqual(['VAERS_ID', 'VAX_TYPE'], VAERSCleanData.get_read_columns(['VAERS_ID', 'VAX_TYPE', 'VAX_MANU'], columns))
+
+    def test_pipeline_run_year_columns(self):
+        file_group = ['./TestData/Data/NonDomesticVAERSDATA.csv', './TestData/Data/NonDomesticVAERSSYMPTOMS.csv', './TestData/Data/NonDomesticVAERSVAX.csv']
+        dataframe = VAERSCleanData.VAERSPipeline().run_year(file_group)
+        pipeline = VAERSCleanData.VAERSPipeline(columns=['AGE_YRS', 'SYMPTOM1', 'VAX_TYPE'])
+        selected = pipeline.run_year(file_group)
+
+        self.assertEqual(['AGE_YRS', 'SYMPTOM1'] + ['VAX_TYPE_' + str(i) for i in range(1, 7)], selected.columns.to_list())
+        pd.testing.assert_frame_equal(dataframe[selected.columns], selected)
+        selected = VAERSCleanData.VAERSPipeline(columns=['AGE_YRS']).run_year(file_group)
+        self.assertEqual(['AGE_YRS'], selected.columns.to_list())
+        self.assertEqual(dataframe.index.to_list(), selected.index.to_list())
+
+    def test_filter_rows(self):
+        dataframe = pd.DataFrame({'VAERS_ID': ['1', '2', '3', '4'], 'RECVDATE': ['12/31/2020', '01/02/2021', '', '02/01/2021'],
+                                  'AGE_YRS': ['9', '10', '75', '.5'], 'STATE': ['CA', 'NY', 'TX', '']})
+        filter_ids = lambda *expressions: VAERSCleanData.filter_rows(dataframe, [VAERSCleanData.parse_filter(e) for e in expressions])['VAERS_ID'].to_list()
+        self.assertEqual(['2', '4'], filter_ids('RECVDATE >= 01/01/2021'))
+        self.assertEqual(['1', '4'], filter_ids('AGE_YRS<10')) # as numbers, not text
+        self.assertEqual(['1', '2'], filter_ids('STATE=CA,NY'))
+        self.assertEqual(['3', '4'], filter_ids('STATE!=CA,NY'))
+        self.assertEqual(['2'], filter_ids('STATE=CA,NY', 'AGE_YRS>=10', 'VAX_TYPE=COVID19')) # VAX_TYPE is left to the VAX file
+        self.assertEqual(['3'], VAERSCleanData.filter_rows(dataframe, [], ids=np.array(['3', '5']))['VAERS_ID'].to_list())
+        with self.assertRaises(VAERSCleanData.argparse.ArgumentTypeError):
+            VAERSCleanData.parse_filter('STATE~CA')
+        for expression in ['RECVDATE>=2019-01-01', 'AGE_YRS>=abc', 'NUMDAYS=1,x', 'AGE_YRS<']: # would drop every row
+            with self.assertRaises(VAERSCleanData.argparse.ArgumentTypeError):
+                VAERSCleanData.parse_filter(expression)
+        self.assertEqual(('RECVDATE', '>=', '01/01/2019'), VAERSCleanData.parse_filter('RECVDATE>=01/01/2019'))
+
+    def test_check_filter_columns(self):
+        list_of_files = [write_clean_year('C://fake_dir/2020/'), write_clean_year('C://fake_dir/2021/')]
+        with open(list_of_files[1][0], 'w') as f:
+            f.write('VAERS_ID,STATE\n100,CA\n')
+        VAERSCleanData.row_filters = [('AGE_YRS', '>=', '30')]
+        try:
+            VAERSCleanData.check_filter_columns(list_of_files[:1])
+            with self.assertRaises(SystemExit): # AGE_YRS is missing from the second year only
+                VAERSCleanData.check_filter_columns(list_of_files)
+        finally:
+            VAERSCleanData.row_filters = []
+
+    def test_check_selected_columns(self):
+        list_of_files = [write_clean_year('C://fake_dir/2021/')]
+        for columns in [['AGE_YRS', 'VAX_TYPE_1', 'SYMPTOM'], ['SYMPTOM7', 'VAX_NAME']]:
+            VAERSCleanData.selected_columns = columns
+            try:
+                VAERSCleanData.check_selected_columns(list_of_files)
+            finally:
+                VAERSCleanData.selected_columns = None
+        VAERSCleanData.selected_columns = ['AGE_YRS', 'AGE_YR']
+        try:
+            with self.assertRaises(SystemExit) as cm:
+                VAERSCleanData.check_selected_columns(list_of_files)
+        finally:
+            VAERSCleanData.selected_columns = None
+        self.assertEqual(VAERSCleanData.__error_unknown_selected_column__, cm.exception.code)
+
+    def test_pipeline_run_year_filters(self):
+        file_group = ['./TestData/Data/2020VAERSDATA.csv', './TestData/Data/2020VAERSSYMPTOMS.csv', './TestData/Data/2020VAERSVAX.csv']
+        dataframe = VAERSCleanData.VAERSPipeline().run_year(file_group)
+        filtered = VAERSCleanData.VAERSPipeline(filters=[('AGE_YRS', '>=', '50'), ('SEX', '=', 'F')]).run_year(file_group)
+
+        expected = dataframe.loc[(pd.to_numeric(dataframe['AGE_YRS'], errors='coerce') >= 50) & (dataframe['SEX'] == 'F')]
+        self.assertLess(0, len(filtered))
+        pd.testing.assert_frame_equal(expected[filtered.columns], filtered)
+
+    def test_dataset_partitions(self):
+        dataset_dir = 'C://fake_dir/VAERSDataset/'
+        os.makedirs(dataset_dir)
+        years = [pd.DataFrame({'VAERS_ID': ['1', '2', '3'], 'AGE_YRS': ['20', '30', '40'], 'VAX_TYPE_1': ['COVID19', 'FLU4', 'COVID19']}),
+                 pd.DataFrame({'VAERS_ID': ['4', '5'], 'AGE_YRS': ['50', '60'], 'SYMPTOM6': ['Rash', ''], 'VAX_TYPE_1': ['FLU(H1N1)', 'COVID19'], 'VAX_TYPE_2': ['COVID19', '']})]
+        combined_files = ['C://fake_dir/2020VAERS.csv', 'C://fake_dir/2021VAERS.csv']
+        for file, dataframe in zip(combined_files, years):
+            VAERSCleanData.write_table_file(dataframe.set_index('VAERS_ID'), file)
+
+        for split in [False, True]:
+            VAERSCleanData.vax_type_partitions = split
+            try:
+                entries = [VAERSCleanData.write_year_partitions(file, dataset_dir) for file in reversed(combined_files)]
+                VAERSCleanData.write_dataset_index(dataset_dir, combined_files, entries)
+            finally:
+                VAERSCleanData.vax_type_partitions = False
+
+            dataset = VAERSCleanData.VAERSDataset(dataset_dir)
+            self.assertEqual(['2020', '2021'], dataset.years)
+            self.assertEqual(['AGE_YRS', 'SYMPTOM6', 'VAX_TYPE_1', 'VAX_TYPE_2'], dataset.columns)
+            self.assertEqual(['1', '2', '3', '4', '5'], sorted(dataset.read().index))
+            self.assertEqual(3 if split else 2, len(dataset.get_partitions(years=[2021])) + len(dataset.get_partitions(years=['2020'], vax_types=['COVID19'])))
+
+            # a COVID19 dose in VAX_TYPE_2 counts as well
+            covid = dataset.read(years=[2021], vax_types=['COVID19'], columns=['AGE_YRS', 'SYMPTOM6'])
+            self.assertEqual(['4', '5'], sorted(covid.index))
+            self.assertEqual([['50', 'Rash'], ['60', '']], covid.sort_index().values.tolist())
+            self.assertEqual(0, len(dataset.get_partitions(years=[2020], vax_types=['FLU(H1N1)'])))
+            self.assertEqual(['30'], dataset.read(vax_types=['FLU4'], columns=['AGE_YRS'])['AGE_YRS'].to_list())
+        self.assertTrue(os.path.exists(dataset_dir + 'year=2021/VAX_TYPE=FLU(H1N1)/part.csv'))
+        self.assertFalse(os.path.exists(dataset_dir + 'year=2021/part.csv'))
+
+        # an incremental run keeps the years it did not rebuild, unless the dataset was split differently
+        self.assertEqual({}, VAERSCleanData.get_partitioned_years(dataset_dir, ['2020']))
+        VAERSCleanData.vax_type_partitions = True
+        try:
+            self.assertEqual(['2020'], list(VAERSCleanData.get_partitioned_years(dataset_dir, ['2020'])))
+        finally:
+            VAERSCleanData.vax_type_partitions = False
+
+    def test_parse_arguments(self):
+        VAERSCleanData.parse_arguments(['--data-dir', 'C://data/', '--begin-year', '2021', '--jobs', '4', '--engine', 'c'])
+        try:
+            self.assertEqual(VAERSCleanData.original_dir_name, 'C://data/')
+            self.assertEqual(VAERSCleanData.begin_year, 2021)
+            self.assertEqual(VAERSCleanData.stop_year, 2020) # unchanged
+            self.assertEqual(VAERSCleanData.jobs, 4)
+            self.assertEqual(VAERSCleanData.csv_engine, 'c')
+        finally:
+            VAERSCleanData.jobs = 1
+            VAERSCleanData.csv_engine = 'python'
+
+    def test_get_combined_file_names(self):
+        in_files = [['./TestData/CleanData/2019VAERSDATA.csv','./TestData/CleanData/2019VAERSSYMPTOMS.csv','./TestData/CleanData/2019VAERSVAX.csv'],['./TestData/CleanData/NonDomesticVAERSDATA.csv','./TestData/CleanData/NonDomesticVAERSSYMPTOMS.csv','./TestData/CleanData/NonDomesticVAERSVAX.csv']]
+        expected_result = ['C://fake_dir/2019VAERS.csv', 'C://fake_dir/NonDomesticVAERS.csv']
+        self.assertEqual(expected_result, VAERSCleanData.get_combined_file_names(in_files, 'C://fake_dir/'))
+
+# The tests that need the real file system, for worker processes and SQLite, work in a temporary directory out_dir
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.out_dir = self.temp_dir.name + '/'
+        VAERSCleanData.encoding_cache.clear()
+
+    def tearDown(self):
+        VAERSCleanData.jobs = 1
+        self.temp_dir.cleanup()
+
+class VAERSCleanDataParallelTest(TempDirTestCase):
+
+    # the original files are copied so their encoding sidecars are not written into TestData
+    def setUp(self):
+        super().setUp()
+        self.data_dir = self.out_dir + 'Data/'
+        os.mkdir(self.data_dir)
+        for name in ['NonDomesticVAERSDATA.csv', 'NonDomesticVAERSSYMPTOMS.csv', 'NonDomesticVAERSVAX.csv']:
+            shutil.copyfile('./TestData/Data/' + name, self.data_dir + name)
+
+    def test_run_tasks_matches_serial(self):
+        in_files = [self.data_dir + 'NonDomesticVAERSDATA.csv', self.data_dir + 'NonDomesticVAERSSYMPTOMS.csv', self.data_dir + 'NonDomesticVAERSVAX.csv']
+        os.mkdir(self.out_dir + 'serial')
+        os.mkdir(self.out_dir + 'parallel')
+
+        VAERSCleanData.jobs = 1
+        VAERSCleanData.run_tasks(VAERSCleanData.scrub_file, [(file, self.out_dir + 'serial/') for file in in_files])
+        VAERSCleanData.jobs = 3
+        VAERSCleanData.run_report.clear()
+        VAERSCleanData.run_tasks(VAERSCleanData.scrub_file, [(file, self.out_dir + 'parallel/') for file in in_files])
+        self.assertEqual(sorted(in_files), sorted(entry['file'] for entry in VAERSCleanData.run_report))
+
+        for file in in_files:
+            file_name = file.rpartition('/')[2]
+            with open(self.out_dir + 'serial/' + file_name, 'rb') as serial, open(self.out_dir + 'parallel/' + file_name, 'rb') as parallel:
+                self.assertEqual(serial.read(), parallel.read(), file_name)
+
+        # the results come back in the order of the items, not the largest first order they run in
+        clean_files = sorted((self.out_dir + 'parallel/' + file.rpartition('/')[2] for file in in_files), key=os.path.getsize)
+        self.assertEqual([VAERSCleanData.get_table_columns(file) for file in clean_files],
+                         VAERSCleanData.run_tasks(VAERSCleanData.get_table_columns, [(file,) for file in clean_files]))
+
+    def test_run_tasks_failure(self):
+        VAERSCleanData.jobs = 2
+        items = [(self.data_dir + 'NonDomesticVAERSVAX.csv', self.out_dir), (self.data_dir + 'missingVAERSVAX.csv', self.out_dir)]
+        with self.assertRaises(RuntimeError) as cm:
+            VAERSCleanData.run_tasks(VAERSCleanData.scrub_file, items)
+        self.assertIn('missingVAERSVAX.csv', str(cm.exception))
+
+class VAERSCleanDataBenchmarkTest(TempDirTestCase):
+
+    def test_generate_year(self):
+        files, malformed = VAERSCleanDataBenchmark.generate_year(self.out_dir, '2021', 200, multi_vax_ratio=0.5, malformed_ratio=0.05, seed=1)
+        self.assertEqual([self.out_dir + '2021VAERSDATA.csv', self.out_dir + '2021VAERSSYMPTOMS.csv', self.out_dir + '2021VAERSVAX.csv'], files)
+
+        data = VAERSCleanData.read_csv_file(files[0], dtype=str, na_filter=False)
+        self.assertEqual(VAERSCleanDataBenchmark.data_columns, data.columns.to_list())
+        self.assertEqual(200, len(data))
+        self.assertEqual(malformed[0], len(VAERSCleanData.bad_lines_by_file[files[0]]))
+
+        vax = VAERSCleanData.read_csv_file(files[2], dtype=str, na_filter=False)
+        self.assertGreater(len(vax), 200)
+        self.assertEqual(200, vax['VAERS_ID'].nunique())
+
+        # the same seed writes the same files
+        other_dir = self.out_dir + 'other/'
+        os.mkdir(other_dir)
+        VAERSCleanDataBenchmark.generate_year(other_dir, '2021', 200, multi_vax_ratio=0.5, malformed_ratio=0.05, seed=1)
+        with open(files[0], 'rb') as first, open(other_dir + '2021VAERSDATA.csv', 'rb') as second:
+            self.assertEqual(first.read(), second.read())
+
+    def test_run_benchmark(self):
+        results = VAERSCleanDataBenchmark.run_benchmark([50], years=2, memory=False, work_dir=self.temp_dir.name)
+        self.assertEqual(VAERSCleanDataBenchmark.stage_names, [result['stage'] for result in results])
+        self.assertTrue(all(result['seconds'] > 0 and result['peak_mb'] is None for result in results))
+
+# sqlite3 writes through its own file calls, which the fake file system does not see
+class VAERSCleanDataSQLiteTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        years = [pd.DataFrame({'VAERS_ID': ['10', '11'], 'RECVDATE': ['12/30/2020', '01/02/2021'], 'SYMPTOM1': ['Headache', 'Rash'], 'SYMPTOMVERSION1': ['23.1', '23.1'],
+                               'VAX_TYPE_1': ['COVID19', 'FLU4'], 'VAX_MANU_1': ['MODERNA', 'SANOFI'], 'VAX_TYPE_2': ['FLU4', ''], 'VAX_MANU_2': ['SANOFI', '']}),
+                 pd.DataFrame({'VAERS_ID': ['20'], 'RECVDATE': ['03/04/2021'], 'SYMPTOM1': ['Pyrexia'], 'SYMPTOMVERSION1': ['24.0'], 'SYMPTOM6': ['Headache'],
+                               'SYMPTOMVERSION6': ['24.0'], 'VAX_TYPE_1': ['COVID19'], 'VAX_MANU_1': ['PFIZER\\BIONTECH']})]
+        self.in_files = [self.out_dir + '2020VAERS.csv', self.out_dir + '2021VAERS.csv']
+        for file, dataframe in zip(self.in_files, years):
+            VAERSCleanData.write_table_file(dataframe.set_index('VAERS_ID'), file)
+
+    def test_build_sqlite_index(self):
+        VAERSCleanData.build_sqlite_index(self.in_files, self.out_dir)
+        db_file = self.out_dir + VAERSCleanData.sqlite_name
+        self.assertFalse(os.path.exists(db_file + '.tmp'))
+
+        reports = VAERSCleanData.lookup_reports(db_file)
+        self.assertEqual(['10', '11', '20'], reports.index.to_list())
+        self.assertEqual(['RECVDATE', 'SYMPTOM1', 'SYMPTOMVERSION1', 'SYMPTOM6', 'SYMPTOMVERSION6', 'VAX_TYPE_1', 'VAX_MANU_1', 'VAX_TYPE_2', 'VAX_MANU_2'], reports.columns.to_list())
+        self.assertEqual(['', 'Headache'], reports['SYMPTOM6'].to_list()[1:])
+
+        lookup_ids = lambda **query: VAERSCleanData.lookup_reports(db_file, columns=[], **query).index.to_list()
+        self.assertEqual(['11', '20'], lookup_ids(ids=[20, 11, 99]))
+        self.assertEqual(['10', '11'], lookup_ids(vax_types=['FLU4']))
+        self.assertEqual(['10', '20'], lookup_ids(symptoms=['Headache']))
+        self.assertEqual(['11'], lookup_ids(received_from='01/01/2021', received_to='03/03/2021'))
+        self.assertEqual(['20'], lookup_ids(vax_types=['COVID19'], symptoms=['Headache'], received_from='01/01/2021'))
+
+        connection = VAERSCleanData.sqlite3.connect(db_file)
+        try:
+            vaccines = connection.execute('SELECT VAERS_ID, VAX_NUMBER, VAX_TYPE, VAX_MANU FROM report_vaccines').fetchall()
+            plan = connection.execute('EXPLAIN QUERY PLAN SELECT * FROM report_symptoms WHERE SYMPTOM = ?', ('Rash',)).fetchall()
+        finally:
+            connection.close()
+        self.assertEqual([('10', '1', 'COVID19', 'MODERNA'), ('10', '2', 'FLU4', 'SANOFI'), ('11', '1', 'FLU4', 'SANOFI'), ('20', '1', 'COVID19', 'PFIZER\\BIONTECH')], vaccines)
+        self.assertIn('report_symptoms_SYMPTOM', str(plan))
+
+    def test_delta_merge(self):
+        VAERSCleanData.append_files(self.in_files, self.out_dir)
+        total = VAERSCleanData.append_files(self.in_files, self.out_dir) # over the total of an earlier run
+        VAERSCleanData.build_sqlite_index(self.in_files, self.out_dir)
+        self.assertEqual([['2020', 0, total['segments'][0][2]], ['2021', total['segments'][0][2], total['size']]], total['segments'])
+        previous_hashes = [VAERSCleanData.get_row_hashes(file) for file in self.in_files]
+
+        # 20 changes and 21 is new in 2021, 2020 gains an empty column and keeps its rows
+        VAERSCleanData.write_table_file(pd.read_csv(self.in_files[0], dtype=str, keep_default_na=False).assign(SYMPTOM6='').set_index('VAERS_ID'), self.in_files[0])
+        year = pd.DataFrame({'VAERS_ID': ['20', '21'], 'RECVDATE': ['03/04/2021', '03/05/2021'], 'SYMPTOM1': ['Pyrexia', 'Nausea'], 'SYMPTOMVERSION1': ['24.0', '24.0'],
+                             'SYMPTOM6': ['Chills', ''], 'SYMPTOMVERSION6': ['24.0', ''], 'VAX_TYPE_1': ['COVID19', 'FLU4'], 'VAX_MANU_1': ['PFIZER\\BIONTECH', 'SEQIRUS']})
+        VAERSCleanData.write_table_file(year.set_index('VAERS_ID'), self.in_files[1])
+        changes = pd.concat([VAERSCleanData.get_row_changes(file, hashes) for file, hashes in zip(self.in_files, previous_hashes)], ignore_index=True)
+        self.assertEqual([('2021', '21', 'inserted'), ('2021', '20', 'changed')], list(changes.itertuples(index=False, name=None)))
+
+        merged_total = VAERSCleanData.merge_into_total(self.in_files, self.out_dir, set(changes['YEAR']), total)
+        self.assertEqual(total['segments'][0], merged_total['segments'][0])
+        VAERSCleanData.merge_into_sqlite(self.in_files, self.out_dir, changes)
+        VAERSCleanData.write_changelog(self.out_dir, changes, datetime(2021, 3, 5))
+        os.mkdir(self.out_dir + 'full')
+        VAERSCleanData.append_files(self.in_files, self.out_dir + 'full/')
+        with open(self.out_dir + 'TotalVAERSData.csv') as merged, open(self.out_dir + 'full/TotalVAERSData.csv') as full:
+            self.assertEqual(full.read(), merged.read())
+
+        reports = VAERSCleanData.lookup_reports(self.out_dir + VAERSCleanData.sqlite_name)
+        self.assertEqual(['10', '11', '20', '21'], reports.index.to_list())
+        self.assertEqual(['', 'Chills', ''], reports['SYMPTOM6'].to_list()[1:])
+        self.assertEqual(['10', '11', '21'], VAERSCleanData.lookup_reports(self.out_dir + VAERSCleanData.sqlite_name, vax_types=['FLU4'], columns=[]).index.to_list())
+        self.assertEqual(['20'], VAERSCleanData.lookup_reports(self.out_dir + VAERSCleanData.sqlite_name, symptoms=['Chills'], columns=[]).index.to_list())
+        changelog = pd.read_csv(self.out_dir + VAERSCleanData.changelog_name, dtype=str)
+        self.assertEqual(['2021-03-05 00:00:00', '2021', '21', 'inserted'], changelog.iloc[0].to_list())
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file